@@ -1,6 +1,7 @@
 """
 Project configuration: paths and constants for E-Commerce Analytics.
 """
+import os
 from pathlib import Path
 
 # Paths
@@ -8,15 +9,122 @@ PROJECT_ROOT = Path(__file__).resolve().parent
 DATA_RAW = PROJECT_ROOT / "data" / "raw"
 DATA_CLEANED = PROJECT_ROOT / "data" / "cleaned"
 OUTPUTS = PROJECT_ROOT / "outputs"
+STATE_DIR = PROJECT_ROOT / "data" / "state"
+
+# Cleaned-layer format: "parquet" (typed, partitioned by event date) or "csv" (small demos)
+CLEANED_FORMAT = "parquet"
+
+# Memory budget (MB) per chunk for streaming cleaning: python scripts/data_cleaning.py --stream
+CLEAN_MEMORY_BUDGET_MB = 512
+
+# Incremental runs: a session stays open (mergeable) until it has been idle this long in event time
+SESSION_HORIZON_HOURS = 24
+# Incremental runs drop re-delivered events (same event_id) whose event date is within this many days of the
+# latest event; fingerprints of older days are discarded, so state stays bounded (older re-deliveries count again)
+REDELIVERY_WINDOW_DAYS = 3
+
+# Sessionization (scripts/sessionize.py): a user's events more than SESSION_GAP_MINUTES apart are separate sessions.
+# SESSIONIZE = "auto" derives session IDs in the clean step when session_id is absent or missing on some rows,
+# "always" replaces upstream IDs, "never" keeps them. Out-of-core runs sort user-hash buckets of ~SESSIONIZE_MEMORY_MB
+SESSION_GAP_MINUTES = 30
+SESSIONIZE = "auto"
+SESSIONIZE_MEMORY_MB = 1024
+
+# Worker processes for parallel funnel/EDA (scripts/parallel_analysis.py, run_pipeline.py --workers)
+N_WORKERS = os.cpu_count() or 1
+
+# SQL backend (scripts/sql_backend.py): DuckDB memory limit; larger intermediates spill to data/state/
+SQL_MEMORY_MB = 2048
+# Also compute the outputs with pandas on each SQL run and fail, writing nothing, on any mismatch (off: it
+# runs the full pandas funnel/EDA in memory, which the SQL backend exists to avoid; --check runs it on demand)
+SQL_CHECK = False
+
+# Approximate KPIs (scripts/sketches.py): HyperLogLog relative standard error for distinct orders/buyers,
+# Count-Min over-count bound (fraction of a day's total) and failure probability for top products,
+# candidate products kept per sketch, and the share of users sampled for the repeat-purchaser rate
+SKETCH_ERROR = 0.02
+SKETCH_CM_EPS = 0.005
+SKETCH_CM_DELTA = 0.01
+SKETCH_TOP_K = 100
+SKETCH_USER_SAMPLE = 0.125
+
+# Charts (scripts/charts.py): file format ("png", or "svg" for vector output), PNG resolution,
+# worker processes for re-rendering changed charts, and max points drawn per time series
+CHART_FORMAT = "png"
+CHART_DPI = 150
+CHART_WORKERS = min(4, N_WORKERS)
+CHART_MAX_POINTS = 1000
+
+# Sharded raw events (scripts/shard_loader.py): shard files under RAW_SHARD_DIR matching RAW_SHARD_GLOB are
+# read on INGEST_IO_THREADS threads and parsed/cleaned in INGEST_PARSE_WORKERS processes; a failing
+# shard is retried INGEST_RETRIES times before it is skipped
+RAW_SHARD_DIR = DATA_RAW / "events"
+RAW_SHARD_GLOB = "**/*.csv*"
+INGEST_IO_THREADS = 8
+INGEST_PARSE_WORKERS = N_WORKERS
+INGEST_RETRIES = 2
+# Raw events the pipeline's clean step reads: "csv" (data/raw/events.csv) or "shards" (RAW_SHARD_DIR);
+# run_pipeline.py --raw-input overrides it
+RAW_EVENTS_INPUT = "csv"
+
+# Streaming ingestion (scripts/streaming.py): rolling windows as name -> (seconds, ring-buffer slots);
+# the last window is the baseline for drop-off alerts, raised when a stage-to-stage conversion in a
+# shorter window falls below STREAM_ALERT_RATIO x its baseline rate (once STREAM_ALERT_MIN_SESSIONS
+# sessions reached the previous stage). Snapshots are refreshed every STREAM_SNAPSHOT_SECONDS.
+STREAM_WINDOWS = {"5m": (300, 30), "1h": (3600, 60), "24h": (86400, 96)}
+STREAM_ALERT_RATIO = 0.5
+STREAM_ALERT_MIN_SESSIONS = 20
+STREAM_SNAPSHOT_SECONDS = 5
+STREAM_HTTP_PORT = 8765
+
+# Instrumentation (scripts/instrument.py): PIPELINE_TRACE=1 (or run_pipeline.py --trace) records stage and
+# sub-step spans to TRACE_DIR; PIPELINE_PROFILE=1 (--profile) also samples Python stacks every PROFILE_INTERVAL_MS
+TRACE_ENABLED = os.environ.get("PIPELINE_TRACE") == "1"
+PROFILE_ENABLED = os.environ.get("PIPELINE_PROFILE") == "1"
+PROFILE_INTERVAL_MS = 5
+TRACE_DIR = STATE_DIR / "traces"
+
+# Benchmark suite (scripts/benchmark_pipeline.py): dataset tiers (name -> events), and a stage regresses when
+# it is more than BENCHMARK_REGRESSION_PCT slower (or uses that much more memory) than the baseline, ignoring
+# differences under BENCHMARK_MIN_SECONDS / BENCHMARK_MIN_MB (timer and RSS sampling noise)
+BENCHMARK_TIERS = {"100k": 100_000, "1m": 1_000_000, "10m": 10_000_000, "50m": 50_000_000}
+BENCHMARK_REGRESSION_PCT = 20
+BENCHMARK_MIN_SECONDS = 0.05
+BENCHMARK_MIN_MB = 50
+
+# Basket analysis (scripts/basket_analysis.py): a session's basket is the products it carted or bought
+# (BASKET_EVENT_TYPES). Pairs need BASKET_MIN_COUNT baskets together; each product / category keeps its
+# BASKET_TOP_K partners by lift. Co-occurrences are computed BASKET_BLOCK_ITEMS catalog columns at a time
+BASKET_EVENT_TYPES = ["add_to_cart", "purchase"]
+BASKET_MIN_COUNT = 3
+BASKET_TOP_K = 10
+BASKET_BLOCK_ITEMS = 4096
+
+# Dashboard: memory cap for parsed output files shared across sessions
+DASHBOARD_CACHE_MB = 256
 
 # Ensure directories exist
 DATA_RAW.mkdir(parents=True, exist_ok=True)
 DATA_CLEANED.mkdir(parents=True, exist_ok=True)
 OUTPUTS.mkdir(parents=True, exist_ok=True)
+STATE_DIR.mkdir(parents=True, exist_ok=True)
 
 # Funnel stages (order matters)
 FUNNEL_STAGES = ["visit", "signup", "add_to_cart", "purchase"]
 
+# Strict (time-ordered) funnel: max minutes from reaching the previous stage (None = any later time in the session)
+FUNNEL_WINDOW_MINUTES = {"signup": None, "add_to_cart": None, "purchase": 30}
+
+# User-level funnel: stages reached in any session starting within this many days of the first visit
+USER_FUNNEL_DAYS = 30
+
+# Repeat-purchase cohorts: share of buyers ordering again within each of these many days
+REPEAT_WINDOWS_DAYS = [30, 60, 90]
+
+# Funnel segmentation: single columns and the cross-segment breakdowns in funnel_cube.csv
+SEGMENT_COLUMNS = ["device", "region", "campaign_source"]
+SEGMENT_CROSSES = [("device", "region"), ("device", "campaign_source")]
+
 # Event type mapping for standardization
 EVENT_TYPE_MAP = {
     "visit": "visit",
@@ -0,0 +1,179 @@
+"""
+Basket analysis: products and categories bought together.
+- A basket is the set of products a session carted or bought (BASKET_EVENT_TYPES), held as a sparse
+  binary session x product matrix; category baskets are that matrix times a product -> category indicator
+- Co-occurrence counts are sparse matrix products (X.T @ X), computed BASKET_BLOCK_ITEMS columns at a time;
+  each block keeps only every item's BASKET_TOP_K partners by lift, so memory is bounded by the catalog size
+- Per pair: baskets together, support, confidence both ways and lift; items in fewer than BASKET_MIN_COUNT
+  baskets are pruned before multiplying (they cannot reach the pair threshold)
+Outputs: outputs/product_pairs.csv, outputs/category_pairs.csv
+Run from project root: python scripts/basket_analysis.py
+"""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import sys
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from config import BASKET_BLOCK_ITEMS, BASKET_EVENT_TYPES, BASKET_MIN_COUNT, BASKET_TOP_K, OUTPUTS
+
+from instrument import span, traced
+from product_index import ProductIndex
+from schema import decode_ids, read_compact_events, read_compact_products
+
+BASKET_COLUMNS = ["session_id", "event_type", "product_id"]
+PAIR_COLUMNS = ["a", "b", "baskets", "baskets_a", "baskets_b", "support", "confidence_a_to_b", "confidence_b_to_a", "lift"]
+
+
+def basket_matrix(session_codes: np.ndarray, item_codes: np.ndarray, n_sessions: int, n_items: int):
+    """Binary CSR matrix with a 1 where a session's basket contains an item (repeats count once)."""
+    import scipy.sparse as sp
+
+    baskets = sp.csr_matrix((np.ones(len(session_codes), dtype=np.int32), (session_codes, item_codes)),
+                            shape=(n_sessions, n_items))
+    baskets.data[:] = 1  # duplicates were summed by the constructor
+    return baskets
+
+
+def pair_stats(baskets, min_count: int = BASKET_MIN_COUNT, top_k: int = BASKET_TOP_K,
+               block: int = BASKET_BLOCK_ITEMS) -> pd.DataFrame:
+    """Item pairs (a < b, column positions) in at least min_count baskets, each item's top_k partners by lift."""
+    n_baskets = int(np.count_nonzero(np.diff(baskets.indptr)))
+    count = np.asarray(baskets.sum(axis=0)).ravel()
+    # Apriori pruning: only frequent items can be in a frequent pair, and only baskets with two of them matter
+    frequent = np.flatnonzero(count >= min_count)
+    x = baskets[:, frequent]
+    x = x[np.diff(x.indptr) >= 2]
+    if x.shape[0] == 0:
+        return pd.DataFrame(columns=PAIR_COLUMNS)
+    xt, xc = x.T.tocsr(), x.tocsc()
+    freq_count = count[frequent]
+
+    kept_a, kept_b, kept_c = [], [], []
+    for lo in range(0, len(frequent), block):
+        # Co-occurrence of every frequent item with this block's items
+        co = (xt @ xc[:, lo:lo + block]).tocoo()
+        i, j, c = co.row, co.col + lo, co.data
+        keep = (i != j) & (c >= min_count)
+        i, j, c = i[keep], j[keep], c[keep]
+        lift = c * n_baskets / (freq_count[i] * freq_count[j])
+        # Top-k partners per block item: rank within each column by lift, then co-occurrence
+        order = np.lexsort((-c, -lift, j))
+        i, j, c = i[order], j[order], c[order]
+        starts = np.flatnonzero(np.r_[True, j[1:] != j[:-1]]) if len(j) else np.empty(0, dtype=np.int64)
+        rank = np.arange(len(j)) - np.repeat(starts, np.diff(np.r_[starts, len(j)]))
+        top = rank < top_k
+        kept_a.append(np.minimum(i[top], j[top]))
+        kept_b.append(np.maximum(i[top], j[top]))
+        kept_c.append(c[top])
+
+    a, b, c = np.concatenate(kept_a), np.concatenate(kept_b), np.concatenate(kept_c)
+    # A pair in the top k of both its items was kept twice
+    _, first = np.unique(a.astype(np.int64) * len(frequent) + b, return_index=True)
+    a, b, c = a[first], b[first], c[first].astype(np.int64)
+    count_a, count_b = freq_count[a], freq_count[b]
+    pairs = pd.DataFrame({
+        "a": frequent[a], "b": frequent[b], "baskets": c, "baskets_a": count_a, "baskets_b": count_b,
+        "support": c / n_baskets,
+        "confidence_a_to_b": c / count_a,
+        "confidence_b_to_a": c / count_b,
+        "lift": c * n_baskets / (count_a * count_b),
+    })
+    return pairs.sort_values(["lift", "baskets"], ascending=False, kind="stable").reset_index(drop=True)
+
+
+def session_baskets(events: pd.DataFrame, index: ProductIndex, event_types=BASKET_EVENT_TYPES):
+    """Session x catalog-position basket matrix from the basket events."""
+    rows = events[events["event_type"].isin(event_types)]
+    positions = index.positions(rows["product_id"])
+    session_codes, session_ids = pd.factorize(rows["session_id"])
+    known = (positions >= 0) & (session_codes >= 0)
+    return basket_matrix(session_codes[known], positions[known], len(session_ids), len(index))
+
+
+def _rounded(pairs: pd.DataFrame) -> pd.DataFrame:
+    return pairs.round({"support": 6, "confidence_a_to_b": 4, "confidence_b_to_a": 4, "lift": 3})
+
+
+def product_pairs(baskets, index: ProductIndex, **kwargs) -> pd.DataFrame:
+    """Product pairs with ids, names and categories for both sides."""
+    pairs = pair_stats(baskets, **kwargs)
+    sides = {}
+    for side in ("a", "b"):
+        pos = pairs[side].to_numpy(dtype=np.int64)
+        described = decode_ids(index.table({"product_id": index.product_ids[pos]}))
+        attributes = index.attributes(pos)
+        sides[side] = pd.DataFrame({
+            f"product_id_{side}": described["product_id"].to_numpy(),
+            f"product_name_{side}": np.asarray(attributes["product_name"], dtype=object),
+            f"category_{side}": np.asarray(attributes["category"], dtype=object),
+        })
+    return _rounded(pd.concat([sides["a"], sides["b"], pairs.drop(columns=["a", "b"])], axis=1))
+
+
+def category_pairs(baskets, index: ProductIndex, **kwargs) -> pd.DataFrame:
+    """Category pairs: the product baskets rolled up to categories (a basket counts once per category)."""
+    import scipy.sparse as sp
+
+    known = np.flatnonzero(index.category_codes >= 0)
+    to_category = sp.csr_matrix((np.ones(len(known), dtype=np.int32), (known, index.category_codes[known])),
+                                shape=(len(index), len(index.categories)))
+    categories = (baskets @ to_category).tocsr()
+    categories.data[:] = 1
+    pairs = pair_stats(categories, **kwargs)
+    names = {f"category_{side}": index.categories[pairs[side].to_numpy(dtype=np.int64)] for side in ("a", "b")}
+    return _rounded(pd.concat([pd.DataFrame(names), pairs.drop(columns=["a", "b"])], axis=1))
+
+
+def bundle_candidates(pairs: pd.DataFrame, top_products: pd.DataFrame, n_best: int = 10, n: int = 5) -> pd.DataFrame:
+    """Pairs of a best-seller (top n_best by revenue) with a product outside the top, by lift.
+
+    confidence is the share of the best-seller's baskets that also hold the partner.
+    """
+    columns = ["best_seller", "partner", "partner_category", "baskets", "confidence", "lift"]
+    if pairs is None or top_products is None or len(pairs) == 0:
+        return pd.DataFrame(columns=columns)
+    best = set(top_products["product_id"].head(n_best))
+    a_best = pairs["product_id_a"].isin(best)
+    b_best = pairs["product_id_b"].isin(best)
+    rows = []
+    for flip, mask in ((False, a_best & ~b_best), (True, b_best & ~a_best)):
+        part = pairs[mask]
+        s, p = ("b", "a") if flip else ("a", "b")
+        rows.append(pd.DataFrame({
+            "best_seller": part[f"product_name_{s}"], "partner": part[f"product_name_{p}"],
+            "partner_category": part[f"category_{p}"], "baskets": part["baskets"],
+            "confidence": part[f"confidence_{s}_to_{p}"], "lift": part["lift"],
+        }))
+    candidates = pd.concat(rows, ignore_index=True)
+    return candidates.sort_values(["lift", "baskets"], ascending=False, kind="stable").head(n).reset_index(drop=True)
+
+
+@traced
+def basket_analysis(events: pd.DataFrame, products) -> tuple:
+    """(product pairs, category pairs) for events in the compact or plain schema."""
+    index = products if isinstance(products, ProductIndex) else ProductIndex(products)
+    with span("basket_analysis.matrix", rows_in=len(events)) as s:
+        baskets = session_baskets(events, index)
+        s.rows_out = baskets.shape[0]
+    return product_pairs(baskets, index), category_pairs(baskets, index)
+
+
+def run(events: pd.DataFrame, products):
+    """Compute and save product and category pairs."""
+    by_product, by_category = basket_analysis(events, products)
+    by_product.to_csv(OUTPUTS / "product_pairs.csv", index=False)
+    by_category.to_csv(OUTPUTS / "category_pairs.csv", index=False)
+    print(f"Basket analysis: {len(by_product)} product pairs and {len(by_category)} category pairs saved.")
+    return by_product, by_category
+
+
+def main():
+    print("Loading cart and purchase events...")
+    events = read_compact_events(columns=BASKET_COLUMNS, event_types=BASKET_EVENT_TYPES)
+    run(events, read_compact_products(columns=["product_id", "product_name", "category", "price"]))
+
+
+if __name__ == "__main__":
+    main()
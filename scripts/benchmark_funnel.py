@@ -0,0 +1,93 @@
+"""
+Benchmark: vectorized funnel engine vs the original per-session lambda aggregation.
+Run from project root: python scripts/benchmark_funnel.py [--sizes 1000000 10000000 50000000]
+"""
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import sys
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from config import FUNNEL_STAGES
+
+from funnel_analysis import funnel_by_session, funnel_counts, strict_funnel
+
+# Same drop-off shape as generate_sample_data (per session: visit, ~35% signup, ~45% cart, ~55% of carts buy)
+STAGE_WEIGHTS = [1.0, 0.35, 0.9, 0.5]
+
+
+def synthetic_events(n_events: int, seed: int = 42) -> pd.DataFrame:
+    """Random events with integer session ids (avoids spending the benchmark on string allocation)."""
+    rng = np.random.default_rng(seed)
+    n_sessions = max(1, int(n_events / sum(STAGE_WEIGHTS)))
+    p = np.array(STAGE_WEIGHTS) / sum(STAGE_WEIGHTS)
+    return pd.DataFrame({
+        "session_id": rng.integers(0, n_sessions, n_events, dtype=np.int64),
+        "event_type": np.array(FUNNEL_STAGES, dtype=object)[rng.choice(len(FUNNEL_STAGES), n_events, p=p)],
+        "timestamp": np.datetime64("2024-10-01") + rng.integers(0, 90 * 1440, n_events).astype("timedelta64[m]"),
+    })
+
+
+def legacy_funnel_by_session(events: pd.DataFrame) -> pd.DataFrame:
+    """The original implementation: one Python lambda per stage per session group."""
+    return events.groupby("session_id").agg(
+        visit=("event_type", lambda x: (x == "visit").any().astype(int)),
+        signup=("event_type", lambda x: (x == "signup").any().astype(int)),
+        add_to_cart=("event_type", lambda x: (x == "add_to_cart").any().astype(int)),
+        purchase=("event_type", lambda x: (x == "purchase").any().astype(int)),
+    ).reset_index()
+
+
+def legacy_funnel_counts(sessions: pd.DataFrame) -> pd.DataFrame:
+    counts = []
+    for i, stage in enumerate(FUNNEL_STAGES):
+        if i == 0:
+            n = sessions[stage].sum()
+        else:
+            n = sessions[sessions[FUNNEL_STAGES[: i + 1]].min(axis=1) == 1][stage].sum()
+        counts.append({"stage": stage, "count": int(n)})
+    return pd.DataFrame(counts)
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000_000, 10_000_000, 50_000_000])
+    # The lambda path needs ~3 minutes per 1M events, so larger tiers only time the new engine by default
+    parser.add_argument("--legacy-max", type=int, default=1_000_000,
+                        help="skip the legacy implementation above this many events")
+    args = parser.parse_args()
+
+    rows = []
+    for n in args.sizes:
+        events = synthetic_events(n)
+        sessions, t_sessions = timed(funnel_by_session, events)
+        counts, t_counts = timed(funnel_counts, sessions)
+        _, t_strict = timed(strict_funnel, events)
+        row = {"events": n, "sessions": len(sessions), "vectorized_s": round(t_sessions + t_counts, 3),
+               "strict_s": round(t_strict, 3)}
+        if n <= args.legacy_max:
+            legacy_sessions, t_legacy_sessions = timed(legacy_funnel_by_session, events)
+            legacy_counts, t_legacy_counts = timed(legacy_funnel_counts, legacy_sessions)
+            assert counts.equals(legacy_counts), "vectorized funnel counts differ from legacy"
+            row["legacy_s"] = round(t_legacy_sessions + t_legacy_counts, 3)
+            row["speedup"] = round(row["legacy_s"] / row["vectorized_s"], 1) if row["vectorized_s"] else None
+        else:
+            row["legacy_s"] = row["speedup"] = None
+        rows.append(row)
+        print(pd.DataFrame([row]).to_string(index=False))
+
+    print("\nSummary:")
+    print(pd.DataFrame(rows).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""
+Benchmark suite: wall time, CPU time and memory of each pipeline stage function at fixed scale tiers.
+- Tiers (BENCHMARK_TIERS: 100K, 1M, 10M, 50M events) are generated deterministically with the
+  generate_sample_data schema and cached in data/state/benchmarks/data/ (timestamps as strings, as in the raw CSV)
+- Stage functions run in pipeline order, each on the previous stages' results; the best of --repeat runs
+  is kept, with peak RSS and RSS growth during the stage
+- Results go to data/state/benchmarks/results.json; each stage is compared with the baseline
+  (data/state/benchmarks/baseline.json or --baseline) and the run fails when one regresses by more than
+  BENCHMARK_REGRESSION_PCT
+Run from project root: python scripts/benchmark_pipeline.py [--tiers 100k 1m 10m 50m] [--repeat 3] [--save-baseline]
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import sys
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from config import (BENCHMARK_MIN_MB, BENCHMARK_MIN_SECONDS, BENCHMARK_REGRESSION_PCT, BENCHMARK_TIERS,
+                    CHART_FORMAT, SEGMENT_COLUMNS, STATE_DIR)
+
+from data_cleaning import clean_events, clean_products
+from eda import (aov_and_repeat, chart_jobs, merge_purchases_with_products, revenue_trends, seasonality_table,
+                 top_products_and_categories)
+from funnel_analysis import conversion_rates, funnel_by_segment, funnel_by_session, funnel_counts
+from generate_sample_data import CHUNK_SESSIONS, N_DAYS, SEED, generate_events, generate_products, generate_sessions
+from instrument import PeakRSS, rss_mb
+from product_index import ProductIndex
+from schema import compact_events, compact_products, lookups_in
+from sessionize import sessionize
+
+BENCH_DIR = STATE_DIR / "benchmarks"
+RESULTS_FILE = BENCH_DIR / "results.json"
+BASELINE_FILE = BENCH_DIR / "baseline.json"
+# generate_sample_data's funnel probabilities give ~2.58 events per session
+EVENTS_PER_SESSION = 2.58
+DEFAULT_TIERS = ["100k", "1m"]
+
+
+def dataset(tier: str, seed: int = SEED):
+    """(raw events, raw products) for a tier; generated once per tier and seed, then read from Parquet."""
+    events_path = BENCH_DIR / "data" / f"events_{tier}_seed{seed}.parquet"
+    products_path = BENCH_DIR / "data" / f"products_{tier}_seed{seed}.parquet"
+    if not events_path.exists():
+        print(f"Generating {tier} dataset (cached in {events_path.parent})...")
+        generate_dataset(BENCHMARK_TIERS[tier], seed, events_path, products_path)
+    return pd.read_parquet(events_path), pd.read_parquet(products_path)
+
+
+def generate_dataset(n_events: int, seed: int, events_path: Path, products_path: Path):
+    """~n_events raw events (sessions / 4 users, n_events / 1000 products) written chunk by chunk."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    rng = np.random.default_rng(seed)
+    n_sessions = max(1, int(np.ceil(n_events / EVENTS_PER_SESSION)))
+    products = generate_products(max(100, n_events // 1000), rng)
+    events_path.parent.mkdir(parents=True, exist_ok=True)
+    products.to_parquet(products_path, index=False)
+
+    tmp = events_path.with_suffix(".tmp")
+    writer, written = None, 0
+    for first in range(0, n_sessions, CHUNK_SESSIONS):
+        sessions = generate_sessions(first, min(CHUNK_SESSIONS, n_sessions - first), max(1, n_sessions // 4), N_DAYS, rng)
+        events = generate_events(sessions, products, rng, first_event=written)
+        events["timestamp"] = np.datetime_as_string(events["timestamp"].to_numpy(), unit="s")
+        table = pa.Table.from_pandas(events, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(tmp, table.schema)
+        writer.write_table(table.cast(writer.schema))
+        written += len(events)
+    writer.close()
+    tmp.replace(events_path)
+
+
+def measure(monitor: PeakRSS, fn, *args, repeat: int = 1, copy: bool = False, **kwargs):
+    """(result, stats) of fn(*args, **kwargs), keeping the fastest of `repeat` runs.
+
+    copy=True passes fresh copies of DataFrame arguments to each run (for functions that modify their input).
+    """
+    best = None
+    for _ in range(repeat):
+        call = [a.copy() if copy and isinstance(a, pd.DataFrame) else a for a in args]
+        gc.collect()
+        monitor.reset()
+        before = monitor.peak
+        wall, cpu = time.perf_counter(), time.process_time()
+        result = fn(*call, **kwargs)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        # The sampler can miss a short stage entirely; the RSS right after it is a lower bound
+        peak = max(monitor.peak, rss_mb())
+        stats = {"seconds": round(wall, 4), "cpu_seconds": round(cpu, 4),
+                 "peak_rss_mb": round(peak, 1), "mem_mb": round(peak - before, 1)}
+        if best is None or stats["seconds"] < best["seconds"]:
+            best = stats
+        del call
+    return result, best
+
+
+def run_tier(tier: str, seed: int = SEED, repeat: int = 1, monitor: PeakRSS = None) -> dict:
+    """Stage timings for one tier: {"events", "sessions", "products", "stages": {stage: stats}}."""
+    raw_events, raw_products = dataset(tier, seed)
+    stages = {}
+
+    def timed(name, fn, *args, copy=False, **kwargs):
+        result, stages[name] = measure(monitor, fn, *args, repeat=repeat, copy=copy, **kwargs)
+        print(f"  {name:<30} {stages[name]['seconds']:9.3f} s {stages[name]['mem_mb']:9.1f} MB")
+        return result
+
+    cleaned = timed("clean_events", clean_events, raw_events, copy=True)
+    products = timed("clean_products", clean_products, raw_products, copy=True)
+    # Timed only: the funnel keeps the generated session IDs so tiers stay comparable
+    timed("sessionize", sessionize, cleaned)
+    n_raw = len(raw_events)
+    del raw_events
+    # Scratch ID lookups: benchmark ids never reach data/state/ids
+    with tempfile.TemporaryDirectory() as scratch, lookups_in(Path(scratch)):
+        events = timed("compact_events", compact_events, cleaned)
+        products = compact_products(products)
+    del cleaned
+
+    sessions = timed("funnel_by_session", funnel_by_session, events)
+    counts = timed("funnel_counts", funnel_counts, sessions)
+    timed("funnel_by_segment", lambda e: [funnel_by_segment(e, col) for col in SEGMENT_COLUMNS], events)
+    index = timed("product_index", ProductIndex, products)
+    purchases = timed("merge_purchases_with_products", merge_purchases_with_products, events, index)
+    by_product, by_category = timed("top_products_and_categories", top_products_and_categories, purchases, index)
+    daily = timed("revenue_trends", revenue_trends, purchases)
+    timed("aov_and_repeat", aov_and_repeat, events, purchases)
+    seasonality = timed("seasonality_table", seasonality_table, purchases)
+    with tempfile.TemporaryDirectory() as plots:
+        jobs = chart_jobs(conversion_rates(counts), by_product, by_category, daily, seasonality)
+        for name, (plot, data) in jobs.items():
+            timed(plot.__name__, plot, data, path=Path(plots) / f"{name}.{CHART_FORMAT}")
+    return {"raw_events": n_raw, "events": len(events), "sessions": len(sessions), "products": len(index),
+            "stages": stages}
+
+
+def machine_info() -> dict:
+    return {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count(),
+            "pandas": pd.__version__, "numpy": np.__version__}
+
+
+def compare(results: dict, baseline: dict, threshold: float = BENCHMARK_REGRESSION_PCT) -> pd.DataFrame:
+    """Stage-by-stage change against the baseline for tiers in both; `regressed` marks stages over threshold."""
+    rows = []
+    for tier, run in results["tiers"].items():
+        base = baseline.get("tiers", {}).get(tier, {}).get("stages", {})
+        for stage, stats in run["stages"].items():
+            if stage not in base:
+                continue
+            old = base[stage]
+            slower = stats["seconds"] - old["seconds"]
+            bigger = stats["mem_mb"] - old["mem_mb"]
+            rows.append({
+                "tier": tier, "stage": stage,
+                "seconds": stats["seconds"], "baseline_seconds": old["seconds"],
+                "time_pct": round(100 * slower / old["seconds"], 1) if old["seconds"] else None,
+                "mem_mb": stats["mem_mb"], "baseline_mem_mb": old["mem_mb"],
+                "regressed": bool(
+                    (slower > BENCHMARK_MIN_SECONDS and slower > old["seconds"] * threshold / 100)
+                    or (bigger > BENCHMARK_MIN_MB and bigger > max(old["mem_mb"], 0) * threshold / 100)
+                ),
+            })
+    return pd.DataFrame(rows, columns=["tier", "stage", "seconds", "baseline_seconds", "time_pct",
+                                       "mem_mb", "baseline_mem_mb", "regressed"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark each pipeline stage at fixed dataset tiers.")
+    parser.add_argument("--tiers", nargs="+", choices=list(BENCHMARK_TIERS), default=DEFAULT_TIERS)
+    parser.add_argument("--repeat", type=int, default=1, help="runs per stage (the fastest is kept)")
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--output", type=Path, default=RESULTS_FILE, help="results JSON")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_FILE, help="baseline JSON to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the baseline")
+    parser.add_argument("--threshold", type=float, default=BENCHMARK_REGRESSION_PCT,
+                        help="%% slower (or more memory) than the baseline that counts as a regression")
+    args = parser.parse_args()
+
+    results = {"created": datetime.now().isoformat(timespec="seconds"), "machine": machine_info(),
+               "seed": args.seed, "repeat": args.repeat, "tiers": {}}
+    monitor = PeakRSS()
+    monitor.start()
+    try:
+        for tier in args.tiers:
+            print(f"\nTier {tier} ({BENCHMARK_TIERS[tier]:,} events)")
+            results["tiers"][tier] = run_tier(tier, args.seed, args.repeat, monitor)
+    finally:
+        monitor.stop()
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    args.output.write_text(json.dumps(results, indent=2))
+    print(f"\nResults saved to {args.output}")
+
+    if args.save_baseline:
+        # Tiers not run this time keep their previous baseline
+        baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {"tiers": {}}
+        baseline.update({k: v for k, v in results.items() if k != "tiers"})
+        baseline["tiers"].update(results["tiers"])
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        args.baseline.write_text(json.dumps(baseline, indent=2))
+        print(f"Baseline saved to {args.baseline}")
+        return
+    if not args.baseline.exists():
+        print(f"No baseline at {args.baseline}; store one with --save-baseline")
+        return
+
+    baseline = json.loads(args.baseline.read_text())
+    if baseline.get("machine") != results["machine"]:
+        print("Note: the baseline was recorded on a different machine or library versions")
+    report = compare(results, baseline, args.threshold)
+    print("\nAgainst baseline:")
+    print(report.to_string(index=False))
+    regressed = report[report["regressed"]]
+    if len(regressed):
+        print(f"\nFAILED: {len(regressed)} stage(s) regressed by more than {args.threshold:g}%: "
+              + ", ".join(f"{r.tier}/{r.stage}" for r in regressed.itertuples()))
+        sys.exit(1)
+    print("\nNo regressions.")
+
+
+if __name__ == "__main__":
+    main()
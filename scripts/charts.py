@@ -0,0 +1,91 @@
+"""
+Chart rendering: each chart is a plot function plus the small DataFrame it draws.
+- A chart is skipped when the hash of its data, plot code and format matches its last render
+  (hashes in data/state/chart_hashes.json) and the file still exists
+- Changed charts render in parallel worker processes (CHART_WORKERS)
+- Long time series are downsampled to CHART_MAX_POINTS (min/max per bucket keeps peaks visible)
+- CHART_FORMAT = "svg" writes vector files instead of PNGs
+"""
+import hashlib
+import inspect
+import json
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import sys
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from config import CHART_FORMAT, CHART_MAX_POINTS, CHART_WORKERS, OUTPUTS, STATE_DIR
+
+from instrument import span
+
+HASH_FILE = STATE_DIR / "chart_hashes.json"
+_lock = threading.Lock()  # eda and funnel_chart stages may render from concurrent pipeline threads
+
+
+def chart_path(name: str, fmt: str = CHART_FORMAT) -> Path:
+    return OUTPUTS / f"{name}.{fmt}"
+
+
+def downsample(frame: pd.DataFrame, column: str, max_points: int = CHART_MAX_POINTS) -> pd.DataFrame:
+    """At most max_points rows: the min and max `column` row of each of max_points / 2 equal buckets."""
+    if len(frame) <= max_points:
+        return frame
+    frame = frame.reset_index(drop=True)
+    bucket = np.arange(len(frame)) * (max_points // 2) // len(frame)
+    grouped = frame[column].groupby(bucket)
+    keep = np.union1d(grouped.idxmin().to_numpy(), grouped.idxmax().to_numpy())
+    return frame.iloc[keep].reset_index(drop=True)
+
+
+def _code_hash(plot) -> str:
+    return hashlib.blake2b(Path(inspect.getsourcefile(plot)).read_bytes(), digest_size=8).hexdigest()
+
+
+def chart_hash(plot, data: pd.DataFrame, fmt: str = CHART_FORMAT) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{plot.__module__}.{plot.__qualname__}:{_code_hash(plot)}:{fmt}".encode())
+    digest.update(",".join(map(str, data.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(data, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def _load_hashes() -> dict:
+    return json.loads(HASH_FILE.read_text()) if HASH_FILE.exists() else {}
+
+
+def _render(plot, data: pd.DataFrame, path: Path):
+    plot(data, path=path)
+    return path
+
+
+def render_charts(charts: dict, workers: int = CHART_WORKERS, fmt: str = CHART_FORMAT, force: bool = False) -> list:
+    """Render {name: (plot function, data)} to OUTPUTS/<name>.<fmt>; returns the names re-rendered.
+
+    Plot functions are called as plot(data, path=...) and must be module-level (picklable).
+    """
+    with _lock:
+        previous = _load_hashes()
+    hashes = {name: chart_hash(plot, data, fmt) for name, (plot, data) in charts.items()}
+    changed = [name for name in charts
+               if force or previous.get(name) != hashes[name] or not chart_path(name, fmt).exists()]
+    with span("charts.render", rows_in=len(changed), charts=",".join(changed)):
+        if len(changed) > 1 and workers > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(changed))) as pool:
+                futures = [pool.submit(_render, *charts[name], chart_path(name, fmt)) for name in changed]
+                for future in futures:
+                    future.result()
+        else:
+            for name in changed:
+                _render(*charts[name], chart_path(name, fmt))
+
+    with _lock:
+        saved = _load_hashes()
+        saved.update({name: hashes[name] for name in changed})
+        HASH_FILE.write_text(json.dumps(saved, indent=2))
+    skipped = len(charts) - len(changed)
+    print(f"Charts: {len(changed)} rendered" + (f", {skipped} unchanged" if skipped else ""))
+    return changed
@@ -0,0 +1,125 @@
+"""
+Cohorts and funnel time series:
+- Retention: users by signup week x weeks since signup, share active (any session) in each week
+- Funnel by day and by week of session start (ordered stage counts and visit -> purchase conversion)
+Timestamps are bucketed into integer period codes, and each table is one 2-D bincount over
+(period, column) cells of the shared user -> sessions index.
+Run from project root: python scripts/cohorts.py
+"""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import sys
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from config import FUNNEL_STAGES, OUTPUTS
+
+from funnel_analysis import ordered_reach, session_reach_matrix
+from schema import read_compact_events
+from user_index import NO_TIME, NS_PER_DAY, UserSessionIndex
+
+COHORT_COLUMNS = ["session_id", "user_id", "event_type", "timestamp"]
+# 1970-01-01 was a Thursday: shifting by 3 days makes weekly codes start on Monday
+WEEK_SHIFT_DAYS = 3
+
+
+def period_codes(ts_ns: np.ndarray, freq: str) -> np.ndarray:
+    """Integer day ("D") or Monday-based week ("W") numbers since the epoch for int64 ns timestamps."""
+    days = ts_ns // NS_PER_DAY
+    return days if freq == "D" else (days + WEEK_SHIFT_DAYS) // 7
+
+
+def period_start(codes: np.ndarray, freq: str) -> pd.DatetimeIndex:
+    days = codes if freq == "D" else codes * 7 - WEEK_SHIFT_DAYS
+    return pd.to_datetime(np.asarray(days, dtype=np.int64) * NS_PER_DAY)
+
+
+def funnel_time_series(events: pd.DataFrame, freqs=("D", "W"), index: UserSessionIndex = None) -> dict:
+    """{freq: sessions and ordered stage counts per period of session start, with visit -> purchase conversion}."""
+    index = index if index is not None else UserSessionIndex.from_events(events)
+    session_ids, reach = session_reach_matrix(events)
+    codes = index.positions(session_ids)
+    start = np.where(codes >= 0, index.session_start[np.maximum(codes, 0)], NO_TIME)
+    timed = start != NO_TIME
+    # Column 0 counts sessions, columns 1.. the ordered stages
+    cells = np.hstack([np.ones((int(timed.sum()), 1), dtype=bool), ordered_reach(reach[timed])])
+    rows, cols = np.nonzero(cells)
+    n_cols = cells.shape[1]
+
+    result = {}
+    for freq in freqs:
+        series = pd.DataFrame(columns=["date", "sessions", *FUNNEL_STAGES, "conversion_pct"])
+        if len(cells):
+            period = period_codes(start[timed], freq)
+            first = period.min()
+            period -= first
+            n_periods = int(period.max()) + 1
+            # One bincount over (period, column) cells
+            counts = np.bincount(period[rows] * n_cols + cols, minlength=n_periods * n_cols).reshape(n_periods, n_cols)
+            series = pd.DataFrame(counts, columns=["sessions", *FUNNEL_STAGES])
+            series.insert(0, "date", period_start(first + np.arange(n_periods), freq))
+            with np.errstate(divide="ignore", invalid="ignore"):
+                series["conversion_pct"] = np.where(
+                    series["visit"] > 0, series["purchase"] / series["visit"] * 100, 0).round(2)
+            series = series[series["sessions"] > 0].reset_index(drop=True)
+        result[freq] = series
+    return result
+
+
+def cohort_retention(events: pd.DataFrame, index: UserSessionIndex = None) -> pd.DataFrame:
+    """Long table: signup-week cohort, weeks since signup, cohort size, active users and retention %.
+
+    A user's cohort is the week of their first session with a signup; they are active in a week
+    if any of their sessions starts in it.
+    """
+    index = index if index is not None else UserSessionIndex.from_events(events)
+    signup_sessions = index.session_mask(events.loc[events["event_type"] == "signup", "session_id"].dropna())
+    week = np.where(index.session_start != NO_TIME, period_codes(index.session_start, "W"), NO_TIME)
+    cohort = index.per_user(np.where(signup_sessions, week, NO_TIME), np.minimum)
+
+    # Distinct (user, active week) pairs from the sessions of users with a cohort
+    session_cohort = index.broadcast(cohort)
+    session_week = week[index.sessions]
+    users = index.session_user[index.sessions].astype(np.int64)
+    keep = (session_cohort != NO_TIME) & (session_week != NO_TIME) & (session_week >= session_cohort)
+    if not keep.any():
+        return pd.DataFrame(columns=["cohort_week", "week_offset", "cohort_size", "active_users", "retention_pct"])
+    first_week = cohort[cohort != NO_TIME].min()
+    n_weeks = int(session_week[keep].max() - first_week) + 1
+    pairs = np.unique(users[keep] * n_weeks + (session_week[keep] - first_week))
+    pair_cohort = cohort[pairs // n_weeks] - first_week
+    pair_offset = pairs % n_weeks - pair_cohort
+
+    # One 2-D bincount over (cohort, offset) cells; cohort sizes are a bincount of cohort weeks
+    active = np.bincount(pair_cohort * n_weeks + pair_offset, minlength=n_weeks * n_weeks).reshape(n_weeks, n_weeks)
+    size = np.bincount(cohort[cohort != NO_TIME] - first_week, minlength=n_weeks)
+    cohort_idx, offset = np.nonzero(active)
+    return pd.DataFrame({
+        "cohort_week": period_start(first_week + cohort_idx, "W"),
+        "week_offset": offset,
+        "cohort_size": size[cohort_idx],
+        "active_users": active[cohort_idx, offset],
+        "retention_pct": (active[cohort_idx, offset] / size[cohort_idx] * 100).round(2),
+    })
+
+
+def run(events: pd.DataFrame, index: UserSessionIndex = None):
+    """Compute and save cohort retention and daily/weekly funnel time series."""
+    index = index if index is not None else UserSessionIndex.from_events(events)
+    retention = cohort_retention(events, index)
+    retention.to_csv(OUTPUTS / "cohort_retention.csv", index=False)
+    print(f"Cohort retention: {retention['cohort_week'].nunique()} signup-week cohorts saved.")
+    series = funnel_time_series(events, ("D", "W"), index)
+    for freq, name in [("D", "funnel_daily.csv"), ("W", "funnel_weekly.csv")]:
+        series[freq].to_csv(OUTPUTS / name, index=False)
+        print(f"{name} saved ({len(series[freq])} periods).")
+
+
+def main():
+    print("Loading cleaned events...")
+    run(read_compact_events(columns=COHORT_COLUMNS))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
 """
 Step 4: Interactive Dashboard (Streamlit)
 - Funnel conversion, top products, revenue trends, KPI summary
+- Live funnel: rolling-window counts and drop-off alerts from scripts/streaming.py, refreshed in place
+- Frequently bought together: product and category pairs from scripts/basket_analysis.py
 Run from project root: streamlit run scripts/dashboard_app.py
 Or double-click: run_dashboard.bat
 """
@@ -13,11 +15,19 @@ _OUTPUTS = _PROJECT_ROOT / "outputs"
 _OUTPUTS.mkdir(parents=True, exist_ok=True)
 if str(_PROJECT_ROOT) not in sys.path:
     sys.path.insert(0, str(_PROJECT_ROOT))
+if str(_PROJECT_ROOT / "scripts") not in sys.path:
+    sys.path.insert(0, str(_PROJECT_ROOT / "scripts"))
 
 import streamlit as st
 import pandas as pd
 import plotly.express as px
 
+from basket_analysis import bundle_candidates
+from config import STREAM_SNAPSHOT_SECONDS
+from dashboard_data import OutputStore
+from storage import events_exist
+from streaming import load_snapshot
+
 st.set_page_config(page_title="E-Commerce Sales Funnel & Insights", layout="wide")
 
 with st.sidebar:
@@ -27,26 +37,72 @@ with st.sidebar:
     st.caption(f"**Outputs folder:** `{_OUTPUTS}`")
     st.caption(f"**Exists:** {_OUTPUTS.exists()}")
 
-# Load outputs (run pipeline first)
-def load_if_exists(path):
-    p = _OUTPUTS / path
-    if p.exists():
-        try:
-            return pd.read_csv(p)
-        except Exception:
-            return None
-    return None
+# Outputs are loaded lazily per section and shared across reruns and sessions (run pipeline first)
+@st.cache_resource
+def get_store():
+    return OutputStore(_OUTPUTS)
+
+
+store = get_store()
+
+
+def _cleaned_signature():
+    """(path, mtime, size) of every cleaned data file: the engine is rebuilt only when these change."""
+    root = _PROJECT_ROOT / "data" / "cleaned"
+    return tuple(sorted((str(p), p.stat().st_mtime_ns, p.stat().st_size) for p in root.rglob("*") if p.is_file()))
+
+
+# Indexed cleaned events for filtered drill-down; built once per cleaned-data version
+@st.cache_resource(max_entries=1)
+def get_engine(signature):
+    from query_engine import EventQueryEngine
+    return EventQueryEngine.from_storage()
+
+
+# Live funnel from a running scripts/streaming.py; only this fragment reruns on each refresh
+@st.fragment(run_every=STREAM_SNAPSHOT_SECONDS)
+def live_funnel():
+    snapshot = load_snapshot()
+    if snapshot is None:
+        st.info("Start the stream to see live counts: `python scripts/streaming.py --follow data/raw/events.csv`")
+        return
+    st.caption(f"As of {snapshot['as_of']} (event time) | {snapshot['events']:,} events, "
+               f"{snapshot['rejected']:,} rejected, {snapshot['open_sessions']:,} open sessions")
+    window = st.radio("Window", list(snapshot["windows"]), horizontal=True)
+    table = pd.DataFrame(snapshot["windows"][window])
+    if len(table) > 0:
+        overall = table[table["segment"] == "all"].drop(columns=["segment", "value", "conversion_pct"])
+        funnel = overall.melt(var_name="stage", value_name="sessions")
+        fig = px.bar(funnel, x="stage", y="sessions", title=f"Sessions Reaching Each Stage (last {window})")
+        fig.update_layout(xaxis_title="", yaxis_title="Sessions")
+        st.plotly_chart(fig, use_container_width=True)
+        st.dataframe(table[table["segment"] != "all"], hide_index=True, use_container_width=True)
+    else:
+        st.info("No events in this window yet.")
+    if snapshot["alerts"]:
+        st.warning(f"{len(snapshot['alerts'])} drop-off alert(s); latest first")
+        st.dataframe(pd.DataFrame(snapshot["alerts"][::-1]), hide_index=True, use_container_width=True)
+
 
 try:
-    funnel = load_if_exists("funnel_conversion_rates.csv")
-    top_products = load_if_exists("top_products.csv")
-    by_category = load_if_exists("revenue_by_category.csv")
-    daily = load_if_exists("daily_revenue.csv")
-    kpis = load_if_exists("kpis.csv")
+    # Inside the try: a missing or unreadable cleaned layer shows the run-the-pipeline message
+    engine = get_engine(_cleaned_signature()) if events_exist() else None
+    filters, start, end = {}, None, None
+    if engine is not None and engine.n_rows:
+        options = engine.options()
+        with st.sidebar:
+            st.caption("**Drill-down filters**")
+            dates = st.date_input("Date range", (options["start"].date(), options["end"].date()),
+                                  min_value=options["start"].date(), max_value=options["end"].date())
+            if isinstance(dates, (tuple, list)) and len(dates) == 2:
+                start, end = pd.Timestamp(dates[0]), pd.Timestamp(dates[1]) + pd.Timedelta(days=1)
+            for col, values in options["segments"].items():
+                filters[col] = st.multiselect(col.replace("_", " ").title(), values)
 
     st.title("E-Commerce Sales Funnel & Product Insights")
     st.markdown("Centralized view of conversion, revenue, and product performance.")
 
+    kpis = store.get("kpis.csv")
     if kpis is not None and len(kpis) > 0:
         row = kpis.iloc[0]
         c1, c2, c3, c4 = st.columns(4)
@@ -56,6 +112,7 @@ try:
         c4.metric("Repeat Purchaser %", f"{row.get('repeat_purchaser_pct', 0):.1f}%")
 
     st.subheader("Sales Funnel: Conversion & Drop-off")
+    funnel = store.get("funnel_conversion_rates.csv")
     if funnel is not None and len(funnel) > 0:
         col1, col2 = st.columns(2)
         with col1:
@@ -80,6 +137,7 @@ try:
         st.info("Run the pipeline (generate data → clean → funnel → eda) to see funnel charts.")
 
     st.subheader("Product & Category Performance")
+    top_products = store.get("top_products.csv")
     if top_products is not None and len(top_products) > 0:
         n = st.slider("Top N products", 5, 30, 15)
         top_n = top_products.head(n)
@@ -87,23 +145,94 @@ try:
         fig.update_layout(yaxis={"categoryorder": "total ascending"}, height=400, title=f"Top {n} Products by Revenue")
         st.plotly_chart(fig, use_container_width=True)
 
+    by_category = store.get("revenue_by_category.csv")
     if by_category is not None and len(by_category) > 0:
         fig = px.pie(by_category, values="revenue", names="category", title="Revenue Share by Category")
         st.plotly_chart(fig, use_container_width=True)
 
     st.subheader("Revenue Over Time")
+    daily = store.get("daily_revenue.csv", parse_dates=["date"])
     if daily is not None and len(daily) > 0:
-        daily["date"] = pd.to_datetime(daily["date"])
         fig = px.line(daily, x="date", y="revenue", title="Daily Revenue")
         fig.update_layout(xaxis_title="Date", yaxis_title="Revenue")
         st.plotly_chart(fig, use_container_width=True)
     else:
         st.info("Run EDA to populate daily revenue.")
 
+    st.subheader("Conversion Trend & Cohort Retention")
+    granularity = st.radio("Granularity", ["Daily", "Weekly"], horizontal=True)
+    series = store.get(f"funnel_{granularity.lower()}.csv", parse_dates=["date"])
+    if series is not None and len(series) > 0:
+        fig = px.line(series, x="date", y="conversion_pct", title=f"{granularity} Visit → Purchase Conversion",
+                      hover_data=["sessions", "visit", "purchase"])
+        fig.update_layout(xaxis_title="Session start", yaxis_title="Conversion %")
+        st.plotly_chart(fig, use_container_width=True)
+    retention = store.get("cohort_retention.csv", parse_dates=["cohort_week"])
+    if retention is not None and len(retention) > 0:
+        matrix = retention.pivot(index="cohort_week", columns="week_offset", values="retention_pct")
+        matrix.index = matrix.index.strftime("%Y-%m-%d")
+        fig = px.imshow(matrix, aspect="auto", color_continuous_scale="Blues", title="Retention % by Signup Week",
+                        labels={"x": "Weeks since signup", "y": "Signup week", "color": "Retention %"})
+        st.plotly_chart(fig, use_container_width=True)
+    if series is None and retention is None:
+        st.info("Run the pipeline (or python scripts/cohorts.py) to see conversion trends and cohorts.")
+
+    st.subheader("Drill-down: Filtered Funnel & Revenue")
+    if engine is not None and engine.n_rows:
+        active = ", ".join(f"{col}: {', '.join(map(str, v))}" for col, v in filters.items() if v) or "all segments"
+        st.caption(f"{start.date() if start is not None else ''} to "
+                   f"{(end - pd.Timedelta(days=1)).date() if end is not None else ''} | {active}")
+        col1, col2 = st.columns(2)
+        with col1:
+            filtered_funnel = engine.funnel(start, end, filters)
+            fig = px.bar(filtered_funnel, x="stage", y="count", title="Filtered Funnel",
+                         text="conversion_from_visit_pct", color="count", color_continuous_scale="Blues")
+            fig.update_layout(showlegend=False, xaxis_title="", yaxis_title="Count")
+            st.plotly_chart(fig, use_container_width=True)
+        with col2:
+            filtered_top = engine.top_products(10, start, end, filters)
+            fig = px.bar(filtered_top, y="product_name", x="revenue", orientation="h", title="Filtered Top 10 Products")
+            fig.update_layout(yaxis={"categoryorder": "total ascending"}, xaxis_title="Revenue", yaxis_title="")
+            st.plotly_chart(fig, use_container_width=True)
+        filtered_daily = engine.daily_revenue(start, end, filters)
+        if len(filtered_daily) > 0:
+            fig = px.line(filtered_daily, x="date", y="revenue", title="Filtered Daily Revenue")
+            fig.update_layout(xaxis_title="Date", yaxis_title="Revenue")
+            st.plotly_chart(fig, use_container_width=True)
+        else:
+            st.info("No purchases match the selected filters.")
+    else:
+        st.info("Run the cleaning step to enable filtered drill-down.")
+
+    st.subheader("Frequently Bought Together")
+    pairs = store.get("product_pairs.csv")
+    category_pairs = store.get("category_pairs.csv")
+    if pairs is not None and len(pairs) > 0:
+        st.caption("Product pairs carted or bought in the same session, by lift (how much more often than chance).")
+        st.dataframe(pairs.head(20)[["product_name_a", "product_name_b", "baskets", "confidence_a_to_b",
+                                     "confidence_b_to_a", "lift"]], use_container_width=True, hide_index=True)
+    if category_pairs is not None and len(category_pairs) > 0:
+        lift = pd.concat([
+            category_pairs[["category_a", "category_b", "lift"]],
+            category_pairs.rename(columns={"category_a": "category_b", "category_b": "category_a"})[["category_a", "category_b", "lift"]],
+        ]).pivot(index="category_a", columns="category_b", values="lift")
+        fig = px.imshow(lift, color_continuous_scale="RdBu", color_continuous_midpoint=1.0, title="Category Pair Lift",
+                        labels={"x": "", "y": "", "color": "Lift"})
+        st.plotly_chart(fig, use_container_width=True)
+    if pairs is None and category_pairs is None:
+        st.info("Run the pipeline (or python scripts/basket_analysis.py) to see co-purchase pairs.")
+
+    st.subheader("Live Funnel (streaming)")
+    live_funnel()
+
     st.subheader("Recommendations")
+    bundles = bundle_candidates(pairs, top_products)
+    if len(bundles) > 0:
+        st.markdown("**Bundle candidates** (best-sellers and the products bought with them more often than chance):")
+        st.dataframe(bundles, use_container_width=True, hide_index=True)
     st.markdown("""
 - **Highest drop-off stage**: Focus UX and marketing on that stage (e.g. checkout simplification, trust signals).
-- **Top products**: Promote best-sellers and bundle underperformers with them.
+- **Top products**: Promote best-sellers and bundle underperformers with them (bundle candidates above, product_pairs.csv).
 - **Regional/device segments**: Use funnel_by_*.csv for targeted campaigns.
 - **Peak periods**: Align inventory and campaigns with revenue heatmap and daily trend.
 """)
@@ -0,0 +1,79 @@
+"""
+Dashboard data access: output files are parsed once and memoized by (mtime, size).
+A file is re-read only after the pipeline rewrites it; least recently used frames are evicted
+when the cache grows past DASHBOARD_CACHE_MB. One store is shared by all dashboard sessions.
+"""
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import pandas as pd
+
+import sys
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from config import DASHBOARD_CACHE_MB, OUTPUTS
+
+
+class OutputStore:
+    """Thread-safe, size-bounded cache of output CSVs. Returned frames are shared: do not mutate."""
+
+    def __init__(self, root: Path = OUTPUTS, max_mb: float = DASHBOARD_CACHE_MB):
+        self.root = Path(root)
+        self.max_bytes = int(max_mb * 2**20)
+        self._entries = OrderedDict()  # name -> (signature, frame, nbytes)
+        self._lock = threading.Lock()
+        self._file_locks = {}
+
+    @property
+    def cached_bytes(self) -> int:
+        with self._lock:
+            return sum(nbytes for _, _, nbytes in self._entries.values())
+
+    def _file_lock(self, name: str) -> threading.Lock:
+        with self._lock:
+            return self._file_locks.setdefault(name, threading.Lock())
+
+    def _cached(self, name: str, signature):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or entry[0] != signature:
+                return None
+            self._entries.move_to_end(name)
+            return entry[1]
+
+    def _store(self, name: str, signature, frame: pd.DataFrame):
+        nbytes = int(frame.memory_usage(deep=True).sum())
+        with self._lock:
+            self._entries.pop(name, None)
+            if nbytes > self.max_bytes:
+                return
+            self._entries[name] = (signature, frame, nbytes)
+            total = sum(n for _, _, n in self._entries.values())
+            while total > self.max_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                total -= evicted
+
+    def get(self, name: str, parse_dates=None):
+        """DataFrame for outputs/<name>, or None if the file is missing or unreadable."""
+        path = self.root / name
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            with self._lock:
+                self._entries.pop(name, None)
+            return None
+        signature = (stat.st_mtime_ns, stat.st_size)
+        frame = self._cached(name, signature)
+        if frame is not None:
+            return frame
+        # One reader per file: concurrent sessions wait for the parse instead of repeating it
+        with self._file_lock(name):
+            frame = self._cached(name, signature)
+            if frame is not None:
+                return frame
+            try:
+                frame = pd.read_csv(path, parse_dates=parse_dates)
+            except Exception:
+                return None
+            self._store(name, signature, frame)
+            return frame
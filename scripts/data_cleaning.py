@@ -2,61 +2,109 @@
 Step 1: Data Cleaning
 - Handle missing values, duplicates, incorrect timestamps
 - Standardize event types, product categories, regions
+- Streaming mode (--stream) cleans raw events larger than RAM in bounded-size chunks
 """
+import argparse
+
 import pandas as pd
 import numpy as np
 from pathlib import Path
 
 import sys
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
-from config import DATA_RAW, DATA_CLEANED, EVENT_TYPE_MAP, OUTPUTS
+from config import CLEAN_MEMORY_BUDGET_MB, DATA_RAW, DATA_CLEANED, EVENT_TYPE_MAP, FUNNEL_STAGES, OUTPUTS
+
+from instrument import span, traced
+from sessionize import agreement, needed, report_sessions, run_if_needed, sessionize
+from storage import write_events, write_products
 
 
 def load_raw_data():
     """Load raw CSVs. Adapt column names if using Kaggle dataset."""
-    events = pd.read_csv(DATA_RAW / "events.csv")
-    products = pd.read_csv(DATA_RAW / "products.csv")
+    with span("load_raw_data.csv_parse", file="events.csv") as s:
+        events = pd.read_csv(DATA_RAW / "events.csv")
+        s.rows_out = len(events)
+    with span("load_raw_data.csv_parse", file="products.csv") as s:
+        products = pd.read_csv(DATA_RAW / "products.csv")
+        s.rows_out = len(products)
     return events, products
 
 
-def clean_events(events: pd.DataFrame) -> pd.DataFrame:
-    # Standardize event_type
+def recode(values: pd.Series, clean) -> pd.Categorical:
+    """Categorical of clean(value) for each row, computed once per distinct value.
+
+    `clean` gets an Index of the distinct raw values (missing values included) and returns their cleaned
+    values, NaN where rows should be dropped; rows are mapped back through their factorized codes.
+    Categories are sorted (as astype("category") would give) and never include the NaN marker.
+    """
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    cleaned = pd.Index(clean(pd.Index(uniques, dtype=object)), dtype=object)
+    # Cast only the kept values: astype("str") would turn NaN into "nan" / "None" on pandas 2.x
+    kept = ~cleaned.isna()
+    cleaned_codes = np.full(len(cleaned), -1, dtype=np.int64)
+    cleaned_codes[kept], categories = pd.factorize(cleaned[kept].astype("str"), sort=True)
+    return pd.Categorical.from_codes(cleaned_codes[codes], categories=categories)
+
+
+def _event_type(raw: pd.Index) -> pd.Index:
+    mapped = raw.str.strip().str.lower().map(EVENT_TYPE_MAP)
+    return mapped.where(mapped.isin(FUNNEL_STAGES))
+
+
+def _dimension(raw: pd.Index) -> pd.Index:
+    return raw.fillna("unknown").astype(str).str.strip()
+
+
+@traced
+def clean_events(events: pd.DataFrame, unmapped: dict = None) -> pd.DataFrame:
+    """Cleaned events; event_type and the segment columns come out categorical.
+
+    unmapped: optional dict updated with {raw event_type: rows dropped} for values outside EVENT_TYPE_MAP.
+    """
+    # Standardize event_type (string cleanup runs on the distinct values only)
     if "event_type" in events.columns:
-        events["event_type"] = (
-            events["event_type"]
-            .str.strip()
-            .str.lower()
-            .replace(EVENT_TYPE_MAP)
-        )
-        # Drop unmapped / invalid event types
-        valid = ["visit", "signup", "add_to_cart", "purchase"]
-        events = events[events["event_type"].isin(valid)]
+        with span("clean_events.event_types", rows_in=len(events)) as s:
+            event_type = recode(events["event_type"], _event_type)
+            # Drop unmapped / invalid event types
+            valid = event_type.notna()
+            if unmapped is not None and not valid.all():
+                dropped = events["event_type"][~valid].fillna("(missing)").value_counts()
+                for value, n in dropped.items():
+                    unmapped[value] = unmapped.get(value, 0) + int(n)
+            events = events.assign(event_type=event_type)[valid]
+            s.rows_out = len(events)
 
     # Parse timestamp
     ts_col = "timestamp" if "timestamp" in events.columns else "event_time"
     if ts_col in events.columns:
-        events[ts_col] = pd.to_datetime(events[ts_col], errors="coerce")
-        events = events.dropna(subset=[ts_col])
-        # Remove future or very old dates (sanity check)
-        events = events[
-            (events[ts_col] >= "2020-01-01") & (events[ts_col] <= pd.Timestamp.now() + pd.Timedelta(days=1))
-        ]
+        with span("clean_events.timestamps", rows_in=len(events)) as s:
+            events[ts_col] = pd.to_datetime(events[ts_col], errors="coerce")
+            events = events.dropna(subset=[ts_col])
+            # Remove future or very old dates (sanity check)
+            events = events[
+                (events[ts_col] >= "2020-01-01") & (events[ts_col] <= pd.Timestamp.now() + pd.Timedelta(days=1))
+            ]
+            s.rows_out = len(events)
 
     # Drop full duplicates
-    events = events.drop_duplicates()
+    with span("clean_events.dedup", rows_in=len(events)) as s:
+        events = events.drop_duplicates()
+        s.rows_out = len(events)
 
     # Fill optional columns with defaults
-    for col in ["region", "device", "campaign_source"]:
-        if col in events.columns:
-            events[col] = events[col].fillna("unknown").astype(str).str.strip()
-        else:
-            events[col] = "unknown"
-
-    if "quantity" in events.columns:
-        events["quantity"] = pd.to_numeric(events["quantity"], errors="coerce").fillna(1).astype(int)
+    with span("clean_events.defaults", rows_in=len(events)):
+        for col in ["region", "device", "campaign_source"]:
+            if col in events.columns:
+                events[col] = recode(events[col], _dimension)
+            else:
+                events[col] = pd.Categorical.from_codes(np.zeros(len(events), dtype=np.int8), ["unknown"])
+
+        if "quantity" in events.columns:
+            events["quantity"] = pd.to_numeric(events["quantity"], errors="coerce").fillna(1).astype(int)
     return events
 
 
+@traced
 def clean_products(products: pd.DataFrame) -> pd.DataFrame:
     # Standardize category
     if "category" in products.columns:
@@ -70,20 +118,100 @@ def clean_products(products: pd.DataFrame) -> pd.DataFrame:
     return products.drop_duplicates(subset=["product_id"] if "product_id" in products.columns else None)
 
 
-def main():
+class RowFingerprints:
+    """Compact set of 64-bit row hashes (8 bytes per distinct row) for cross-chunk de-duplication."""
+
+    def __init__(self):
+        self._seen = np.empty(0, dtype=np.uint64)
+
+    def __len__(self):
+        return len(self._seen)
+
+    def keep_new(self, rows: pd.DataFrame) -> np.ndarray:
+        """Mask of rows not seen in any earlier chunk (first occurrence wins); records them as seen."""
+        fingerprints = pd.util.hash_pandas_object(rows, index=False).to_numpy()
+        keep = np.zeros(len(fingerprints), dtype=bool)
+        keep[np.unique(fingerprints, return_index=True)[1]] = True
+        pos = np.searchsorted(self._seen, fingerprints)
+        seen = pos < len(self._seen)
+        seen[seen] = self._seen[pos[seen]] == fingerprints[seen]
+        keep &= ~seen
+        new = np.sort(fingerprints[keep])
+        self._seen = np.insert(self._seen, np.searchsorted(self._seen, new), new)
+        return keep
+
+
+# clean_events holds a few full-size copies of its input at peak (string ops, filters, dedup)
+_CLEANING_COPIES = 4
+
+
+def chunk_rows_for_budget(path, memory_mb: float, sample_rows: int = 10_000) -> int:
+    """Rows per chunk so that a raw chunk and its cleaning copies fit in memory_mb."""
+    sample = pd.read_csv(path, nrows=sample_rows)
+    bytes_per_row = sample.memory_usage(deep=True).sum() / max(len(sample), 1)
+    return max(1_000, int(memory_mb * 2**20 / (bytes_per_row * _CLEANING_COPIES)))
+
+
+def clean_events_streaming(path=DATA_RAW / "events.csv", memory_mb: float = CLEAN_MEMORY_BUDGET_MB) -> dict:
+    """Clean a raw events file chunk by chunk, appending each cleaned chunk to the cleaned layer."""
+    chunk_rows = chunk_rows_for_budget(path, memory_mb)
+    fingerprints = RowFingerprints()
+    stats = {"raw_rows": 0, "events_rows": 0, "event_types": {}, "unmapped": {}}
+    for i, chunk in enumerate(pd.read_csv(path, chunksize=chunk_rows)):
+        stats["raw_rows"] += len(chunk)
+        cleaned = clean_events(chunk, stats["unmapped"])
+        with span("clean_events_streaming.dedup_write", rows_in=len(cleaned)) as s:
+            cleaned = cleaned[fingerprints.keep_new(cleaned)]
+            write_events(cleaned, append=i > 0)
+            s.rows_out = len(cleaned)
+        stats["events_rows"] += len(cleaned)
+        for event_type, n in cleaned["event_type"].value_counts().items():
+            stats["event_types"][event_type] = stats["event_types"].get(event_type, 0) + int(n)
+        print(f"  chunk {i}: {len(chunk)} -> {len(cleaned)} rows")
+    stats["chunk_rows"] = chunk_rows
+    return stats
+
+
+def report_unmapped(unmapped: dict):
+    """Print the raw event types dropped because EVENT_TYPE_MAP has no entry for them."""
+    if unmapped:
+        dropped = ", ".join(f"{value!r}: {n}" for value, n in sorted(unmapped.items(), key=lambda kv: -kv[1]))
+        print(f"Dropped unmapped event types ({sum(unmapped.values())} rows): {dropped}")
+
+
+def main(stream: bool = False, memory_mb: float = CLEAN_MEMORY_BUDGET_MB):
+    if stream:
+        return main_streaming(memory_mb)
+
     print("Loading raw data...")
     events, products = load_raw_data()
+    run(events, products)
+
 
+def run(events: pd.DataFrame, products: pd.DataFrame):
+    """Clean raw frames, save the cleaned layer and summary; returns (events_clean, products_clean)."""
     print("Cleaning events...")
-    events_clean = clean_events(events)
+    unmapped = {}
+    events_clean = clean_events(events, unmapped)
+    if needed(events_clean):
+        print("Deriving sessions by inactivity gap...")
+        derived = sessionize(events_clean)
+        stats = {"events_rows": len(derived), "derived_sessions": derived["session_id"].nunique()}
+        if "session_id" in events_clean.columns:
+            match = agreement(events_clean["session_id"], derived["session_id"])
+            stats.update(upstream_sessions=match["upstream_sessions"], exact_matches=match["exact_matches"])
+        report_sessions(stats)
+        events_clean = derived
     print("Cleaning products...")
     products_clean = clean_products(products)
 
-    events_clean.to_csv(DATA_CLEANED / "events_cleaned.csv", index=False)
-    products_clean.to_csv(DATA_CLEANED / "products_cleaned.csv", index=False)
+    with span("data_cleaning.write", rows_in=len(events_clean)):
+        write_events(events_clean)
+        write_products(products_clean)
 
     print(f"Events: {len(events)} -> {len(events_clean)}")
     print(f"Products: {len(products)} -> {len(products_clean)}")
+    report_unmapped(unmapped)
     print(f"Cleaned data saved to {DATA_CLEANED}")
 
     # Summary report
@@ -91,10 +219,42 @@ def main():
         "events_rows": len(events_clean),
         "products_rows": len(products_clean),
         "event_types": events_clean["event_type"].value_counts().to_dict(),
+        "unmapped_event_types": unmapped,
+    }
+    pd.DataFrame([report]).to_csv(OUTPUTS / "cleaning_summary.csv", index=False)
+    print("Cleaning summary saved to outputs/cleaning_summary.csv")
+    return events_clean, products_clean
+
+
+def main_streaming(memory_mb: float):
+    print(f"Cleaning events in chunks (memory budget {memory_mb:g} MB)...")
+    stats = clean_events_streaming(DATA_RAW / "events.csv", memory_mb)
+    products = pd.read_csv(DATA_RAW / "products.csv")
+    products_clean = clean_products(products)
+    write_products(products_clean)
+    sessions = run_if_needed()
+    if sessions is not None:
+        stats["events_rows"] = sessions["events_rows"]
+
+    print(f"Events: {stats['raw_rows']} -> {stats['events_rows']} ({stats['chunk_rows']} rows per chunk)")
+    print(f"Products: {len(products)} -> {len(products_clean)}")
+    report_unmapped(stats["unmapped"])
+    print(f"Cleaned data saved to {DATA_CLEANED}")
+
+    report = {
+        "events_rows": stats["events_rows"],
+        "products_rows": len(products_clean),
+        "event_types": stats["event_types"],
+        "unmapped_event_types": stats["unmapped"],
     }
     pd.DataFrame([report]).to_csv(OUTPUTS / "cleaning_summary.csv", index=False)
     print("Cleaning summary saved to outputs/cleaning_summary.csv")
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Clean raw events and products.")
+    parser.add_argument("--stream", action="store_true", help="clean events.csv in bounded-size chunks")
+    parser.add_argument("--memory-mb", type=float, default=CLEAN_MEMORY_BUDGET_MB,
+                        help="memory budget per chunk in streaming mode")
+    args = parser.parse_args()
+    main(stream=args.stream, memory_mb=args.memory_mb)
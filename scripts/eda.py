@@ -1,7 +1,7 @@
 """
 Step 3: Exploratory Data Analysis
 - Top products and categories, revenue trends, seasonality
-- Average order value, total revenue, repeat purchases
+- Average order value, total revenue, repeat purchases and repeat-purchase cohorts
 """
 import pandas as pd
 import numpy as np
@@ -9,7 +9,13 @@ from pathlib import Path
 
 import sys
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
-from config import DATA_CLEANED, OUTPUTS
+from config import CHART_DPI, OUTPUTS, REPEAT_WINDOWS_DAYS
+
+from charts import chart_path, downsample, render_charts
+from instrument import traced
+from schema import decode_ids, read_compact_events, read_compact_products
+from product_index import ProductIndex
+from user_index import NO_TIME, NS_PER_DAY, UserSessionIndex
 
 import matplotlib
 matplotlib.use("Agg")
@@ -20,36 +26,46 @@ sns.set_theme(style="whitegrid", palette="muted")
 OUTPUTS.mkdir(parents=True, exist_ok=True)
 
 
-def load_data():
-    events = pd.read_csv(DATA_CLEANED / "events_cleaned.csv")
-    products = pd.read_csv(DATA_CLEANED / "products_cleaned.csv")
-    events["timestamp"] = pd.to_datetime(events["timestamp"])
+EDA_COLUMNS = ["session_id", "user_id", "event_type", "product_id", "quantity", "timestamp"]
+TOP_N_CHART = 15
+
+
+@traced
+def load_data(start=None, end=None):
+    """Purchase events (all EDA metrics are purchase-based) and the product catalog, in the compact schema."""
+    events = read_compact_events(columns=EDA_COLUMNS, start=start, end=end, event_types=["purchase"])
+    products = read_compact_products(columns=["product_id", "product_name", "category", "price"])
     return events, products
 
 
-def merge_purchases_with_products(events: pd.DataFrame, products: pd.DataFrame) -> pd.DataFrame:
-    purchases = events[events["event_type"] == "purchase"].copy()
-    purchases = purchases.merge(products[["product_id", "product_name", "category", "price"]], on="product_id", how="left")
-    purchases["revenue"] = purchases["quantity"] * purchases["price"]
+def product_index(products) -> ProductIndex:
+    """ProductIndex for a product table (an existing index is returned as is)."""
+    return products if isinstance(products, ProductIndex) else ProductIndex(products)
+
+
+@traced
+def merge_purchases_with_products(events: pd.DataFrame, products) -> pd.DataFrame:
+    """Purchase rows with product_name, category, price and revenue gathered from the product index."""
+    products = product_index(products)
+    purchases = events[events["event_type"] == "purchase"].reset_index(drop=True)
+    positions = products.positions(purchases["product_id"])
+    purchases = purchases.assign(**products.attributes(positions))
+    purchases["revenue"] = products.revenue(positions, purchases["quantity"].to_numpy())
     return purchases
 
 
-def top_products_and_categories(purchases: pd.DataFrame):
-    by_product = (
-        purchases.groupby(["product_id", "product_name", "category"])
-        .agg(units_sold=("quantity", "sum"), revenue=("revenue", "sum"))
-        .reset_index()
-        .sort_values("revenue", ascending=False)
-    )
-    by_category = (
-        purchases.groupby("category")
-        .agg(units_sold=("quantity", "sum"), revenue=("revenue", "sum"), orders=("session_id", "nunique"))
-        .reset_index()
-        .sort_values("revenue", ascending=False)
-    )
+@traced
+def top_products_and_categories(purchases: pd.DataFrame, products):
+    """Per-product and per-category units and revenue (bincounts over product positions)."""
+    products = product_index(products)
+    positions = products.positions(purchases["product_id"])
+    quantity = purchases["quantity"].to_numpy()
+    by_product = products.top_products(positions, quantity)
+    by_category = products.by_category(positions, quantity, pd.factorize(purchases["session_id"])[0])
     return by_product, by_category
 
 
+@traced
 def revenue_trends(purchases: pd.DataFrame) -> pd.DataFrame:
     purchases["date"] = purchases["timestamp"].dt.date
     daily = purchases.groupby("date").agg(
@@ -61,62 +77,131 @@ def revenue_trends(purchases: pd.DataFrame) -> pd.DataFrame:
     return daily
 
 
-def aov_and_repeat(events: pd.DataFrame, purchases: pd.DataFrame) -> dict:
+def purchase_index(events: pd.DataFrame, index: UserSessionIndex = None):
+    """User -> sessions index (built from purchase events unless shared) and its order-session mask."""
+    purchase_events = events[events["event_type"] == "purchase"]
+    if index is None:
+        index = UserSessionIndex.from_events(purchase_events)
+    return index, index.session_mask(purchase_events["session_id"].dropna())
+
+
+def first_purchase_times(events: pd.DataFrame, index: UserSessionIndex) -> np.ndarray:
+    """Time of the first purchase per indexed session, int64 ns (NO_TIME = none).
+
+    Order times come from the purchase rows, not index.session_start, so they do not depend on whether
+    the index was built from all events (shared) or from purchases only.
+    """
+    purchase_events = events[events["event_type"] == "purchase"]
+    codes = index.positions(purchase_events["session_id"])
+    ts = purchase_events["timestamp"].to_numpy().astype("datetime64[ns]")
+    timed = (codes >= 0) & ~np.isnat(ts)
+    first = np.full(index.n_sessions, NO_TIME, dtype=np.int64)
+    np.minimum.at(first, codes[timed], ts[timed].view("int64"))
+    return first
+
+
+@traced
+def aov_and_repeat(events: pd.DataFrame, purchases: pd.DataFrame, index: UserSessionIndex = None) -> dict:
     orders_per_session = purchases.groupby("session_id")["revenue"].sum()
     aov = float(orders_per_session.mean())
     total_revenue = float(orders_per_session.sum())
-    repeat = events[events["event_type"] == "purchase"].groupby("user_id")["session_id"].nunique()
-    repeat_pct = (repeat > 1).mean() * 100 if len(repeat) else 0
+    index, ordered = purchase_index(events, index)
+    orders_per_user = index.per_user(ordered.astype(np.int64))
+    buyers = orders_per_user > 0
+    repeat_pct = (orders_per_user[buyers] > 1).mean() * 100 if buyers.any() else 0
     return {"aov": aov, "total_revenue": total_revenue, "repeat_purchaser_pct": repeat_pct, "total_orders": len(orders_per_session)}
 
 
-def plot_funnel_chart():
-    """Bar chart of funnel conversion (uses funnel output if present)."""
-    fp = OUTPUTS / "funnel_conversion_rates.csv"
-    if not fp.exists():
-        return
-    df = pd.read_csv(fp)
+@traced
+def repeat_purchase_cohorts(events: pd.DataFrame, index: UserSessionIndex = None,
+                            windows=REPEAT_WINDOWS_DAYS) -> pd.DataFrame:
+    """Buyers by month of first order: orders per buyer and % ordering again (ever / within N days).
+
+    An order's time is its first purchase event, so a buyer's cohort is the month of their first purchase.
+    """
+    index, ordered = purchase_index(events, index)
+    order_time = first_purchase_times(events, index)
+    orders = index.sessions[ordered[index.sessions]]  # order sessions, grouped by user
+    orders = orders[np.lexsort((order_time[orders], index.session_user[orders]))]  # in purchase time order
+    users = index.session_user[orders]
+    first = np.flatnonzero(np.r_[True, users[1:] != users[:-1]]) if len(orders) else np.empty(0, dtype=np.int64)
+    n_orders = np.diff(np.r_[first, len(orders)])
+    first_time = order_time[orders[first]]
+    second_time = order_time[orders[np.minimum(first + 1, len(orders) - 1)]]
+    gap_days = np.where(n_orders > 1, (second_time - first_time) / NS_PER_DAY, np.inf)
+
+    buyers = pd.DataFrame({
+        "cohort": first_time.astype("datetime64[ns]").astype("datetime64[M]").astype(str),
+        "orders": n_orders,
+        "repeat": n_orders > 1,
+        **{f"repeat_within_{d}d": gap_days <= d for d in windows},
+    })
+    cohorts = buyers.groupby("cohort").agg(
+        buyers=("orders", "size"), orders_per_buyer=("orders", "mean"), repeat_buyer_pct=("repeat", "mean"),
+        **{f"repeat_within_{d}d_pct": (f"repeat_within_{d}d", "mean") for d in windows},
+    ).reset_index()
+    pct = [c for c in cohorts.columns if c.endswith("_pct")]
+    cohorts[pct] *= 100
+    return cohorts.round(2)
+
+
+def kpi_tables(events: pd.DataFrame, purchases: pd.DataFrame, index: UserSessionIndex = None) -> tuple:
+    """(KPIs, repeat-purchase cohorts) for every caller: serial (index shared over all events), workers
+    and main (purchase rows only) give the same tables."""
+    index = purchase_index(events, index)[0]
+    return aov_and_repeat(events, purchases, index), repeat_purchase_cohorts(events, index)
+
+
+def _save(path: Path):
+    plt.tight_layout()
+    plt.savefig(path, dpi=CHART_DPI, bbox_inches="tight")
+    plt.close()
+
+
+def plot_funnel_chart(df: pd.DataFrame = None, path: Path = None):
+    """Bar chart of funnel conversion (df defaults to the funnel output, if present)."""
+    if df is None:
+        fp = OUTPUTS / "funnel_conversion_rates.csv"
+        if not fp.exists():
+            return
+        df = pd.read_csv(fp)
     fig, ax = plt.subplots(figsize=(8, 5))
-    x = range(len(df))
-    ax.bar(x, df["count"], color=sns.color_palette("Blues_d", len(df))[::-1], edgecolor="white")
+    x = np.arange(len(df))
+    counts = df["count"].to_numpy()
+    ax.bar(x, counts, color=sns.color_palette("Blues_d", len(df))[::-1], edgecolor="white")
     ax.set_xticks(x)
     ax.set_xticklabels(df["stage"].str.replace("_", " ").str.title())
     ax.set_ylabel("Count")
     ax.set_title("Sales Funnel: Users at Each Stage")
-    for i, (_, row) in enumerate(df.iterrows()):
-        ax.annotate(f"{row['conversion_from_visit_pct']:.1f}%", (i, row["count"]), ha="center", va="bottom", fontsize=9)
-    plt.tight_layout()
-    plt.savefig(OUTPUTS / "funnel_chart.png", dpi=150, bbox_inches="tight")
-    plt.close()
+    for i, count, pct in zip(x, counts, df["conversion_from_visit_pct"].to_numpy()):
+        ax.annotate(f"{pct:.1f}%", (i, count), ha="center", va="bottom", fontsize=9)
+    _save(path or chart_path("funnel_chart"))
 
 
-def plot_top_products(by_product: pd.DataFrame, top_n: int = 15):
+def plot_top_products(by_product: pd.DataFrame, top_n: int = TOP_N_CHART, path: Path = None):
     df = by_product.head(top_n)
     fig, ax = plt.subplots(figsize=(10, 6))
     y_pos = range(len(df))
     ax.barh(y_pos, df["revenue"], color=sns.color_palette("viridis", len(df)))
     ax.set_yticks(y_pos)
-    ax.set_yticklabels(df["product_name"].str[:30], fontsize=9)
+    ax.set_yticklabels(df["product_name"].astype(str).str[:30], fontsize=9)
     ax.invert_yaxis()
     ax.set_xlabel("Revenue")
     ax.set_title(f"Top {top_n} Products by Revenue")
-    plt.tight_layout()
-    plt.savefig(OUTPUTS / "top_products_revenue.png", dpi=150, bbox_inches="tight")
-    plt.close()
+    _save(path or chart_path("top_products_revenue"))
 
 
-def plot_top_categories(by_category: pd.DataFrame):
+def plot_top_categories(by_category: pd.DataFrame, path: Path = None):
     fig, ax = plt.subplots(figsize=(8, 5))
-    sns.barplot(data=by_category, x="revenue", y="category", palette="rocket", ax=ax)
+    sns.barplot(data=by_category, x="revenue", y="category", hue="category", palette="rocket", legend=False, ax=ax)
     ax.set_xlabel("Revenue")
     ax.set_ylabel("Category")
     ax.set_title("Revenue by Category")
-    plt.tight_layout()
-    plt.savefig(OUTPUTS / "revenue_by_category.png", dpi=150, bbox_inches="tight")
-    plt.close()
+    _save(path or chart_path("revenue_by_category"))
 
 
-def plot_revenue_trend(daily: pd.DataFrame):
+def plot_revenue_trend(daily: pd.DataFrame, path: Path = None):
+    daily = downsample(daily, "revenue")
     fig, ax = plt.subplots(figsize=(12, 4))
     ax.plot(daily["date"], daily["revenue"], color="steelblue", linewidth=1.5)
     ax.fill_between(daily["date"], daily["revenue"], alpha=0.3)
@@ -124,49 +209,83 @@ def plot_revenue_trend(daily: pd.DataFrame):
     ax.set_ylabel("Revenue")
     ax.set_title("Daily Revenue Trend")
     plt.xticks(rotation=45)
-    plt.tight_layout()
-    plt.savefig(OUTPUTS / "revenue_trend.png", dpi=150, bbox_inches="tight")
-    plt.close()
+    _save(path or chart_path("revenue_trend"))
+
+
+@traced
+def seasonality_cells(purchases: pd.DataFrame) -> pd.Series:
+    """Revenue per (weekday, Monday = 0; hour) that has purchases (as revenue_seasonality in the SQL file)."""
+    ts = purchases["timestamp"].dt
+    return purchases["revenue"].groupby([ts.dayofweek.rename("weekday"), ts.hour.rename("hour")]).sum()
+
 
+def seasonality_table(purchases: pd.DataFrame) -> pd.DataFrame:
+    """Revenue by weekday (rows, Monday = 0) and hour (columns)."""
+    return seasonality_cells(purchases).unstack(fill_value=0)
 
-def plot_heatmap_seasonality(purchases: pd.DataFrame):
-    purchases["weekday"] = purchases["timestamp"].dt.dayofweek
-    purchases["hour"] = purchases["timestamp"].dt.hour
-    cross = purchases.groupby(["weekday", "hour"])["revenue"].sum().unstack(fill_value=0)
+
+def plot_heatmap_seasonality(cross: pd.DataFrame, path: Path = None):
+    """Weekday x hour revenue heatmap (cross: seasonality_table)."""
     fig, ax = plt.subplots(figsize=(12, 4))
     sns.heatmap(cross, cmap="YlOrRd", ax=ax, cbar_kws={"label": "Revenue"})
-    ax.set_xticklabels([f"{h}h" for h in range(24)])
-    ax.set_yticklabels(["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"])
+    ax.set_xticklabels([f"{h}h" for h in cross.columns])
+    ax.set_yticklabels(["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"][i] for i in cross.index)
     ax.set_title("Revenue by Weekday & Hour (Heatmap)")
-    plt.tight_layout()
-    plt.savefig(OUTPUTS / "revenue_heatmap.png", dpi=150, bbox_inches="tight")
-    plt.close()
+    _save(path or chart_path("revenue_heatmap"))
+
+
+def chart_jobs(funnel: pd.DataFrame = None, by_product: pd.DataFrame = None, by_category: pd.DataFrame = None,
+               daily: pd.DataFrame = None, seasonality: pd.DataFrame = None) -> dict:
+    """charts.render_charts jobs for the EDA charts whose data is given (only the plotted rows are hashed)."""
+    jobs = {
+        "funnel_chart": (plot_funnel_chart, funnel),
+        "top_products_revenue": (plot_top_products, None if by_product is None else by_product.head(TOP_N_CHART)),
+        "revenue_by_category": (plot_top_categories, by_category),
+        "revenue_trend": (plot_revenue_trend, None if daily is None else downsample(daily, "revenue")),
+        "revenue_heatmap": (plot_heatmap_seasonality, seasonality),
+    }
+    return {name: job for name, job in jobs.items() if job[1] is not None}
+
+
+def render_funnel_chart():
+    """Render the funnel chart from funnel_conversion_rates.csv (skipped if unchanged)."""
+    fp = OUTPUTS / "funnel_conversion_rates.csv"
+    if fp.exists():
+        render_charts(chart_jobs(funnel=pd.read_csv(fp)))
 
 
 def main():
     print("Loading data...")
     events, products = load_data()
+    run(events, products)
+
+
+def run(events: pd.DataFrame, products: pd.DataFrame, funnel_chart: bool = True, index: UserSessionIndex = None):
+    """EDA tables, KPIs and charts (funnel_chart=False when funnel outputs are not written yet;
+    index: shared user -> sessions index)."""
+    products = product_index(products)
     purchases = merge_purchases_with_products(events, products)
 
     print("Top products and categories...")
-    by_product, by_category = top_products_and_categories(purchases)
-    by_product.to_csv(OUTPUTS / "top_products.csv", index=False)
+    by_product, by_category = top_products_and_categories(purchases, products)
+    decode_ids(by_product).to_csv(OUTPUTS / "top_products.csv", index=False)
     by_category.to_csv(OUTPUTS / "revenue_by_category.csv", index=False)
 
     print("Revenue trends...")
     daily = revenue_trends(purchases)
     daily.to_csv(OUTPUTS / "daily_revenue.csv", index=False)
 
-    kpis = aov_and_repeat(events, purchases)
+    kpis, cohorts = kpi_tables(events, purchases, index)
     pd.DataFrame([kpis]).to_csv(OUTPUTS / "kpis.csv", index=False)
     print("KPIs:", kpis)
+    cohorts.to_csv(OUTPUTS / "repeat_purchase_cohorts.csv", index=False)
 
     print("Generating plots...")
-    plot_funnel_chart()
-    plot_top_products(by_product)
-    plot_top_categories(by_category)
-    plot_revenue_trend(daily)
-    plot_heatmap_seasonality(purchases)
+    funnel = OUTPUTS / "funnel_conversion_rates.csv"
+    render_charts(chart_jobs(
+        funnel=pd.read_csv(funnel) if funnel_chart and funnel.exists() else None,
+        by_product=by_product, by_category=by_category, daily=daily, seasonality=seasonality_table(purchases),
+    ))
 
     print(f"EDA outputs and charts saved to {OUTPUTS}")
 
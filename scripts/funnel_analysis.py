@@ -2,6 +2,8 @@
 Step 2: Funnel Analysis
 - Count users/sessions at each stage: Visit -> Signup -> Add to Cart -> Purchase
 - Conversion and drop-off rates; optional segmentation (device, region, campaign)
+- Strict funnel: stages in time order within per-stage conversion windows, with time-to-convert
+- User funnel: stages reached across a user's sessions within USER_FUNNEL_DAYS of the first visit
 """
 import pandas as pd
 import numpy as np
@@ -9,75 +11,264 @@ from pathlib import Path
 
 import sys
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
-from config import DATA_CLEANED, FUNNEL_STAGES, OUTPUTS
+from config import FUNNEL_STAGES, FUNNEL_WINDOW_MINUTES, OUTPUTS, SEGMENT_COLUMNS, SEGMENT_CROSSES, USER_FUNNEL_DAYS
 
+from instrument import span, traced
+from schema import read_compact_events
+from user_index import NO_TIME, NS_PER_DAY, UserSessionIndex
 
-def load_cleaned_data():
-    events = pd.read_csv(DATA_CLEANED / "events_cleaned.csv")
-    events["timestamp"] = pd.to_datetime(events["timestamp"])
-    return events
+FUNNEL_COLUMNS = ["session_id", "user_id", "event_type", "timestamp"] + SEGMENT_COLUMNS
 
 
+@traced
+def load_cleaned_data(columns=FUNNEL_COLUMNS, start=None, end=None):
+    """Cleaned events in the compact schema (only the columns the funnel needs), optionally limited to
+    start <= timestamp < end."""
+    return read_compact_events(columns=columns, start=start, end=end)
+
+
+def reach_from_codes(session_codes: np.ndarray, n_sessions: int, event_type: pd.Series) -> np.ndarray:
+    """Session x stage boolean matrix from factorized session codes (-1 = missing session)."""
+    stage_codes = pd.Categorical(event_type, categories=FUNNEL_STAGES).codes
+    reach = np.zeros((n_sessions, len(FUNNEL_STAGES)), dtype=bool)
+    known = (stage_codes >= 0) & (session_codes >= 0)
+    reach[session_codes[known], stage_codes[known]] = True
+    return reach
+
+
+def session_reach_matrix(events: pd.DataFrame):
+    """Session ids and a session x stage boolean reach matrix, built in one pass.
+
+    event_type is encoded as a categorical code over FUNNEL_STAGES and session_id is
+    factorized (sorted, like groupby), so each event sets a single cell of the matrix.
+    """
+    session_codes, session_ids = pd.factorize(events["session_id"], sort=True)
+    return session_ids, reach_from_codes(session_codes, len(session_ids), events["event_type"])
+
+
+def session_segments(events: pd.DataFrame, session_codes: np.ndarray, n_sessions: int, segment_cols) -> pd.DataFrame:
+    """First non-null value of each segment column per session (same as groupby(...).first())."""
+    segments = {}
+    for col in segment_cols:
+        present = np.flatnonzero(events[col].notna().to_numpy() & (session_codes >= 0))
+        codes, first = np.unique(session_codes[present], return_index=True)
+        values = events[col].iloc[present[first]]
+        segments[col] = pd.Series(values.to_numpy(), index=codes, dtype=values.dtype).reindex(np.arange(n_sessions))
+    return pd.DataFrame(segments)
+
+
+@traced
 def funnel_by_session(events: pd.DataFrame) -> pd.DataFrame:
     """One row per session: whether it reached each stage (1/0)."""
-    sessions = events.groupby("session_id").agg(
-        visit=("event_type", lambda x: (x == "visit").any().astype(int)),
-        signup=("event_type", lambda x: (x == "signup").any().astype(int)),
-        add_to_cart=("event_type", lambda x: (x == "add_to_cart").any().astype(int)),
-        purchase=("event_type", lambda x: (x == "purchase").any().astype(int)),
-    ).reset_index()
+    session_ids, reach = session_reach_matrix(events)
+    sessions = pd.DataFrame(reach.astype(int), columns=FUNNEL_STAGES)
+    sessions.insert(0, "session_id", session_ids)
     return sessions
 
 
+def ordered_reach(reach: np.ndarray) -> np.ndarray:
+    """Cumulative AND across stages: a stage counts only if every previous stage was reached."""
+    return np.logical_and.accumulate(reach.astype(bool), axis=1)
+
+
+@traced
 def funnel_counts(sessions: pd.DataFrame) -> pd.DataFrame:
     """Cumulative counts: each stage counts only if previous stages done (ordered funnel)."""
-    counts = []
-    for i, stage in enumerate(FUNNEL_STAGES):
-        if i == 0:
-            n = sessions[stage].sum()
-        else:
-            prev_stages = FUNNEL_STAGES[: i + 1]
-            n = sessions[sessions[prev_stages].min(axis=1) == 1][stage].sum()
-        counts.append({"stage": stage, "count": int(n)})
-    return pd.DataFrame(counts)
+    counts = ordered_reach(sessions[FUNNEL_STAGES].to_numpy()).sum(axis=0)
+    return pd.DataFrame({"stage": FUNNEL_STAGES, "count": counts.astype(int)})
+
+
+def _rate_columns(counts: np.ndarray) -> dict:
+    """Conversion/drop-off columns for a (groups x stages) matrix of ordered stage counts."""
+    counts = counts.astype(float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        from_visit = np.where(counts[:, [0]] > 0, counts / counts[:, [0]] * 100, 0)
+        prev = counts[:, :-1]
+        from_prev = np.hstack([
+            np.full((len(counts), 1), 100.0),
+            np.where(prev > 0, counts[:, 1:] / prev * 100, 0),
+        ])
+    drop_off = 100 - from_prev
+    drop_off[:, 0] = 0
+    return {
+        "conversion_from_visit_pct": from_visit.round(2),
+        "conversion_from_previous_stage_pct": from_prev.round(2),
+        "drop_off_from_previous_pct": drop_off.round(2),
+    }
 
 
 def conversion_rates(counts_df: pd.DataFrame) -> pd.DataFrame:
     """Conversion rate from first stage (visit) and stage-to-stage."""
-    counts = counts_df["count"].values
-    result = []
-    for i, stage in enumerate(FUNNEL_STAGES):
-        from_visit = counts[i] / counts[0] * 100 if counts[0] else 0
-        from_prev = counts[i] / counts[i - 1] * 100 if i > 0 and counts[i - 1] else (100 if i == 0 else 0)
-        result.append({
+    counts = counts_df["count"].to_numpy()
+    rates = _rate_columns(counts[np.newaxis, :])
+    return pd.DataFrame({
+        "stage": FUNNEL_STAGES,
+        "count": counts,
+        **{name: values[0] for name, values in rates.items()},
+    })
+
+
+@traced
+def funnel_cells(events: pd.DataFrame, segment_cols) -> pd.DataFrame:
+    """Ordered stage counts per finest segment cell, from a single session reach matrix.
+
+    Every segment breakdown (single columns or crosses) is a roll-up of these cells, so the
+    reach matrix and the session -> segment lookup are computed once for all of them.
+    """
+    session_codes, session_ids = pd.factorize(events["session_id"], sort=True)
+    reach = ordered_reach(reach_from_codes(session_codes, len(session_ids), events["event_type"]))
+    sessions = session_segments(events, session_codes, len(session_ids), segment_cols)
+    sessions[FUNNEL_STAGES] = reach.astype(int)
+    with span("funnel_cells.groupby", rows_in=len(sessions)) as s:
+        cells = sessions.groupby(list(segment_cols), dropna=False, observed=True)[FUNNEL_STAGES].sum().reset_index()
+        s.rows_out = len(cells)
+    return cells
+
+
+def funnel_rollup(cells: pd.DataFrame, cols) -> pd.DataFrame:
+    """Funnel counts and conversion per value of `cols`, summed from funnel cells (long format)."""
+    cols = list(cols)
+    grouped = cells.groupby(cols, observed=True)[FUNNEL_STAGES].sum()
+    counts = grouped.to_numpy()
+    n_stages = len(FUNNEL_STAGES)
+    result = pd.DataFrame({
+        "stage": np.tile(FUNNEL_STAGES, len(grouped)),
+        "count": counts.ravel(),
+        **{name: values.ravel() for name, values in _rate_columns(counts).items()},
+    })
+    keys = grouped.index.to_frame(index=False)
+    for col in cols:
+        result[col] = np.repeat(keys[col].to_numpy(), n_stages)
+    return result
+
+
+@traced
+def funnel_cube(events: pd.DataFrame, segment_cols=SEGMENT_COLUMNS, crosses=SEGMENT_CROSSES) -> dict:
+    """Funnel tables for every segment column and cross, keyed by the tuple of grouping columns."""
+    segment_cols = [c for c in segment_cols if c in events.columns]
+    return cube_from_cells(funnel_cells(events, segment_cols), segment_cols, crosses)
+
+
+def cube_from_cells(cells: pd.DataFrame, segment_cols=SEGMENT_COLUMNS, crosses=SEGMENT_CROSSES) -> dict:
+    """Roll funnel cells up to every segment column and every cross of those columns."""
+    groupings = [(c,) for c in segment_cols] + [tuple(x) for x in crosses if set(x) <= set(segment_cols)]
+    return {grouping: funnel_rollup(cells, grouping) for grouping in groupings}
+
+
+def combine_cube(cube: dict, segment_cols=SEGMENT_COLUMNS) -> pd.DataFrame:
+    """Stack cube tables into one frame; columns outside a grouping are marked "(all)"."""
+    frames = []
+    for grouping, table in cube.items():
+        table = table.copy()
+        table.insert(0, "grouping", "+".join(grouping))
+        for col in segment_cols:
+            if col not in grouping:
+                table[col] = "(all)"
+        frames.append(table)
+    combined = pd.concat(frames, ignore_index=True)
+    front = ["grouping"] + [c for c in segment_cols if c in combined.columns]
+    return combined[front + [c for c in combined.columns if c not in front]]
+
+
+@traced
+def strict_funnel(events: pd.DataFrame, windows: dict = FUNNEL_WINDOW_MINUTES):
+    """Time-ordered funnel: a stage counts only after the previous stage, within its window.
+
+    Events are sorted by (session, timestamp, stage) so each session is a contiguous slice. Per
+    stage, a forward max-scan carries the latest qualifying previous-stage row through the slices;
+    an event qualifies if that row is in its own session and no more than windows[stage] minutes
+    earlier. Returns (counts_df, {stage: seconds from the previous stage to the first qualifying event}).
+    """
+    session_codes, session_ids = pd.factorize(events["session_id"])
+    stage_codes = pd.Categorical(events["event_type"], categories=FUNNEL_STAGES).codes
+    ts = events["timestamp"].to_numpy().astype("datetime64[s]")
+    keep = np.flatnonzero((session_codes >= 0) & (stage_codes >= 0) & ~np.isnat(ts))
+    session, stage, ts = session_codes[keep], stage_codes[keep], ts[keep].view("int64")
+    # One int64 sort key when it fits; the stable sort is near-linear on logs already grouped by session
+    offset = ts - ts.min() if len(ts) else ts
+    key_span = (int(offset.max()) + 1) * len(FUNNEL_STAGES) if len(ts) else 1
+    with span("strict_funnel.sort", rows_in=len(session)):
+        if len(session_ids) * key_span < 2**62:
+            order = np.argsort(session.astype(np.int64) * key_span + offset * len(FUNNEL_STAGES) + stage, kind="stable")
+        else:
+            order = np.lexsort((stage, ts, session))
+        session, stage, ts = session[order], stage[order], ts[order]
+
+    n = len(session)
+    rows = np.arange(n)
+    starts = np.flatnonzero(np.r_[True, session[1:] != session[:-1]]) if n else np.empty(0, dtype=np.int64)
+    slice_start = np.repeat(starts, np.diff(np.r_[starts, n]))
+
+    reach = np.zeros((len(session_ids), len(FUNNEL_STAGES)), dtype=bool)
+    qualified = stage == 0
+    reach[session[qualified], 0] = True
+    times = {}
+    for k, name in enumerate(FUNNEL_STAGES[1:], start=1):
+        latest = np.maximum.accumulate(np.where(qualified, rows, -1)) if n else rows
+        qualified = (stage == k) & (latest >= slice_start)
+        gap = np.where(qualified, ts - ts[np.maximum(latest, 0)], 0)
+        if windows.get(name) is not None:
+            qualified &= gap <= windows[name] * 60
+        hits = np.flatnonzero(qualified)
+        first = hits[np.r_[True, session[hits][1:] != session[hits][:-1]]] if len(hits) else hits
+        reach[session[first], k] = True
+        times[name] = gap[first]
+    counts = reach.sum(axis=0)
+    return pd.DataFrame({"stage": FUNNEL_STAGES, "count": counts}), times
+
+
+def time_to_convert(times: dict) -> pd.DataFrame:
+    """Per stage: sessions converting and the distribution (minutes) of time since the previous stage."""
+    quantiles = [50, 75, 90, 99]
+    rows = []
+    for stage, seconds in times.items():
+        minutes = np.asarray(seconds, dtype=float) / 60
+        stats = np.percentile(minutes, quantiles) if len(minutes) else [np.nan] * len(quantiles)
+        rows.append({
             "stage": stage,
-            "count": counts[i],
-            "conversion_from_visit_pct": round(from_visit, 2),
-            "conversion_from_previous_stage_pct": round(from_prev, 2),
-            "drop_off_from_previous_pct": round(100 - from_prev, 2) if i > 0 else 0,
+            "sessions": len(minutes),
+            "mean_minutes": minutes.mean() if len(minutes) else np.nan,
+            **{f"p{q}_minutes": v for q, v in zip(quantiles, stats)},
+            "max_minutes": minutes.max() if len(minutes) else np.nan,
         })
-    return pd.DataFrame(result)
+    return pd.DataFrame(rows).round(2)
+
+
+@traced
+def user_funnel(events: pd.DataFrame, days: int = USER_FUNNEL_DAYS, index: UserSessionIndex = None) -> pd.DataFrame:
+    """Ordered funnel over users: a user reaches a stage if any of their sessions starting within
+    `days` of their first visit session reached it (stages may come from different sessions)."""
+    index = index if index is not None else UserSessionIndex.from_events(events)
+    session_ids, reach = session_reach_matrix(events)
+    codes = index.positions(session_ids)
+    session_reach = np.zeros((index.n_sessions, len(FUNNEL_STAGES)), dtype=bool)
+    session_reach[codes[codes >= 0]] = reach[codes >= 0]
 
+    start = index.session_start
+    first_visit = index.broadcast(index.per_user(np.where(session_reach[:, 0], start, NO_TIME), np.minimum))
+    csr_start = start[index.sessions]
+    in_window = np.zeros(index.n_sessions, dtype=bool)
+    in_window[index.sessions] = ((first_visit != NO_TIME) & (csr_start >= first_visit)
+                                 & (csr_start <= first_visit + days * NS_PER_DAY))
+    user_reach = index.per_user(session_reach & in_window[:, np.newaxis], np.logical_or)
+    counts = ordered_reach(user_reach).sum(axis=0)
+    return conversion_rates(pd.DataFrame({"stage": FUNNEL_STAGES, "count": counts}))
 
+
+@traced
 def funnel_by_segment(events: pd.DataFrame, segment_col: str) -> pd.DataFrame:
     """Funnel counts and conversion by segment (e.g. device, region)."""
-    sessions = funnel_by_session(events)
-    segment = events.groupby("session_id")[segment_col].first()
-    sessions = sessions.merge(segment, left_on="session_id", right_index=True)
-
-    rows = []
-    for seg_val, grp in sessions.groupby(segment_col):
-        counts_df = funnel_counts(grp)
-        conv = conversion_rates(counts_df)
-        conv[segment_col] = seg_val
-        rows.append(conv)
-    return pd.concat(rows, ignore_index=True)
+    return funnel_rollup(funnel_cells(events, [segment_col]), [segment_col])
 
 
 def main():
     print("Loading cleaned events...")
     events = load_cleaned_data()
+    run(events)
+
 
+def run(events: pd.DataFrame, index: UserSessionIndex = None):
+    """Compute and save overall and segment funnels for cleaned events (index: shared user -> sessions index)."""
     sessions = funnel_by_session(events)
     counts_df = funnel_counts(sessions)
     funnel_rates = conversion_rates(counts_df)
@@ -87,11 +278,30 @@ def main():
     print("Funnel conversion rates:")
     print(funnel_rates.to_string(index=False))
 
-    for seg_col in ["device", "region", "campaign_source"]:
-        if seg_col in events.columns:
-            seg_funnel = funnel_by_segment(events, seg_col)
-            seg_funnel.to_csv(OUTPUTS / f"funnel_by_{seg_col}.csv", index=False)
-            print(f"Funnel by {seg_col} saved.")
+    cube = funnel_cube(events)
+    for grouping, seg_funnel in cube.items():
+        if len(grouping) == 1:
+            seg_funnel.to_csv(OUTPUTS / f"funnel_by_{grouping[0]}.csv", index=False)
+            print(f"Funnel by {grouping[0]} saved.")
+    combine_cube(cube).to_csv(OUTPUTS / "funnel_cube.csv", index=False)
+    print("Funnel cube (segments and crosses) saved.")
+
+    if "timestamp" in events.columns:
+        strict_counts, times = strict_funnel(events)
+        strict_rates = conversion_rates(strict_counts)
+        strict_rates.to_csv(OUTPUTS / "funnel_strict_conversion_rates.csv", index=False)
+        ttc = time_to_convert(times)
+        ttc.to_csv(OUTPUTS / "funnel_time_to_convert.csv", index=False)
+        print(f"Strict funnel (windows in minutes: {FUNNEL_WINDOW_MINUTES}):")
+        print(strict_rates.to_string(index=False))
+        print("Time to convert from previous stage:")
+        print(ttc.to_string(index=False))
+
+    if {"user_id", "timestamp"} <= set(events.columns):
+        users = user_funnel(events, index=index)
+        users.to_csv(OUTPUTS / "funnel_users.csv", index=False)
+        print(f"User funnel (sessions within {USER_FUNNEL_DAYS} days of first visit):")
+        print(users.to_string(index=False))
 
     print(f"\nOutputs saved to {OUTPUTS}")
 
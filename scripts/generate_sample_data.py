@@ -1,25 +1,37 @@
 """
 Generate synthetic e-commerce data for analysis.
 Use this if you don't have Kaggle data yet. Schema matches project requirements.
+Sessions and events are drawn with vectorized NumPy and written in chunks, so large load-test
+datasets fit in bounded memory, e.g.:
+    python scripts/generate_sample_data.py --sessions 40000000 --users 5000000 --days 365 --seed 7
 """
+import argparse
+
 import pandas as pd
 import numpy as np
 from pathlib import Path
-from datetime import datetime, timedelta
+from datetime import datetime
 
 # Add project root to path
 import sys
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 from config import DATA_RAW
 
-np.random.seed(42)
-
 # --- Parameters --- (reduce for quick demo; increase for full analysis)
 N_USERS = 800
 N_SESSIONS = 3000
 N_PRODUCTS = 100
 N_DAYS = 90
 START_DATE = datetime(2024, 10, 1)
+SEED = 42
+CHUNK_SESSIONS = 500_000
+
+# Funnel probabilities (per session) and item counts
+P_SIGNUP = 0.35
+P_ADD_TO_CART = 0.45
+P_PURCHASE_GIVEN_CART = 0.55
+CART_ITEMS = (1, 4)      # integers in [1, 4)
+PURCHASE_ITEMS = (1, 3)  # first 1-2 cart lines are bought
 
 # Product categories
 CATEGORIES = [
@@ -31,138 +43,148 @@ CATEGORIES = [
 REGIONS = ["North", "South", "East", "West", "Central"]
 DEVICES = ["mobile", "desktop", "tablet"]
 CAMPAIGNS = ["organic", "google", "facebook", "email", "direct"]
+DEVICE_P = [0.5, 0.4, 0.1]
+CAMPAIGN_P = [0.3, 0.25, 0.2, 0.15, 0.1]
+
+EVENT_COLUMNS = ["event_id", "session_id", "user_id", "event_type", "product_id", "quantity",
+                 "timestamp", "region", "device", "campaign_source"]
 
 
-def generate_products(n: int) -> pd.DataFrame:
+def _ids(prefix: str, numbers: np.ndarray, width: int) -> np.ndarray:
+    return np.char.add(prefix, np.char.zfill(numbers.astype(str), width)).astype(object)
+
+
+def generate_products(n: int, rng: np.random.Generator = None) -> pd.DataFrame:
     """Generate product catalog."""
-    categories = np.random.choice(CATEGORIES, n)
-    prices = np.round(np.random.lognormal(2.5, 1.2, n).clip(5, 500), 2)
+    rng = rng or np.random.default_rng(SEED)
+    categories = rng.choice(CATEGORIES, n)
+    prices = np.round(rng.lognormal(2.5, 1.2, n).clip(5, 500), 2)
     return pd.DataFrame({
-        "product_id": [f"P{i:05d}" for i in range(n)],
-        "product_name": [f"Product_{i}" for i in range(n)],
+        "product_id": _ids("P", np.arange(n), 5),
+        "product_name": _ids("Product_", np.arange(n), 0),
         "category": categories,
         "price": prices,
     })
 
 
-def generate_events(sessions_df: pd.DataFrame, products_df: pd.DataFrame) -> pd.DataFrame:
-    """Generate event stream (visit, signup, add_to_cart, purchase)."""
-    events = []
-    for _, row in sessions_df.iterrows():
-        session_id = row["session_id"]
-        user_id = row["user_id"]
-        ts = row["session_start"]
-        device = row["device"]
-        region = row["region"]
-        campaign = row["campaign_source"]
-
-        # Visit (every session)
-        events.append({
-            "event_id": f"E{len(events):08d}",
-            "session_id": session_id,
-            "user_id": user_id,
-            "event_type": "visit",
-            "product_id": None,
-            "quantity": None,
-            "timestamp": ts,
-            "region": region,
-            "device": device,
-            "campaign_source": campaign,
-        })
-
-        # Signup (subset of sessions - new users)
-        if row.get("is_signup", False):
-            events.append({
-                "event_id": f"E{len(events):08d}",
-                "session_id": session_id,
-                "user_id": user_id,
-                "event_type": "signup",
-                "product_id": None,
-                "quantity": None,
-                "timestamp": ts + timedelta(minutes=np.random.randint(1, 5)),
-                "region": region,
-                "device": device,
-                "campaign_source": campaign,
-            })
-
-        # Add to cart (subset)
-        if row.get("add_to_cart", False):
-            n_items = row.get("cart_items", 1)
-            for _ in range(n_items):
-                prod = products_df.sample(1).iloc[0]
-                events.append({
-                    "event_id": f"E{len(events):08d}",
-                    "session_id": session_id,
-                    "user_id": user_id,
-                    "event_type": "add_to_cart",
-                    "product_id": prod["product_id"],
-                    "quantity": np.random.randint(1, 4),
-                    "timestamp": ts + timedelta(minutes=np.random.randint(5, 25)),
-                    "region": region,
-                    "device": device,
-                    "campaign_source": campaign,
-                })
-
-        # Purchase (subset of add_to_cart)
-        if row.get("purchase", False):
-            cart_events = [e for e in events if e["session_id"] == session_id and e["event_type"] == "add_to_cart"]
-            for ce in cart_events[: row.get("purchase_items", 1)]:
-                events.append({
-                    "event_id": f"E{len(events):08d}",
-                    "session_id": session_id,
-                    "user_id": user_id,
-                    "event_type": "purchase",
-                    "product_id": ce["product_id"],
-                    "quantity": ce["quantity"],
-                    "timestamp": ts + timedelta(minutes=np.random.randint(30, 60)),
-                    "region": region,
-                    "device": device,
-                    "campaign_source": campaign,
-                })
-
-    return pd.DataFrame(events)
+def generate_sessions(first: int, n: int, n_users: int, n_days: int, rng: np.random.Generator) -> pd.DataFrame:
+    """Sessions first..first+n-1 with funnel behavior (realistic drop-offs)."""
+    minutes = rng.integers(0, n_days, n) * 1440 + rng.integers(0, 24, n) * 60 + rng.integers(0, 60, n)
+    add_to_cart = rng.random(n) < P_ADD_TO_CART
+    purchase = add_to_cart & (rng.random(n) < P_PURCHASE_GIVEN_CART)
+    return pd.DataFrame({
+        "session_id": _ids("S", np.arange(first, first + n), 8),
+        "user_id": _ids("U", rng.integers(0, n_users, n), 6),
+        "session_start": np.datetime64(START_DATE, "m") + minutes.astype("timedelta64[m]"),
+        "device": np.array(DEVICES, dtype=object)[rng.choice(len(DEVICES), n, p=DEVICE_P)],
+        "region": np.array(REGIONS, dtype=object)[rng.integers(0, len(REGIONS), n)],
+        "campaign_source": np.array(CAMPAIGNS, dtype=object)[rng.choice(len(CAMPAIGNS), n, p=CAMPAIGN_P)],
+        "is_signup": rng.random(n) < P_SIGNUP,
+        "add_to_cart": add_to_cart,
+        "cart_items": np.where(add_to_cart, rng.integers(*CART_ITEMS, n), 0),
+        "purchase": purchase,
+        "purchase_items": np.where(purchase, rng.integers(*PURCHASE_ITEMS, n), 0),
+    })
 
 
-def main():
-    products_df = generate_products(N_PRODUCTS)
-    products_df.to_csv(DATA_RAW / "products.csv", index=False)
+def generate_events(sessions_df: pd.DataFrame, products_df: pd.DataFrame,
+                    rng: np.random.Generator = None, first_event: int = 0) -> pd.DataFrame:
+    """Generate event stream (visit, signup, add_to_cart, purchase) for a block of sessions.
+
+    Each event kind is drawn as one array over all sessions; purchases copy the product and
+    quantity of the session's first purchase_items cart lines.
+    """
+    rng = rng or np.random.default_rng(SEED)
+    n = len(sessions_df)
+    cart_items = sessions_df["cart_items"].to_numpy()
+
+    # Cart lines: one row per item, position within its session's cart
+    cart_session = np.repeat(np.arange(n), cart_items)
+    cart_pos = np.arange(len(cart_session)) - np.repeat(np.cumsum(cart_items) - cart_items, cart_items)
+    cart_product = rng.integers(0, len(products_df), len(cart_session))
+    cart_qty = rng.integers(1, 4, len(cart_session)).astype(float)
+    bought = (sessions_df["purchase"].to_numpy()[cart_session]
+              & (cart_pos < sessions_df["purchase_items"].to_numpy()[cart_session]))
+    signup_session = np.flatnonzero(sessions_df["is_signup"].to_numpy())
+    n_bought = int(bought.sum())
+
+    # kind: 0 visit, 1 signup, 2 add_to_cart, 3 purchase (also the within-session event order)
+    session = np.concatenate([np.arange(n), signup_session, cart_session, cart_session[bought]])
+    kind = np.repeat(np.arange(4), [n, len(signup_session), len(cart_session), n_bought])
+    pos = np.concatenate([np.zeros(n + len(signup_session), dtype=int), cart_pos, cart_pos[bought]])
+    product = np.concatenate([np.full(n + len(signup_session), -1), cart_product, cart_product[bought]])
+    quantity = np.concatenate([np.full(n + len(signup_session), np.nan), cart_qty, cart_qty[bought]])
+    offset = np.concatenate([
+        np.zeros(n, dtype=int),
+        rng.integers(1, 5, len(signup_session)),
+        rng.integers(5, 25, len(cart_session)),
+        rng.integers(30, 60, n_bought),
+    ])
+    order = np.lexsort((pos, kind, session))
+    session, kind, product, quantity, offset = (a[order] for a in (session, kind, product, quantity, offset))
+
+    product_ids = np.append(products_df["product_id"].to_numpy(dtype=object), None)
+    start = sessions_df["session_start"].to_numpy().astype("datetime64[m]")
+    return pd.DataFrame({
+        "event_id": _ids("E", np.arange(first_event, first_event + len(session)), 8),
+        "session_id": sessions_df["session_id"].to_numpy()[session],
+        "user_id": sessions_df["user_id"].to_numpy()[session],
+        "event_type": np.array(["visit", "signup", "add_to_cart", "purchase"], dtype=object)[kind],
+        "product_id": product_ids[product],
+        "quantity": quantity,
+        "timestamp": start[session] + offset.astype("timedelta64[m]"),
+        "region": sessions_df["region"].to_numpy()[session],
+        "device": sessions_df["device"].to_numpy()[session],
+        "campaign_source": sessions_df["campaign_source"].to_numpy()[session],
+    }, columns=EVENT_COLUMNS)
+
+
+def generate(n_sessions: int = N_SESSIONS, n_users: int = N_USERS, n_days: int = N_DAYS,
+             n_products: int = N_PRODUCTS, seed: int = SEED, chunk_sessions: int = CHUNK_SESSIONS,
+             out_dir: Path = DATA_RAW, keep_in_memory: bool = True):
+    """Write products, sessions and events CSVs chunk by chunk; returns (products_df, events_df or None)."""
+    rng = np.random.default_rng(seed)
+    products_df = generate_products(n_products, rng)
+    products_df.to_csv(out_dir / "products.csv", index=False)
     print(f"Created products: {len(products_df)} rows")
 
-    # Sessions with funnel behavior (realistic drop-offs)
-    user_ids = [f"U{i:06d}" for i in range(N_USERS)]
-    sessions = []
-    for i in range(N_SESSIONS):
-        session_start = START_DATE + timedelta(
-            days=np.random.randint(0, N_DAYS),
-            hours=np.random.randint(0, 24),
-            minutes=np.random.randint(0, 60),
-        )
-        is_signup = np.random.random() < 0.35
-        add_to_cart = np.random.random() < 0.45
-        purchase = add_to_cart and (np.random.random() < 0.55)
-        sessions.append({
-            "session_id": f"S{i:08d}",
-            "user_id": np.random.choice(user_ids),
-            "session_start": session_start,
-            "device": np.random.choice(DEVICES, p=[0.5, 0.4, 0.1]),
-            "region": np.random.choice(REGIONS),
-            "campaign_source": np.random.choice(CAMPAIGNS, p=[0.3, 0.25, 0.2, 0.15, 0.1]),
-            "is_signup": is_signup,
-            "add_to_cart": add_to_cart,
-            "cart_items": np.random.randint(1, 4) if add_to_cart else 0,
-            "purchase": purchase,
-            "purchase_items": np.random.randint(1, 3) if purchase else 0,
-        })
-
-    sessions_df = pd.DataFrame(sessions)
-    events_df = generate_events(sessions_df, products_df)
-
-    # Export sessions (for reference) and events
-    sessions_df.to_csv(DATA_RAW / "sessions.csv", index=False)
-    events_df.to_csv(DATA_RAW / "events.csv", index=False)
-    print(f"Created sessions: {len(sessions_df)} rows")
-    print(f"Created events: {len(events_df)} rows")
-    print(f"Data saved to {DATA_RAW}")
+    n_events, kept = 0, []
+    for first in range(0, n_sessions, chunk_sessions):
+        sessions_df = generate_sessions(first, min(chunk_sessions, n_sessions - first), n_users, n_days, rng)
+        events_df = generate_events(sessions_df, products_df, rng, first_event=n_events)
+        header = first == 0
+        sessions_df.to_csv(out_dir / "sessions.csv", mode="w" if header else "a", header=header, index=False)
+        events_df.to_csv(out_dir / "events.csv", mode="w" if header else "a", header=header, index=False)
+        n_events += len(events_df)
+        if keep_in_memory:
+            kept.append(events_df)
+        if n_sessions > chunk_sessions:
+            print(f"  sessions {first + len(sessions_df):,}/{n_sessions:,}, events {n_events:,}")
+
+    print(f"Created sessions: {n_sessions} rows")
+    print(f"Created events: {n_events} rows")
+    print(f"Data saved to {out_dir}")
+    events_df = pd.concat(kept, ignore_index=True) if keep_in_memory else None
+    return products_df, events_df
+
+
+def run():
+    """Generate and save the default demo dataset; returns (products_df, events_df)."""
+    return generate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic e-commerce data.")
+    parser.add_argument("--sessions", type=int, default=N_SESSIONS)
+    parser.add_argument("--users", type=int, default=N_USERS)
+    parser.add_argument("--days", type=int, default=N_DAYS)
+    parser.add_argument("--products", type=int, default=N_PRODUCTS)
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--chunk-sessions", type=int, default=CHUNK_SESSIONS,
+                        help="sessions generated and written per chunk (bounds memory)")
+    args = parser.parse_args()
+    generate(args.sessions, args.users, args.days, args.products, args.seed, args.chunk_sessions,
+             keep_in_memory=False)
 
 
 if __name__ == "__main__":
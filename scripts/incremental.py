@@ -0,0 +1,328 @@
+"""
+Incremental pipeline run: clean and aggregate only the raw events appended since the last run.
+- Watermark: byte offset into data/raw/events.csv (plus the latest event timestamp seen)
+- Outputs are rebuilt from mergeable aggregates persisted in data/state/, not from full history
+- Distinct counts (orders per day/category, purchase sessions per user) keep per-session keys only
+  while a session is open; sessions idle for SESSION_HORIZON_HOURS are closed and dropped from state
+- Batches without usable session IDs are sessionized by inactivity gap (scripts/sessionize.py), continuing
+  each user's open session from the previous run
+- Events re-delivered in a later batch (same event_id) are dropped against per-event-date fingerprints kept
+  in state for the last REDELIVERY_WINDOW_DAYS days of event time (older days are discarded each run)
+Refreshed: funnel counts/rates/segments/cube, top products, revenue by category, daily revenue, KPIs and
+their charts (including the seasonality heatmap). Not refreshed (need full history; rerun the batch
+pipeline): see NOT_REFRESHED - strict funnel, time to convert, funnel users, repeat-purchase cohorts,
+cohort retention and funnel trends, basket pairs and the *_approx sketch tables.
+Run from project root: python scripts/incremental.py [--reset]
+"""
+import argparse
+import io
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import sys
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from config import (DATA_RAW, FUNNEL_STAGES, OUTPUTS, REDELIVERY_WINDOW_DAYS, SEGMENT_COLUMNS, SESSION_HORIZON_HOURS,
+                    STATE_DIR)
+
+from data_cleaning import RowFingerprints, clean_events, clean_products
+from eda import chart_jobs, merge_purchases_with_products, render_charts, render_funnel_chart, seasonality_table
+from funnel_analysis import combine_cube, conversion_rates, cube_from_cells, ordered_reach, reach_from_codes, session_segments
+from sessionize import continue_open, needed, sessionize
+from storage import write_events, write_products
+
+STATE_FILE = STATE_DIR / "incremental_state.pkl"
+STAGE_BITS = 1 << np.arange(len(FUNNEL_STAGES))
+ID_COLUMNS = ["event_id", "session_id", "user_id", "product_id"]
+OPEN_SESSION_COLUMNS = ["mask", *SEGMENT_COLUMNS, "last_seen"]
+# Outputs of the batch pipeline that an incremental run leaves as they are
+NOT_REFRESHED = [
+    "funnel_strict_conversion_rates.csv", "funnel_time_to_convert.csv", "funnel_users.csv",
+    "repeat_purchase_cohorts.csv", "cohort_retention.csv", "funnel_daily.csv", "funnel_weekly.csv",
+    "product_pairs.csv", "category_pairs.csv", "kpis_approx.csv", "revenue_by_category_approx.csv",
+    "top_products_approx.csv", "daily_revenue_approx.csv", "kpis_approx_weekly.csv", "kpis_approx_monthly.csv",
+]
+
+
+def empty_state() -> dict:
+    return {
+        "watermark": {"offset": 0, "header": None, "max_timestamp": None},
+        # Open sessions: stage bitmask, first segment values and last event time, indexed by session_id
+        "sessions": None,
+        # Derived sessions (SESSIONIZE): per user, the session an event within the gap would continue
+        "open_users": None,
+        # Additive aggregates
+        "funnel_cells": None,
+        "products": None,
+        "categories": None,
+        "daily": None,
+        "seasonality": None,
+        "totals": {"revenue": 0.0, "orders": 0},
+        "user_orders": pd.Series(dtype="int64", name="orders"),
+        # Distinct keys of open sessions, so each session counts once per date / category / order
+        "seen_date": pd.DataFrame(columns=["session_id", "date"]),
+        "seen_category": pd.DataFrame(columns=["session_id", "category"]),
+        "seen_order": pd.DataFrame(columns=["session_id", "user_id"]),
+        # Event key fingerprints per event date (last REDELIVERY_WINDOW_DAYS), to drop re-delivered events
+        "fingerprints": {},
+    }
+
+
+def load_state(reset: bool = False) -> dict:
+    if reset or not STATE_FILE.exists():
+        return empty_state()
+    return pd.read_pickle(STATE_FILE)
+
+
+def save_state(state: dict):
+    tmp = STATE_FILE.with_suffix(".tmp")
+    pd.to_pickle(state, tmp)
+    tmp.replace(STATE_FILE)
+
+
+def read_new_raw(path: Path, watermark: dict):
+    """Complete lines appended to the raw events file since the watermark: (events, new_offset, header)."""
+    offset = watermark["offset"]
+    with open(path, "rb") as f:
+        size = f.seek(0, io.SEEK_END)
+        if size < offset:
+            raise RuntimeError(f"{path.name} is smaller than the watermark (rotated?); rerun with --reset")
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b"\n") + 1  # a trailing partial line waits for the next run
+    if end == 0:
+        return None, offset, watermark["header"]
+    if offset == 0:
+        header = list(pd.read_csv(io.BytesIO(data[:end]), nrows=0).columns)
+        events = pd.read_csv(io.BytesIO(data[:end]), dtype={c: str for c in ID_COLUMNS if c in header})
+    else:
+        header = watermark["header"]
+        events = pd.read_csv(io.BytesIO(data[:end]), header=None, names=header,
+                             dtype={c: str for c in ID_COLUMNS if c in header})
+    return events, offset + end, header
+
+
+def _add(total, part: pd.DataFrame) -> pd.DataFrame:
+    """Sum two aggregates indexed by the same keys (keys missing on either side count as zero)."""
+    if total is None or total.empty:
+        return part
+    combined = pd.concat([total, part])
+    return combined.groupby(level=list(range(combined.index.nlevels)), dropna=False, observed=True).sum()
+
+
+def _new_distinct(seen: pd.DataFrame, keys: pd.DataFrame) -> pd.DataFrame:
+    """Distinct rows of `keys` that are not in `seen` yet."""
+    keys = keys.drop_duplicates()
+    if seen.empty:
+        return keys
+    merged = keys.merge(seen.drop_duplicates(), how="left", indicator=True)
+    return keys[(merged["_merge"] == "left_only").to_numpy()]
+
+
+def _append(seen: pd.DataFrame, new: pd.DataFrame) -> pd.DataFrame:
+    return new.reset_index(drop=True) if seen.empty else pd.concat([seen, new], ignore_index=True)
+
+
+def _ordered_flags(masks: np.ndarray) -> np.ndarray:
+    return ordered_reach((masks[:, None] & STAGE_BITS) > 0).astype(int)
+
+
+def update_funnel(state: dict, events: pd.DataFrame):
+    """Merge batch session bitmasks into the open sessions and apply the change to the funnel cells."""
+    session_codes, session_ids = pd.factorize(events["session_id"], sort=True)
+    batch = session_segments(events, session_codes, len(session_ids), SEGMENT_COLUMNS).astype(object)
+    batch.index = pd.Index(session_ids, name="session_id")
+    masks = reach_from_codes(session_codes, len(session_ids), events["event_type"]) @ STAGE_BITS
+
+    last_seen = events["timestamp"].groupby(session_codes).max()
+    last_seen.index = batch.index
+
+    sessions = state["sessions"]
+    old = (sessions if sessions is not None else pd.DataFrame(columns=OPEN_SESSION_COLUMNS)).reindex(batch.index)
+    known = old["mask"].notna().to_numpy()
+    old_masks = old["mask"].fillna(0).astype(int).to_numpy()
+    new_masks = old_masks | masks
+    # Segment values stay as first seen for sessions that were already open
+    batch.loc[known, SEGMENT_COLUMNS] = old.loc[known, SEGMENT_COLUMNS]
+    batch["mask"] = new_masks
+    old_last_seen = pd.to_datetime(old["last_seen"])
+    batch["last_seen"] = last_seen.where(~known | (last_seen >= old_last_seen), old_last_seen)
+
+    delta = pd.DataFrame(_ordered_flags(new_masks) - _ordered_flags(old_masks), columns=FUNNEL_STAGES)
+    delta[SEGMENT_COLUMNS] = batch[SEGMENT_COLUMNS].to_numpy()
+    cells = delta.groupby(SEGMENT_COLUMNS, dropna=False)[FUNNEL_STAGES].sum()
+    state["funnel_cells"] = _add(state["funnel_cells"], cells)
+
+    batch = batch[OPEN_SESSION_COLUMNS]
+    state["sessions"] = batch if sessions is None else pd.concat([sessions[~sessions.index.isin(batch.index)], batch])
+
+
+def update_purchases(state: dict, events: pd.DataFrame, products: pd.DataFrame):
+    """Add batch revenue/units and count sessions newly seen per day, category and user.
+
+    product_name and category are categoricals, so groupbys on them pass observed=True (only the
+    combinations present, not the cartesian product of every category).
+    """
+    if not (events["event_type"] == "purchase").any():
+        return
+    purchases = merge_purchases_with_products(events, products)
+    purchases["date"] = purchases["timestamp"].dt.normalize()
+
+    by_product = purchases.groupby(["product_id", "product_name", "category"], observed=True).agg(
+        units_sold=("quantity", "sum"), revenue=("revenue", "sum"))
+    state["products"] = _add(state["products"], by_product)
+
+    new_category = _new_distinct(state["seen_category"], purchases[["session_id", "category"]].dropna())
+    by_category = purchases.groupby("category", observed=True).agg(units_sold=("quantity", "sum"), revenue=("revenue", "sum"))
+    by_category["orders"] = new_category.groupby("category", observed=True).size().reindex(by_category.index, fill_value=0)
+    state["categories"] = _add(state["categories"], by_category)
+    state["seen_category"] = _append(state["seen_category"], new_category)
+
+    new_date = _new_distinct(state["seen_date"], purchases[["session_id", "date"]])
+    daily = purchases.groupby("date").agg(revenue=("revenue", "sum"), units=("quantity", "sum"))
+    daily["orders"] = new_date.groupby("date").size().reindex(daily.index, fill_value=0)
+    state["daily"] = _add(state["daily"], daily[["revenue", "orders", "units"]])
+    state["seen_date"] = _append(state["seen_date"], new_date)
+    if "seasonality" in state:  # states saved before the heatmap was tracked cannot start it mid-history
+        cells = seasonality_table(purchases).stack().to_frame("revenue")
+        state["seasonality"] = _add(state["seasonality"], cells)
+
+    new_orders = _new_distinct(state["seen_order"], purchases[["session_id", "user_id"]])
+    state["totals"]["revenue"] += float(purchases["revenue"].sum())
+    state["totals"]["orders"] += len(new_orders)
+    state["user_orders"] = _add(state["user_orders"].to_frame(), new_orders.groupby("user_id").size().to_frame("orders"))["orders"]
+    state["seen_order"] = _append(state["seen_order"], new_orders)
+
+
+def close_sessions(state: dict):
+    """Drop sessions idle past the horizon, along with their distinct-key bookkeeping."""
+    sessions = state["sessions"]
+    horizon = state["watermark"]["max_timestamp"] - pd.Timedelta(hours=SESSION_HORIZON_HOURS)
+    closed = sessions.index[sessions["last_seen"] < horizon]
+    state["sessions"] = sessions.drop(closed)
+    for key in ["seen_date", "seen_category", "seen_order"]:
+        seen = state[key]
+        state[key] = seen[~seen["session_id"].isin(closed)].reset_index(drop=True)
+    return len(closed)
+
+
+def write_outputs(state: dict):
+    """Same output files as funnel_analysis.py and eda.py, built from the persisted aggregates."""
+    cells = state["funnel_cells"].reset_index()
+    counts_df = pd.DataFrame({"stage": FUNNEL_STAGES, "count": cells[FUNNEL_STAGES].sum().to_numpy().astype(int)})
+    counts_df.to_csv(OUTPUTS / "funnel_counts.csv", index=False)
+    conversion_rates(counts_df).to_csv(OUTPUTS / "funnel_conversion_rates.csv", index=False)
+    cube = cube_from_cells(cells)
+    for grouping, table in cube.items():
+        if len(grouping) == 1:
+            table.to_csv(OUTPUTS / f"funnel_by_{grouping[0]}.csv", index=False)
+    combine_cube(cube).to_csv(OUTPUTS / "funnel_cube.csv", index=False)
+    render_funnel_chart()
+
+    if state["products"] is None:
+        return
+    by_product = state["products"].reset_index().sort_values("revenue", ascending=False)
+    by_category = state["categories"].reset_index().sort_values("revenue", ascending=False)
+    daily = state["daily"].reset_index().sort_values("date")
+    by_product.to_csv(OUTPUTS / "top_products.csv", index=False)
+    by_category.to_csv(OUTPUTS / "revenue_by_category.csv", index=False)
+    daily.to_csv(OUTPUTS / "daily_revenue.csv", index=False)
+
+    totals, user_orders = state["totals"], state["user_orders"]
+    kpis = {
+        "aov": totals["revenue"] / totals["orders"] if totals["orders"] else float("nan"),
+        "total_revenue": totals["revenue"],
+        "repeat_purchaser_pct": (user_orders > 1).mean() * 100 if len(user_orders) else 0,
+        "total_orders": totals["orders"],
+    }
+    pd.DataFrame([kpis]).to_csv(OUTPUTS / "kpis.csv", index=False)
+    print("KPIs:", kpis)
+
+    seasonality = state.get("seasonality")
+    if seasonality is not None:
+        seasonality = seasonality["revenue"].unstack(fill_value=0)
+    render_charts(chart_jobs(by_product=by_product, by_category=by_category, daily=daily, seasonality=seasonality))
+
+
+def drop_redelivered(state: dict, events: pd.DataFrame) -> pd.DataFrame:
+    """Events whose key (event_id, else the whole row) was not processed in this or an earlier batch.
+
+    Keys are fingerprinted per event date, so a re-delivered event is matched only against its own day's set.
+    """
+    by_day = state.get("fingerprints")
+    if not isinstance(by_day, dict):  # states saved with one set over all history
+        by_day = state["fingerprints"] = {}
+    keys = (events[["event_id"]] if "event_id" in events.columns else events).astype(str)
+    day_codes, days = pd.factorize(events["timestamp"].dt.normalize())
+    keep = np.ones(len(events), dtype=bool)
+    for code, day in enumerate(days):
+        rows = np.flatnonzero(day_codes == code)
+        keep[rows] = by_day.setdefault(day, RowFingerprints()).keep_new(keys.iloc[rows])
+    if not keep.all():
+        print(f"Dropped {int((~keep).sum())} events already processed in an earlier batch")
+    return events[keep]
+
+
+def expire_fingerprints(state: dict) -> int:
+    """Discard fingerprint sets of event dates older than REDELIVERY_WINDOW_DAYS before the latest event."""
+    latest = state["watermark"]["max_timestamp"]
+    by_day = state.get("fingerprints") or {}
+    if latest is None:
+        return 0
+    cutoff = latest.normalize() - pd.Timedelta(days=REDELIVERY_WINDOW_DAYS)
+    expired = [day for day in by_day if day < cutoff]
+    for day in expired:
+        del by_day[day]
+    return len(expired)
+
+
+def warn_not_refreshed():
+    stale = [name for name in NOT_REFRESHED if (OUTPUTS / name).exists()]
+    if stale:
+        print(f"Note: incremental runs do not refresh {', '.join(stale)}; rerun the batch pipeline for them.")
+
+
+def main(reset: bool = False):
+    state = load_state(reset)
+    watermark = state["watermark"]
+    print(f"Reading raw events after byte offset {watermark['offset']}...")
+    raw, offset, header = read_new_raw(DATA_RAW / "events.csv", watermark)
+    if raw is None or raw.empty:
+        print("No new events since the last run.")
+        return
+
+    events = drop_redelivered(state, clean_events(raw))
+    if needed(events):
+        events, state["open_users"] = continue_open(sessionize(events), state.get("open_users"))
+    products = clean_products(pd.read_csv(DATA_RAW / "products.csv"))
+    first_run = watermark["offset"] == 0
+    write_events(events, append=not first_run)
+    write_products(products)
+    print(f"New events: {len(raw)} -> {len(events)} cleaned")
+
+    if len(events):
+        update_funnel(state, events)
+        update_purchases(state, events, products)
+        batch_max = events["timestamp"].max()
+        previous = watermark["max_timestamp"]
+        watermark["max_timestamp"] = batch_max if previous is None else max(previous, batch_max)
+    watermark.update(offset=offset, header=header)
+    expire_fingerprints(state)
+    if state["sessions"] is not None:
+        n_closed = close_sessions(state)
+        print(f"Open sessions: {len(state['sessions'])} ({n_closed} closed this run)")
+
+    save_state(state)
+    if state["funnel_cells"] is not None:
+        write_outputs(state)
+    print(f"Watermark: offset {offset}, latest event {watermark['max_timestamp']}")
+    print(f"Outputs updated in {OUTPUTS}")
+    warn_not_refreshed()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Incrementally update outputs with newly arrived raw events.")
+    parser.add_argument("--reset", action="store_true", help="discard persisted state and reprocess from the start")
+    args = parser.parse_args()
+    main(reset=args.reset)
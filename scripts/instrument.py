@@ -0,0 +1,289 @@
+"""
+Instrumentation for pipeline stages: named spans recording wall time, CPU time, rows in/out and peak RSS.
+- Off unless run_pipeline.py --trace / --profile or PIPELINE_TRACE=1 (any script); when off, span() hands
+  back one shared no-op object and @traced functions cost a single check per call
+- Spans nest per thread (pipeline stages run in threads). On exit the run is written to
+  data/state/traces/trace-<time>.json in Chrome trace format (open in https://ui.perfetto.dev or
+  chrome://tracing; RSS is a counter track), and a per-span summary is printed and saved as *-summary.csv
+- Profile mode (--profile, PIPELINE_PROFILE=1) also samples every thread's Python stack each
+  PROFILE_INTERVAL_MS into *-profile.folded (collapsed stacks: speedscope, flamegraph.pl)
+Worker processes (parallel_analysis, chart rendering) are covered by the span around the pool, not traced inside.
+Usage:
+    with span("clean_events.dedup", rows_in=len(events)) as s:
+        events = events.drop_duplicates()
+        s.rows_out = len(events)
+"""
+import atexit
+import functools
+import json
+import multiprocessing
+import os
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import sys
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from config import PROFILE_ENABLED, PROFILE_INTERVAL_MS, TRACE_DIR, TRACE_ENABLED
+
+RSS_INTERVAL = 0.02      # seconds between RSS samples for span peaks
+COUNTER_INTERVAL = 0.1   # seconds between RSS points on the trace's counter track
+
+_tracer = None  # the active Tracer; None while instrumentation is off
+
+
+def rss_mb():
+    """Current resident set size in MB (Linux /proc; None where unavailable)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, AttributeError, ValueError):
+        return None
+
+
+class PeakRSS(threading.Thread):
+    """Samples RSS every `interval` seconds; unlike tracemalloc it does not slow the stages down."""
+
+    def __init__(self, interval: float = RSS_INTERVAL):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = rss_mb()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while self.peak is not None and not self._stopped.wait(self.interval):
+            self.peak = max(self.peak, rss_mb())
+
+    def reset(self):
+        self.peak = rss_mb()
+
+    def stop(self):
+        self._stopped.set()
+
+
+class _NoSpan:
+    """What span() returns while tracing is off: entering, leaving and setting rows do nothing."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Span:
+    __slots__ = ("tracer", "name", "rows_in", "rows_out", "args", "tid", "start", "cpu", "peak")
+
+    def __init__(self, tracer, name: str, rows_in=None, args=None):
+        self.tracer, self.name, self.rows_in, self.rows_out, self.args = tracer, name, rows_in, None, args or {}
+
+    def __enter__(self):
+        self.tid = threading.get_ident()
+        self.peak = rss_mb() or 0.0
+        self.tracer.opened(self)
+        # CPU time of this thread only: concurrent pipeline stages do not inflate each other
+        self.cpu = time.thread_time()
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter_ns()
+        cpu = time.thread_time() - self.cpu
+        self.tracer.closed(self, end, cpu, failed=exc_type is not None)
+        return False
+
+
+class Tracer:
+    def __init__(self, profile: bool = False, interval_ms: float = PROFILE_INTERVAL_MS):
+        self.t0 = time.perf_counter_ns()
+        self.started = datetime.now()
+        self.events = []  # Chrome trace events
+        self.spans = []   # (name, wall s, cpu s, rows in, rows out, peak RSS MB)
+        self.stacks = Counter() if profile else None
+        self._open = set()
+        self._threads = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._interval = interval_ms / 1000 if profile else RSS_INTERVAL
+        self._sampler = threading.Thread(target=self._sample, daemon=True, name="instrument-sampler")
+        self._sampler.start()
+
+    def _us(self, ns: int) -> float:
+        return (ns - self.t0) / 1000
+
+    def opened(self, span: Span):
+        with self._lock:
+            self._open.add(span)
+            # Stage threads are gone by the time the trace is written, so names are kept as they appear
+            self._threads.setdefault(span.tid, threading.current_thread().name)
+
+    def closed(self, span: Span, end: int, cpu: float, failed: bool = False):
+        peak = max(span.peak, rss_mb() or 0.0)
+        args = {"cpu_ms": round(cpu * 1000, 3), "peak_rss_mb": round(peak, 1), **span.args}
+        for key in ("rows_in", "rows_out"):
+            if getattr(span, key) is not None:
+                args[key] = int(getattr(span, key))
+        if failed:
+            args["failed"] = True
+        with self._lock:
+            self._open.discard(span)
+            self.events.append({"name": span.name, "cat": span.name.split(".")[0], "ph": "X",
+                                "ts": self._us(span.start), "dur": (end - span.start) / 1000,
+                                "pid": os.getpid(), "tid": span.tid, "args": args})
+            self.spans.append((span.name, (end - span.start) / 1e9, cpu,
+                               np.nan if span.rows_in is None else span.rows_in,
+                               np.nan if span.rows_out is None else span.rows_out, peak))
+
+    def _sample(self):
+        me, last_counter = threading.get_ident(), 0.0
+        while not self._stopped.wait(self._interval):
+            rss = rss_mb()
+            now = time.perf_counter_ns()
+            with self._lock:
+                for span in self._open:
+                    span.peak = max(span.peak, rss or 0.0)
+                if rss is not None and now / 1e9 - last_counter >= COUNTER_INTERVAL:
+                    last_counter = now / 1e9
+                    self.events.append({"name": "rss_mb", "ph": "C", "ts": self._us(now), "pid": os.getpid(),
+                                        "args": {"rss_mb": round(rss, 1)}})
+            if self.stacks is not None:
+                self._sample_stacks(me)
+
+    def _sample_stacks(self, me: int):
+        for tid, frame in sys._current_frames().items():
+            if tid == me or _idle(frame):
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{Path(code.co_filename).stem}.{code.co_name}")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self._sampler.join()
+
+    def summary(self) -> pd.DataFrame:
+        """Per span name: calls, total wall and CPU seconds, rows in/out and the highest peak RSS."""
+        spans = pd.DataFrame(self.spans, columns=["span", "wall_s", "cpu_s", "rows_in", "rows_out", "peak_rss_mb"])
+        summary = spans.groupby("span", sort=False).agg(
+            calls=("wall_s", "size"), wall_s=("wall_s", "sum"), cpu_s=("cpu_s", "sum"),
+            rows_in=("rows_in", lambda x: x.sum(min_count=1)), rows_out=("rows_out", lambda x: x.sum(min_count=1)),
+            peak_rss_mb=("peak_rss_mb", "max"),
+        )
+        return summary.sort_values("wall_s", ascending=False).round(3).reset_index()
+
+    def hot_functions(self, n: int = 15) -> pd.DataFrame:
+        """Functions by self samples (top of stack) and total samples (anywhere on the stack)."""
+        own, total = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] += count
+            for name in set(frames):
+                total[name] += count
+        samples = sum(self.stacks.values()) or 1
+        rows = [{"function": name, "self_pct": round(100 * c / samples, 1), "total_pct": round(100 * total[name] / samples, 1)}
+                for name, c in own.most_common(n)]
+        return pd.DataFrame(rows, columns=["function", "self_pct", "total_pct"])
+
+    def write(self, root: Path = TRACE_DIR) -> Path:
+        root.mkdir(parents=True, exist_ok=True)
+        base = root / f"trace-{self.started:%Y%m%d-%H%M%S}"
+        names = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+                 for tid, name in self._threads.items()]
+        base.with_suffix(".json").write_text(json.dumps(
+            {"traceEvents": names + self.events, "displayTimeUnit": "ms",
+             "otherData": {"started": self.started.isoformat(timespec="seconds"), "argv": sys.argv}}))
+        self.summary().to_csv(f"{base}-summary.csv", index=False)
+        if self.stacks:
+            Path(f"{base}-profile.folded").write_text(
+                "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common()))
+        return base.with_suffix(".json")
+
+
+def _idle(frame) -> bool:
+    """Thread parked in a lock/condition wait or an idle pool worker (not useful in a profile)."""
+    code = frame.f_code
+    return code.co_filename == threading.__file__ or code.co_name == "_worker"
+
+
+def enabled() -> bool:
+    return _tracer is not None
+
+
+def enable(profile: bool = False) -> Tracer:
+    """Start recording spans (and stack samples with profile=True); the trace is written by finish() or at exit."""
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer(profile)
+        atexit.register(finish)
+    return _tracer
+
+
+def finish(show: bool = True):
+    """Stop recording, write the trace files and print the summary; returns the trace path (None if off)."""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is None:
+        return None
+    atexit.unregister(finish)
+    tracer.stop()
+    path = tracer.write()
+    if show:
+        print("\nSpan summary (wall/CPU seconds, rows, peak RSS MB):")
+        print(tracer.summary().to_string(index=False))
+        if tracer.stacks:
+            print(f"\nHottest functions ({sum(tracer.stacks.values())} stack samples):")
+            print(tracer.hot_functions().to_string(index=False))
+        print(f"Trace saved to {path}")
+    return path
+
+
+def span(name: str, rows_in=None, **args):
+    """Context manager timing a named step; set .rows_out on it before leaving. No-op while tracing is off."""
+    tracer = _tracer
+    if tracer is None:
+        return _NO_SPAN
+    return Span(tracer, name, rows_in, args)
+
+
+def _rows(value):
+    return len(value) if isinstance(value, (pd.DataFrame, pd.Series)) else None
+
+
+def traced(func=None, *, name: str = None):
+    """Decorator: a span per call named after the function, with rows in (first argument) and rows out
+    (DataFrame/Series result)."""
+    if func is None:
+        return functools.partial(traced, name=name)
+    label = name or func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        tracer = _tracer
+        if tracer is None:
+            return func(*args, **kwargs)
+        with Span(tracer, label, _rows(args[0]) if args else None) as s:
+            result = func(*args, **kwargs)
+            s.rows_out = _rows(result)
+        return result
+
+    return wrapper
+
+
+# Scripts started with PIPELINE_TRACE=1 trace themselves (pool worker processes inherit the variable but not a tracer)
+if TRACE_ENABLED and multiprocessing.parent_process() is None:
+    enable(PROFILE_ENABLED)
@@ -0,0 +1,143 @@
+"""
+Parallel funnel + EDA: the independent aggregations and charts run in a process pool.
+The cleaned events are written once to an uncompressed Arrow IPC file (in /dev/shm when available)
+that every worker memory-maps, so workers read shared pages instead of unpickling DataFrames.
+Run from project root: python scripts/parallel_analysis.py [--workers N] [--check]
+--check compares the worker KPI tables (purchase rows only) with the serial pipeline's (index over all events).
+"""
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+import sys
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from config import N_WORKERS, OUTPUTS
+
+import eda
+import funnel_analysis
+from product_index import ProductIndex
+from schema import ID_COLUMNS, compact_events, decode_ids, mark_encoded, read_compact_events, read_compact_products
+
+
+def share_events(events: pd.DataFrame, path: Path) -> Path:
+    """Write events as an uncompressed Arrow IPC file in the compact schema (int32 ID codes)."""
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    events = compact_events(events)
+    feather.write_feather(pa.Table.from_pandas(events, preserve_index=False), path, compression="uncompressed")
+    return path
+
+
+def load_shared(path: Path, columns, event_types=None) -> pd.DataFrame:
+    """Memory-map the shared events file and materialize only `columns` (and `event_types` rows; IDs stay coded)."""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    table = pa.ipc.open_file(pa.memory_map(str(path))).read_all().select(list(columns))
+    if event_types is not None:
+        table = table.filter(pc.is_in(table["event_type"], value_set=pa.array(list(event_types))))
+    return mark_encoded(table.to_pandas(), [c for c in ID_COLUMNS if c in columns])
+
+
+def _purchases(path: Path, products: ProductIndex):
+    """Purchase events, their product-joined rows (as eda.load_data + merge would give) and the product index."""
+    events = load_shared(path, eda.EDA_COLUMNS, event_types=["purchase"])
+    return events, eda.merge_purchases_with_products(events, products), products
+
+
+# --- Worker tasks (module-level so the pool can pickle them; inputs are the events file path and the
+# product index built once in the parent, so workers never encode product IDs themselves) ---
+
+def task_funnel(path: Path):
+    funnel_analysis.run(load_shared(path, funnel_analysis.FUNNEL_COLUMNS))
+
+
+def task_products(path: Path, products: ProductIndex):
+    by_product, by_category = eda.top_products_and_categories(*_purchases(path, products)[1:])
+    decode_ids(by_product).to_csv(OUTPUTS / "top_products.csv", index=False)
+    by_category.to_csv(OUTPUTS / "revenue_by_category.csv", index=False)
+    return by_product, by_category
+
+
+def task_daily(path: Path, products: ProductIndex):
+    daily = eda.revenue_trends(_purchases(path, products)[1])
+    daily.to_csv(OUTPUTS / "daily_revenue.csv", index=False)
+    return daily
+
+
+def task_kpis(path: Path, products: ProductIndex):
+    events, purchases, _ = _purchases(path, products)
+    kpis, cohorts = eda.kpi_tables(events, purchases)
+    pd.DataFrame([kpis]).to_csv(OUTPUTS / "kpis.csv", index=False)
+    cohorts.to_csv(OUTPUTS / "repeat_purchase_cohorts.csv", index=False)
+    return kpis
+
+
+def task_seasonality(path: Path, products: ProductIndex):
+    return eda.seasonality_table(_purchases(path, products)[1])
+
+
+def run(events: pd.DataFrame = None, workers: int = N_WORKERS, products=None):
+    """Compute every funnel/EDA output with `workers` processes sharing one mapped events file
+    (products: compact catalog or its ProductIndex; read once here when not given)."""
+    if events is None:
+        events = read_compact_events()
+    products = eda.product_index(products if products is not None else read_compact_products())
+    shm = Path("/dev/shm")
+    with tempfile.TemporaryDirectory(dir=shm if shm.is_dir() else None) as tmp:
+        path = share_events(events, Path(tmp) / "events.arrow")
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            funnel = pool.submit(task_funnel, path)
+            top = pool.submit(task_products, path, products)
+            daily = pool.submit(task_daily, path, products)
+            kpis = pool.submit(task_kpis, path, products)
+            seasonality = pool.submit(task_seasonality, path, products)
+            funnel.result()
+            by_product, by_category = top.result()
+            # Charts render from the small aggregates (only those whose data changed)
+            eda.render_charts(eda.chart_jobs(
+                funnel=pd.read_csv(OUTPUTS / "funnel_conversion_rates.csv"), by_product=by_product,
+                by_category=by_category, daily=daily.result(), seasonality=seasonality.result(),
+            ), workers=workers)
+    print("KPIs:", kpis.result())
+    print(f"Funnel and EDA outputs saved to {OUTPUTS} ({workers} workers)")
+
+
+def check(events: pd.DataFrame = None) -> bool:
+    """Compare the KPI and repeat-purchase cohort tables of the worker path and the serial path."""
+    from sql_backend import compare
+    from user_index import UserSessionIndex
+
+    if events is None:
+        events = read_compact_events()
+    products = eda.product_index(read_compact_products())
+    purchase_events = events[events["event_type"] == "purchase"]
+    purchases = eda.merge_purchases_with_products(purchase_events, products)
+    tables = {}
+    for mode, rows, index in [("serial", events, UserSessionIndex.from_events(events)), ("workers", purchase_events, None)]:
+        kpis, cohorts = eda.kpi_tables(rows, purchases, index)
+        tables[mode] = {"kpis": pd.DataFrame([kpis]), "repeat_purchase_cohorts": cohorts}
+    problems = compare(tables["workers"], tables["serial"], atol=0)
+    for problem in problems:
+        print("MISMATCH", problem)
+    print("Serial and worker outputs match." if not problems else f"{len(problems)} mismatches.")
+    return not problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run funnel analysis and EDA in parallel.")
+    parser.add_argument("--workers", type=int, default=N_WORKERS)
+    parser.add_argument("--check", action="store_true", help="compare the worker and serial KPI tables instead of writing")
+    args = parser.parse_args()
+    print("Loading cleaned events...")
+    if args.check:
+        sys.exit(0 if check(read_compact_events()) else 1)
+    run(read_compact_events(), args.workers)
+
+
+if __name__ == "__main__":
+    main()
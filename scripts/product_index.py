@@ -0,0 +1,91 @@
+"""
+Product dimension index for purchase rollups (EDA, dashboard drill-down top-N).
+Each product_id maps to a dense position; price, name codes and category codes are NumPy arrays
+aligned with it. Joining purchases to the catalog is then a gather of positions, and per-product
+or per-category rollups are bincounts over those positions, with no hash merge or string groupby.
+Tables built from the index carry the catalog frame's attrs (e.g. which ID columns are coded).
+"""
+import numpy as np
+import pandas as pd
+
+
+class ProductIndex:
+    def __init__(self, products: pd.DataFrame):
+        products = products.drop_duplicates(subset=["product_id"]).reset_index(drop=True)
+        self.product_ids = pd.Index(products["product_id"])
+        self.attrs = dict(products.attrs)
+        self.price = products["price"].to_numpy(dtype=float)
+        self.name_codes, self.names = self._codes(products["product_name"])          # -1 = no name
+        self.category_codes, self.categories = self._codes(products["category"])     # -1 = no category
+
+    @staticmethod
+    def _codes(values: pd.Series):
+        codes, uniques = pd.factorize(values)
+        return codes, pd.Index(np.asarray(uniques))
+
+    def __len__(self) -> int:
+        return len(self.product_ids)
+
+    def positions(self, product_ids) -> np.ndarray:
+        """Dense product positions for product ids (-1 = not in the catalog or missing)."""
+        return self.product_ids.get_indexer(product_ids)
+
+    def table(self, columns: dict) -> pd.DataFrame:
+        """DataFrame from `columns` with the catalog frame's attrs."""
+        frame = pd.DataFrame(columns)
+        frame.attrs.update(self.attrs)
+        return frame
+
+    def revenue(self, positions: np.ndarray, quantity: np.ndarray) -> np.ndarray:
+        """quantity x price per row (NaN for products not in the catalog)."""
+        return np.where(positions >= 0, np.asarray(quantity, dtype=float) * self.price[positions], np.nan)
+
+    def attributes(self, positions: np.ndarray) -> dict:
+        """product_name, category (categoricals) and price gathered for each row."""
+        known = positions >= 0
+        return {
+            "product_name": pd.Categorical.from_codes(np.where(known, self.name_codes[positions], -1), self.names),
+            "category": pd.Categorical.from_codes(np.where(known, self.category_codes[positions], -1), self.categories),
+            "price": np.where(known, self.price[positions], np.nan),
+        }
+
+    def top_products(self, positions: np.ndarray, quantity: np.ndarray, n: int = None) -> pd.DataFrame:
+        """Units and revenue per purchased product with a name and category, by revenue (as top_products.csv)."""
+        known = positions >= 0
+        rows = np.bincount(positions[known], minlength=len(self))
+        units = np.bincount(positions[known], weights=np.asarray(quantity, dtype=float)[known], minlength=len(self))
+        revenue = units * self.price
+        sold = np.flatnonzero((rows > 0) & (self.name_codes >= 0) & (self.category_codes >= 0))
+        top = sold[np.argsort(-revenue[sold], kind="stable")[:n]]
+        return self.table({
+            "product_id": self.product_ids[top],
+            "product_name": self.names[self.name_codes[top]],
+            "category": self.categories[self.category_codes[top]],
+            "units_sold": units[top].astype(np.int64),
+            "revenue": revenue[top],
+        })
+
+    def by_category(self, positions: np.ndarray, quantity: np.ndarray, session_codes: np.ndarray) -> pd.DataFrame:
+        """Units, revenue and distinct ordering sessions (session_codes, -1 = none) per category, by revenue."""
+        category = np.where(positions >= 0, self.category_codes[positions], -1)
+        known = category >= 0
+        cat, pos, qty = category[known], positions[known], np.asarray(quantity, dtype=float)[known]
+        n = len(self.categories)
+        rows = np.bincount(cat, minlength=n)
+        units = np.bincount(cat, weights=qty, minlength=n)
+        revenue = np.bincount(cat, weights=qty * self.price[pos], minlength=n)
+        # Distinct (category, session) pairs: sort the combined keys and keep the first of each run
+        sessions = np.asarray(session_codes)[known]
+        ordered = sessions >= 0
+        span = int(sessions.max(initial=-1)) + 1
+        pairs = np.sort(cat[ordered].astype(np.int64) * span + sessions[ordered])
+        pairs = pairs[np.r_[True, pairs[1:] != pairs[:-1]]] if len(pairs) else pairs
+        orders = np.bincount(pairs // max(span, 1), minlength=n)
+        present = np.flatnonzero(rows > 0)
+        present = present[np.argsort(-revenue[present], kind="stable")]
+        return pd.DataFrame({
+            "category": self.categories[present],
+            "units_sold": units[present].astype(np.int64),
+            "revenue": revenue[present],
+            "orders": orders[present],
+        })
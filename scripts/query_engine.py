@@ -0,0 +1,123 @@
+"""
+Embedded query engine over the cleaned events for interactive drill-down (dashboard sidebar filters).
+Events are held as time-sorted NumPy columns: a date range is a searchsorted row slice, and each
+segment value (region, device, campaign_source) has a packed row bitmap that filters AND/OR together.
+Funnel, daily revenue and top-product queries then reduce the selected rows with bincounts.
+"""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import sys
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from config import FUNNEL_STAGES, SEGMENT_COLUMNS
+
+from funnel_analysis import conversion_rates, ordered_reach
+from product_index import ProductIndex
+from storage import read_events, read_products
+
+QUERY_COLUMNS = ["session_id", "event_type", "product_id", "quantity", "timestamp"] + SEGMENT_COLUMNS
+PURCHASE = FUNNEL_STAGES.index("purchase")
+NS_PER_DAY = 86_400 * 10**9
+
+
+class EventQueryEngine:
+    def __init__(self, events: pd.DataFrame, products: pd.DataFrame):
+        # Encode on the unsorted columns (categoricals/strings factorize fastest as Series), then reorder codes
+        ts = events["timestamp"].to_numpy().astype("datetime64[ns]").view("int64")
+        order = np.argsort(ts, kind="stable")
+        self.ts = ts[order]
+        self.n_rows = len(order)
+        session_codes, self.session_ids = pd.factorize(events["session_id"])
+        self.session_codes = session_codes.astype(np.int32)[order]
+        self.stage_codes = pd.Categorical(events["event_type"], categories=FUNNEL_STAGES).codes[order]
+
+        self.products = products if isinstance(products, ProductIndex) else ProductIndex(products)
+        self.product_codes = self.products.positions(events["product_id"])[order]
+        self.quantity = events["quantity"].to_numpy(dtype=float)[order]
+
+        # Packed row bitmaps per segment value: 1 bit per event
+        self.bitmaps = {}
+        for col in SEGMENT_COLUMNS:
+            if col not in events.columns:
+                continue
+            codes, values = pd.factorize(events[col], sort=True)
+            codes = codes[order]
+            self.bitmaps[col] = {v: np.packbits(codes == i) for i, v in enumerate(values)}
+
+    @classmethod
+    def from_storage(cls):
+        return cls(read_events(columns=QUERY_COLUMNS), read_products(columns=["product_id", "product_name", "category", "price"]))
+
+    def options(self) -> dict:
+        """Filter choices: segment values per column and the date range covered."""
+        first, last = (pd.Timestamp(self.ts[0]), pd.Timestamp(self.ts[-1])) if self.n_rows else (None, None)
+        return {"segments": {col: list(maps) for col, maps in self.bitmaps.items()}, "start": first, "end": last}
+
+    def _rows(self, start=None, end=None, filters=None) -> np.ndarray:
+        """Row positions with start <= timestamp < end matching every segment filter {col: [values]}."""
+        lo = np.searchsorted(self.ts, pd.Timestamp(start).value) if start is not None else 0
+        hi = np.searchsorted(self.ts, pd.Timestamp(end).value) if end is not None else self.n_rows
+        if hi <= lo:
+            return np.empty(0, dtype=np.int64)
+        mask = None
+        first_byte, skip = divmod(lo, 8)
+        last_byte = (hi + 7) // 8
+        for col, values in (filters or {}).items():
+            if not values or col not in self.bitmaps:
+                continue
+            col_bits = np.zeros(last_byte - first_byte, dtype=np.uint8)
+            for value in values:
+                bits = self.bitmaps[col].get(value)
+                if bits is not None:
+                    col_bits |= bits[first_byte:last_byte]
+            mask = col_bits if mask is None else mask & col_bits
+        if mask is None:
+            return np.arange(lo, hi)
+        selected = np.unpackbits(mask)[skip: skip + hi - lo].astype(bool)
+        return lo + np.flatnonzero(selected)
+
+    def funnel(self, start=None, end=None, filters=None) -> pd.DataFrame:
+        """Ordered funnel (same columns as funnel_conversion_rates.csv) for the selected events."""
+        rows = self._rows(start, end, filters)
+        stages = self.stage_codes[rows]
+        known = stages >= 0
+        # Sessions without selected events keep an all-False row and count nowhere
+        reach = np.zeros((len(self.session_ids), len(FUNNEL_STAGES)), dtype=bool)
+        reach[self.session_codes[rows][known], stages[known]] = True
+        counts = ordered_reach(reach).sum(axis=0)
+        return conversion_rates(pd.DataFrame({"stage": FUNNEL_STAGES, "count": counts}))
+
+    def _purchases(self, start, end, filters):
+        rows = self._rows(start, end, filters)
+        rows = rows[self.stage_codes[rows] == PURCHASE]
+        products, quantity = self.product_codes[rows], self.quantity[rows]
+        return rows, products, quantity, self.products.revenue(products, quantity)
+
+    def daily_revenue(self, start=None, end=None, filters=None) -> pd.DataFrame:
+        """Revenue, distinct ordering sessions and units per day (as daily_revenue.csv)."""
+        rows, _, quantity, revenue = self._purchases(start, end, filters)
+        if len(rows) == 0:
+            return pd.DataFrame(columns=["date", "revenue", "orders", "units"])
+        day = self.ts[rows] // NS_PER_DAY
+        first_day = day.min()
+        day = day - first_day
+        n_days = int(day.max()) + 1
+        # Purchases without a session (code -1) add revenue and units but no order, as nunique skips them
+        sessions = self.session_codes[rows]
+        in_session = sessions >= 0
+        stride = len(self.session_ids) + 1
+        orders_key = np.unique(day[in_session] * stride + sessions[in_session])
+        daily = pd.DataFrame({
+            "date": pd.to_datetime((first_day + np.arange(n_days)) * NS_PER_DAY),
+            "revenue": np.bincount(day, weights=np.nan_to_num(revenue), minlength=n_days),
+            "orders": np.bincount(orders_key // stride, minlength=n_days),
+            "units": np.bincount(day, weights=quantity, minlength=n_days).astype(int),
+        })
+        return daily[np.bincount(day, minlength=n_days) > 0].reset_index(drop=True)
+
+    def top_products(self, n: int = 15, start=None, end=None, filters=None) -> pd.DataFrame:
+        """Top-n products by revenue (as top_products.csv)."""
+        _, products, quantity, _ = self._purchases(start, end, filters)
+        return self.products.top_products(products, quantity, n)
@@ -1,30 +1,269 @@
 """
-Run full pipeline: generate sample data -> clean -> funnel -> EDA.
-Execute from project root: python scripts/run_pipeline.py
+Run full pipeline: generate sample data -> clean -> funnel + EDA + cohorts + baskets (in parallel) -> funnel chart.
+Execute from project root: python scripts/run_pipeline.py [--force] [--skip-generate] [--workers N] [--trace]
+                                                        [--raw-input csv|shards]
+Incremental (only newly arrived raw events): python scripts/run_pipeline.py --incremental
+SQL metric definitions (DuckDB over the cleaned layer): python scripts/run_pipeline.py --backend sql
+
+Steps run in one process as a DAG and hand DataFrames to each other in memory. A step is skipped
+when the content hashes of its code and input files match its last successful run.
 """
-import subprocess
+import argparse
+import hashlib
+import json
 import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 PROJECT_ROOT = Path(__file__).resolve().parent.parent
+SCRIPTS = PROJECT_ROOT / "scripts"
+sys.path.insert(0, str(PROJECT_ROOT))
+sys.path.insert(0, str(SCRIPTS))
+from config import CHART_FORMAT, CLEANED_FORMAT, DATA_CLEANED, DATA_RAW, OUTPUTS, RAW_EVENTS_INPUT, RAW_SHARD_DIR, STATE_DIR
+
+import instrument
+from instrument import PeakRSS, rss_mb, span
+
+CACHE_FILE = STATE_DIR / "pipeline_cache.json"
+CLEANED_EVENTS = DATA_CLEANED / ("events" if CLEANED_FORMAT == "parquet" else "events_cleaned.csv")
+CLEANED_PRODUCTS = DATA_CLEANED / f"products_cleaned.{CLEANED_FORMAT}"
+RAW_FILES = [DATA_RAW / "events.csv", DATA_RAW / "products.csv"]
+# Run options that change what a stage computes; part of that stage's cache key
+STAGE_OPTIONS = {"clean": {"raw_input": RAW_EVENTS_INPUT, "allow_partial": False}}
+
+
+def _generate(upstream):
+    import generate_sample_data
+    products, events = generate_sample_data.run()
+    return events, products
+
+
+def _clean(upstream):
+    import data_cleaning
+    import schema
+    if STAGE_OPTIONS["clean"]["raw_input"] == "shards":
+        import shard_loader
+        # Sharded raw events (data/raw/events/) are cleaned straight into the cleaned layer
+        shard_loader.run(allow_partial=STAGE_OPTIONS["clean"]["allow_partial"])
+        return schema.read_compact_events(), schema.read_compact_products()
+    raw = upstream.get("generate")
+    events, products = raw if raw is not None else data_cleaning.load_raw_data()
+    events, products = data_cleaning.run(events, products)
+    # Downstream stages share the compact (coded) frames
+    return schema.compact_events(events), schema.compact_products(products)
+
+
+def _user_index(upstream):
+    from schema import read_compact_events
+    from user_index import UserSessionIndex
+    cleaned = upstream.get("clean")
+    events = cleaned[0] if cleaned is not None else read_compact_events(columns=["session_id", "user_id", "timestamp"])
+    return UserSessionIndex.from_events(events)
+
+
+def _funnel(upstream):
+    import funnel_analysis
+    cleaned = upstream.get("clean")
+    events = cleaned[0] if cleaned is not None else funnel_analysis.load_cleaned_data()
+    funnel_analysis.run(events, index=upstream.get("user_index"))
+
+
+def _eda(upstream):
+    import eda
+    cleaned = upstream.get("clean")
+    events, products = cleaned if cleaned is not None else eda.load_data()
+    eda.run(events, products, funnel_chart=False, index=upstream.get("user_index"))
+
+
+def _cohorts(upstream):
+    import cohorts
+    from schema import read_compact_events
+    cleaned = upstream.get("clean")
+    events = cleaned[0] if cleaned is not None else read_compact_events(columns=cohorts.COHORT_COLUMNS)
+    cohorts.run(events, index=upstream.get("user_index"))
+
+
+def _baskets(upstream):
+    import basket_analysis
+    cleaned = upstream.get("clean")
+    if cleaned is None:
+        return basket_analysis.main()
+    basket_analysis.run(*cleaned)
+
+
+def _funnel_chart(upstream):
+    import eda
+    eda.render_funnel_chart()
+
 
-def run(script: str, name: str) -> bool:
+def _parallel_analysis(upstream, workers=1):
+    import parallel_analysis
+    cleaned = upstream.get("clean")
+    events, products = cleaned if cleaned is not None else (None, None)
+    parallel_analysis.run(events, workers, products)
+
+
+def _sql_analysis(upstream):
+    import sql_backend
+    sql_backend.run()
+
+
+# name: (function, dependencies, code files, input paths, output paths)
+STAGES = {
+    "generate": (_generate, [], ["generate_sample_data.py"], [], RAW_FILES),
+    "clean": (_clean, ["generate"], ["data_cleaning.py", "shard_loader.py", "sessionize.py", "instrument.py", "schema.py", "storage.py"],
+              RAW_FILES + [RAW_SHARD_DIR],
+              [CLEANED_EVENTS, CLEANED_PRODUCTS]),
+    # In-memory only: shared by funnel, eda and cohorts when they run together (each builds its own otherwise)
+    "user_index": (_user_index, ["clean"], ["user_index.py", "schema.py", "storage.py"], [CLEANED_EVENTS], []),
+    "funnel": (_funnel, ["clean", "user_index"], ["funnel_analysis.py", "instrument.py", "user_index.py", "schema.py", "storage.py"],
+               [CLEANED_EVENTS], [OUTPUTS / "funnel_conversion_rates.csv"]),
+    "eda": (_eda, ["clean", "user_index"], ["eda.py", "charts.py", "instrument.py", "product_index.py", "user_index.py", "schema.py", "storage.py"],
+            [CLEANED_EVENTS, CLEANED_PRODUCTS], [OUTPUTS / "top_products.csv", OUTPUTS / "kpis.csv"]),
+    "cohorts": (_cohorts, ["clean", "user_index"], ["cohorts.py", "funnel_analysis.py", "instrument.py", "user_index.py", "schema.py", "storage.py"],
+                [CLEANED_EVENTS], [OUTPUTS / "cohort_retention.csv", OUTPUTS / "funnel_daily.csv"]),
+    "baskets": (_baskets, ["clean"], ["basket_analysis.py", "instrument.py", "product_index.py", "schema.py", "storage.py"],
+                [CLEANED_EVENTS, CLEANED_PRODUCTS], [OUTPUTS / "product_pairs.csv", OUTPUTS / "category_pairs.csv"]),
+    "funnel_chart": (_funnel_chart, ["funnel", "eda", "sql"], ["eda.py", "charts.py", "instrument.py"], [OUTPUTS / "funnel_conversion_rates.csv"],
+                     [OUTPUTS / f"funnel_chart.{CHART_FORMAT}"]),
+    # Replaces funnel/eda/funnel_chart when --workers > 1
+    "analysis": (_parallel_analysis, ["clean"],
+                 ["parallel_analysis.py", "funnel_analysis.py", "eda.py", "charts.py", "instrument.py", "product_index.py",
+                  "user_index.py", "schema.py", "storage.py"],
+                 [CLEANED_EVENTS, CLEANED_PRODUCTS],
+                 [OUTPUTS / "funnel_conversion_rates.csv", OUTPUTS / "top_products.csv", OUTPUTS / "kpis.csv"]),
+    # Replaces funnel/eda with sql/funnel_and_kpis.sql when --backend sql
+    "sql": (_sql_analysis, ["clean"], ["sql_backend.py", "eda.py", "funnel_analysis.py", "cohorts.py", "charts.py", "instrument.py",
+                                      "product_index.py", "user_index.py", "schema.py", "storage.py"],
+            [CLEANED_EVENTS, CLEANED_PRODUCTS, PROJECT_ROOT / "sql" / "funnel_and_kpis.sql"],
+            [OUTPUTS / "funnel_conversion_rates.csv", OUTPUTS / "top_products.csv", OUTPUTS / "kpis.csv"]),
+}
+SERIAL_ANALYSIS = ["funnel", "eda", "funnel_chart"]
+
+
+def _hash_paths(digest, paths):
+    for path in paths:
+        files = sorted(p for p in path.rglob("*") if p.is_file()) if path.is_dir() else [path]
+        for f in files:
+            digest.update(str(f.relative_to(PROJECT_ROOT)).encode())
+            if f.exists():
+                with open(f, "rb") as fh:
+                    for block in iter(lambda: fh.read(1 << 20), b""):
+                        digest.update(block)
+
+
+def stage_key(name: str) -> str:
+    """Content hash of a stage's code (plus config.py), its run options and its current input files."""
+    _, _, code, inputs, _ = STAGES[name]
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(json.dumps(STAGE_OPTIONS.get(name, {}), sort_keys=True).encode())
+    _hash_paths(digest, [PROJECT_ROOT / "config.py"] + [SCRIPTS / c for c in code])
+    _hash_paths(digest, inputs)
+    return digest.hexdigest()
+
+
+def waves(selected):
+    """Stages grouped into dependency levels; stages within a level run in parallel."""
+    done, levels = set(), []
+    pending = [s for s in STAGES if s in selected]
+    while pending:
+        level = [s for s in pending if all(d in done or d not in selected for d in STAGES[s][1])]
+        levels.append(level)
+        done.update(level)
+        pending = [s for s in pending if s not in level]
+    return levels
+
+
+def run_stage(name, results, cache, force, workers=1):
+    func, deps, _, _, outputs = STAGES[name]
+    key = stage_key(name)
+    if not force and cache.get(name) == key and all(p.exists() for p in outputs):
+        return name, "cached", 0.0, None, None
     print(f"\n--- {name} ---")
-    r = subprocess.run([sys.executable, str(PROJECT_ROOT / "scripts" / script)], cwd=PROJECT_ROOT)
-    return r.returncode == 0
+    start = time.perf_counter()
+    upstream = {d: results.get(d) for d in deps}
+    # RSS sampled over this stage's own run: its peak, and the growth over the RSS it started at
+    sampler = PeakRSS()
+    start_mb = sampler.peak
+    sampler.start()
+    try:
+        with span(f"stage.{name}"):
+            results[name] = func(upstream, workers) if name == "analysis" else func(upstream)
+    finally:
+        sampler.stop()
+    peak_mb = None if start_mb is None else max(sampler.peak, rss_mb() or 0.0)
+    # Re-hash after running: a stage may write its own inputs (generate) or outputs other stages read
+    cache[name] = stage_key(name)
+    return name, "ran", time.perf_counter() - start, peak_mb, None if peak_mb is None else peak_mb - start_mb
+
+
+def run_dag(selected, force=False, workers=1):
+    cache = json.loads(CACHE_FILE.read_text()) if CACHE_FILE.exists() else {}
+    results, report = {}, []
+    for level in waves(selected):
+        with ThreadPoolExecutor(max_workers=len(level)) as pool:
+            report.extend(pool.map(lambda s: run_stage(s, results, cache, force, workers), level))
+        CACHE_FILE.write_text(json.dumps(cache, indent=2))
+    return report
+
+
+def print_report(report):
+    """Per stage: wall seconds, peak process RSS while it ran and growth over its starting RSS
+    (stages in one dependency level run concurrently, so their peaks overlap; growth is the stage's own)."""
+    print("\nStage         Status   Seconds   Peak RSS MB   Growth MB")
+    for name, status, secs, peak_mb, growth_mb in report:
+        peak = f"{peak_mb:8.1f}" if peak_mb is not None else "       -"
+        growth = f"{growth_mb:8.1f}" if growth_mb is not None else "       -"
+        print(f"{name:<13} {status:<7} {secs:8.2f}  {peak}      {growth}")
+
 
 def main():
-    steps = [
-        ("generate_sample_data.py", "Generate sample data"),
-        ("data_cleaning.py", "Data cleaning"),
-        ("funnel_analysis.py", "Funnel analysis"),
-        ("eda.py", "EDA & visualizations"),
-    ]
-    for script, name in steps:
-        if not run(script, name):
-            print(f"Pipeline failed at: {name}")
-            sys.exit(1)
+    parser = argparse.ArgumentParser(description="Run the analytics pipeline.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="process only raw events appended since the last run (see scripts/incremental.py)")
+    parser.add_argument("--force", action="store_true", help="re-run every stage, ignoring cached results")
+    parser.add_argument("--skip-generate", action="store_true", help="use existing raw data in data/raw/")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="run funnel/EDA aggregations and charts in N worker processes")
+    parser.add_argument("--backend", choices=["pandas", "sql"], default="pandas",
+                        help="compute funnel/EDA outputs with pandas or with sql/funnel_and_kpis.sql (DuckDB)")
+    parser.add_argument("--raw-input", choices=["csv", "shards"], default=RAW_EVENTS_INPUT,
+                        help="raw events to clean: data/raw/events.csv or the shards under data/raw/events/")
+    parser.add_argument("--allow-partial", action="store_true",
+                        help="with --raw-input shards, continue when some shards fail to load")
+    parser.add_argument("--trace", action="store_true",
+                        help="record stage and sub-step spans to data/state/traces/ (see scripts/instrument.py)")
+    parser.add_argument("--profile", action="store_true", help="--trace plus sampled Python stacks")
+    args = parser.parse_args()
+    if args.trace or args.profile:
+        instrument.enable(profile=args.profile)
+    STAGE_OPTIONS["clean"].update(raw_input=args.raw_input, allow_partial=args.allow_partial)
+
+    if args.incremental:
+        import incremental
+        incremental.main()
+        print("\nIncremental update complete.")
+        return
+
+    skipped = {"generate"} if args.skip_generate else set()
+    if args.backend == "sql":
+        skipped |= {"funnel", "eda", "analysis"}
+    else:
+        skipped |= {"sql"} | (set(SERIAL_ANALYSIS) if args.workers > 1 else {"analysis"})
+    selected = [s for s in STAGES if s not in skipped]
+    try:
+        report = run_dag(selected, force=args.force, workers=args.workers)
+    except Exception:
+        traceback.print_exc()
+        print("Pipeline failed.")
+        instrument.finish()
+        sys.exit(1)
+    print_report(report)
+    instrument.finish()
     print("\nPipeline complete. Run dashboard with: streamlit run scripts/dashboard_app.py")
 
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,217 @@
+"""
+Compact in-memory schema for cleaned events and products:
+- ID columns (event_id, session_id, user_id, product_id) -> nullable int32 codes; the id <-> code
+  lookup tables are persisted in data/state/ids/<column>.parquet and only ever appended to, so codes
+  are stable across runs and incremental batches. Appends hold a file lock (<column>.lock) and re-read
+  the table first, so processes encoding at once never hand out one code to two ids
+- Low-cardinality dimensions (event_type, region, device, campaign_source, category, product_name)
+  -> categoricals
+- Integer columns downcast to the smallest type that holds them (floats stay float64 so revenue
+  sums match the SQL backend exactly)
+Funnel and EDA code works on the codes; decode_ids() restores the ids when a report is written.
+Coded columns are listed in frame.attrs["encoded_ids"] (kept by selections and filters), not guessed from
+the dtype, so raw integer IDs are still encoded and never decoded as codes.
+Run from project root: python scripts/schema.py  (prints memory per column, string vs compact)
+"""
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import sys
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from config import STATE_DIR
+
+from storage import read_events, read_products, typed_events
+
+ID_COLUMNS = ["event_id", "session_id", "user_id", "product_id"]
+PRODUCT_CATEGORICALS = ["product_name", "category"]
+ID_DIR = STATE_DIR / "ids"
+ENCODED_ATTR = "encoded_ids"  # frame.attrs key: ID columns that hold lookup codes
+
+_lookups = {}
+_lock = threading.Lock()  # pipeline stages run in threads and may encode concurrently
+
+
+@contextmanager
+def _file_lock(path: Path):
+    """Exclusive lock on `path` across processes (flock; a no-op where fcntl is unavailable)."""
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class IdLookup:
+    """Append-only id -> int32 code table for one ID column."""
+
+    def __init__(self, column: str, root: Path = ID_DIR):
+        self.path = root / f"{column}.parquet"
+        self.lock_path = root / f"{column}.lock"
+        self.reload()
+
+    def reload(self):
+        """Re-read the persisted table (a superset of this copy when another process appended)."""
+        self.ids = pd.Index(pd.read_parquet(self.path)["id"] if self.path.exists() else [], dtype="str")
+
+    def save(self):
+        """Write the table atomically through a uniquely named temp file (call with the file lock held)."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=self.path.parent, prefix=f"{self.path.stem}-", suffix=".tmp",
+                                         delete=False) as tmp:
+            pass
+        try:
+            pd.DataFrame({"id": self.ids}).to_parquet(tmp.name, index=False)
+            os.replace(tmp.name, self.path)
+        except BaseException:
+            Path(tmp.name).unlink(missing_ok=True)
+            raise
+
+    def encode(self, values) -> np.ndarray:
+        """int32 codes for ids (-1 = missing); unseen ids get the next free codes."""
+        codes, uniques = pd.factorize(values)
+        uniques = pd.Index(np.asarray(uniques, dtype=object), dtype="str")
+        known = self.ids.get_indexer(uniques)
+        if (known < 0).any():
+            with _file_lock(self.lock_path):
+                # Another process may have appended since this copy was read: extend its table, not ours
+                self.reload()
+                known = self.ids.get_indexer(uniques)
+                new = known < 0
+                if new.any():
+                    known[new] = len(self.ids) + np.arange(int(new.sum()))
+                    self.ids = self.ids.append(uniques[new])
+                    self.save()
+        return np.where(codes >= 0, known.astype(np.int32)[codes], np.int32(-1))
+
+    def decode(self, codes) -> np.ndarray:
+        """Ids for codes (None where missing)."""
+        codes = pd.array(codes, dtype="Int32").to_numpy(dtype=np.int64, na_value=-1)
+        if codes.max(initial=-1) >= len(self.ids):  # codes handed out by another process since the last read
+            self.reload()
+        ids = self.ids.to_numpy(dtype=object).take(np.maximum(codes, 0)) if len(self.ids) else np.full(len(codes), None)
+        ids[codes < 0] = None
+        return ids
+
+
+def lookup(column: str) -> IdLookup:
+    """The process-wide lookup for an ID column."""
+    if column not in _lookups:
+        _lookups[column] = IdLookup(column)
+    return _lookups[column]
+
+
+@contextmanager
+def lookups_in(root: Path):
+    """Encode with lookup tables under `root` instead of data/state/ids (e.g. benchmark datasets)."""
+    with _lock:
+        saved = dict(_lookups)
+        _lookups.clear()
+        _lookups.update({col: IdLookup(col, root) for col in ID_COLUMNS})
+    try:
+        yield
+    finally:
+        with _lock:
+            _lookups.clear()
+            _lookups.update(saved)
+
+
+def _nullable(codes: np.ndarray) -> pd.arrays.IntegerArray:
+    return pd.arrays.IntegerArray(codes, codes < 0)
+
+
+def is_encoded(frame: pd.DataFrame, column: str) -> bool:
+    """True if `column` of `frame` holds lookup codes (marked by encode_ids or mark_encoded)."""
+    return column in frame.attrs.get(ENCODED_ATTR, ())
+
+
+def mark_encoded(frame: pd.DataFrame, columns) -> pd.DataFrame:
+    """Record `columns` as coded IDs on `frame` (e.g. frames rebuilt from already coded data); returns frame."""
+    frame.attrs[ENCODED_ATTR] = sorted(set(frame.attrs.get(ENCODED_ATTR, ())) | set(columns))
+    return frame
+
+
+def encode_ids(frame: pd.DataFrame) -> pd.DataFrame:
+    """Replace the ID columns of `frame` with nullable int32 codes (in place; returns frame)."""
+    with _lock:
+        for col in ID_COLUMNS:
+            if col in frame.columns and not is_encoded(frame, col):
+                frame[col] = _nullable(lookup(col).encode(frame[col]))
+                mark_encoded(frame, [col])
+    return frame
+
+
+def decode_ids(frame: pd.DataFrame) -> pd.DataFrame:
+    """Copy of `frame` with coded ID columns mapped back to their ids (for writing reports)."""
+    frame = frame.copy()
+    decoded = []
+    with _lock:
+        for col in ID_COLUMNS:
+            if col in frame.columns and is_encoded(frame, col):
+                frame[col] = pd.array(lookup(col).decode(frame[col]), dtype="str")
+                decoded.append(col)
+    frame.attrs[ENCODED_ATTR] = [c for c in frame.attrs.get(ENCODED_ATTR, ()) if c not in decoded]
+    return frame
+
+
+def downcast_integers(frame: pd.DataFrame) -> pd.DataFrame:
+    for col in frame.columns:
+        dtype = frame[col].dtype
+        if col not in ID_COLUMNS and pd.api.types.is_integer_dtype(dtype) and isinstance(dtype, np.dtype):
+            frame[col] = pd.to_numeric(frame[col], downcast="integer")
+    return frame
+
+
+def compact_events(events: pd.DataFrame) -> pd.DataFrame:
+    """Cleaned events with coded IDs, categorical dimensions and downcast integers."""
+    return downcast_integers(encode_ids(typed_events(events)))
+
+
+def compact_products(products: pd.DataFrame) -> pd.DataFrame:
+    """Products with a coded product_id (same codes as the events) and categorical name/category."""
+    products = encode_ids(products.copy())
+    for col in PRODUCT_CATEGORICALS:
+        if col in products.columns:
+            products[col] = products[col].astype("category")
+    return downcast_integers(products)
+
+
+def read_compact_events(columns=None, start=None, end=None, event_types=None) -> pd.DataFrame:
+    """storage.read_events in the compact schema (IDs are dictionary-encoded while reading)."""
+    return compact_events(read_events(columns=columns, start=start, end=end, event_types=event_types,
+                                      dictionary_columns=ID_COLUMNS))
+
+
+def read_compact_products(columns=None) -> pd.DataFrame:
+    return compact_products(read_products(columns=columns))
+
+
+def memory_report(events: pd.DataFrame, compact: pd.DataFrame) -> pd.DataFrame:
+    """Bytes per column before and after compaction."""
+    report = pd.DataFrame({"dtype": events.dtypes.astype(str), "mb": events.memory_usage(deep=True, index=False) / 1e6,
+                           "compact_dtype": compact.dtypes.astype(str),
+                           "compact_mb": compact.memory_usage(deep=True, index=False) / 1e6})
+    report.loc["total"] = ["", report["mb"].sum(), "", report["compact_mb"].sum()]
+    return report.round(2)
+
+
+def main():
+    print("Loading cleaned events...")
+    events = read_events()
+    print(memory_report(events, compact_events(events)).to_string())
+
+
+if __name__ == "__main__":
+    main()
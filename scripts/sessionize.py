@@ -0,0 +1,282 @@
+"""
+Sessionization: derive session IDs from the clickstream by inactivity gap instead of trusting the upstream session_id.
+- Events are ordered by (user_id, timestamp); a session starts at a user's first event and at every event more
+  than SESSION_GAP_MINUTES after the user's previous one (a diff and cumsum over the sorted arrays, no per-user loop)
+- A derived session_id is "<user_id>-<start, epoch seconds>", so it does not depend on chunking or row order
+- Out of core: the cleaned layer is split into user-hash buckets of about SESSIONIZE_MEMORY_MB, each bucket is
+  sorted and sessionized as one chunk, and the cleaned layer is rewritten with the derived IDs
+- The clean step runs it per SESSIONIZE ("auto": when session_id is absent or missing on some rows)
+Rows without a user_id cannot be sessionized and are dropped.
+Run from project root: python scripts/sessionize.py [--gap-minutes 30] [--memory-mb 1024]
+"""
+import argparse
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import sys
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from config import CLEANED_FORMAT, DATA_CLEANED, SESSION_GAP_MINUTES, SESSIONIZE, SESSIONIZE_MEMORY_MB, STATE_DIR
+
+from instrument import span, traced
+from storage import events_dataset, events_exist, read_events, write_events
+
+SCRATCH_DIR = STATE_DIR / "sessionize"
+# Sorting a bucket holds a few copies of it (sort keys, the reordered frame, derived IDs)
+_SORT_COPIES = 4
+
+
+def session_starts(user_codes: np.ndarray, ts: np.ndarray, gap_ns: int) -> np.ndarray:
+    """True where a session starts, for events sorted by (user, timestamp): a user's first event or a gap over gap_ns."""
+    new = np.ones(len(user_codes), dtype=bool)
+    new[1:] = (user_codes[1:] != user_codes[:-1]) | (np.diff(ts) > gap_ns)
+    return new
+
+
+def session_ids(users, start_ns: np.ndarray):
+    """Arrow string array of "<user_id>-<start epoch seconds>" (built in Arrow, not per row in Python)."""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    seconds = pc.cast(pa.array(start_ns // 10**9), pa.string())
+    return pc.binary_join_element_wise(pa.array(users, pa.string()), seconds, "-")
+
+
+def _epoch_ns(timestamps: pd.Series) -> np.ndarray:
+    return timestamps.to_numpy("datetime64[ns]").view("i8")
+
+
+class Sessionizer:
+    """Session IDs for events arriving in (user_id, timestamp) order, over one chunk or many.
+
+    The session still open at the end of a chunk continues into the next chunk when the same user's next
+    event is within the gap.
+    """
+
+    def __init__(self, gap_minutes: float = SESSION_GAP_MINUTES):
+        self.gap_ns = int(gap_minutes * 60 * 10**9)
+        self.sessions = 0
+        self._open = None  # (user_id, last event ns, session id) at the end of the previous chunk
+
+    def assign(self, users: pd.Series, timestamps: pd.Series) -> pd.Series:
+        """Derived session_id per event; users/timestamps must continue the (user, timestamp) order."""
+        codes, uniques = pd.factorize(users)
+        ids = self.assign_codes(codes, uniques, _epoch_ns(timestamps)).to_pandas()
+        return pd.Series(ids.to_numpy(), index=users.index, name="session_id")
+
+    def assign_codes(self, codes: np.ndarray, uniques, ts: np.ndarray):
+        """Arrow array of session ids for sorted user codes (positions in `uniques`) and epoch-ns timestamps."""
+        import pyarrow as pa
+
+        if len(codes) == 0:
+            return pa.array([], pa.string())
+        new = session_starts(codes, ts, self.gap_ns)
+        carried = self._open is not None and uniques[codes[0]] == self._open[0] and ts[0] - self._open[1] <= self.gap_ns
+        if carried:
+            new[0] = False
+        starts = np.flatnonzero(new)
+        ids = session_ids(np.asarray(uniques)[codes[starts]], ts[starts])
+        if carried:
+            ids = pa.concat_arrays([pa.array([self._open[2]], pa.string()), ids])
+        # Rows before the first start in this chunk belong to the carried session (id 0)
+        session = np.cumsum(new) - (0 if carried else 1)
+        self.sessions += len(starts)
+        self._open = (uniques[codes[-1]], ts[-1], ids[int(session[-1])].as_py())
+        return ids.take(pa.array(session))
+
+
+def needed(events: pd.DataFrame, mode: str = SESSIONIZE) -> bool:
+    """Whether SESSIONIZE mode calls for deriving sessions for these events."""
+    if mode == "always":
+        return True
+    if mode == "never":
+        return False
+    return "session_id" not in events.columns or bool(events["session_id"].isna().any())
+
+
+def agreement(upstream: pd.Series, derived: pd.Series) -> dict:
+    """Upstream vs derived session counts, and how many upstream sessions are exactly one derived session.
+
+    Rows are matched by index; derived may be a reordered subset of upstream's rows (as sessionize returns).
+    """
+    upstream = upstream.loc[derived.index]
+    known = upstream.notna().to_numpy()
+    up, _ = pd.factorize(upstream[known])
+    down, _ = pd.factorize(derived[known])
+    pairs = np.unique(up.astype(np.int64) << 32 | down.astype(np.int64))
+    pair_up, pair_down = pairs >> 32, pairs & 0xFFFFFFFF
+    one_to_one = (np.bincount(pair_up)[pair_up] == 1) & (np.bincount(pair_down)[pair_down] == 1)
+    return {"upstream_sessions": len(np.unique(pair_up)), "derived_sessions": len(np.unique(pair_down)),
+            "exact_matches": int(one_to_one.sum())}
+
+
+@traced
+def sessionize(events: pd.DataFrame, gap_minutes: float = SESSION_GAP_MINUTES,
+               sessionizer: Sessionizer = None) -> pd.DataFrame:
+    """Events with session_id derived by inactivity gap, rows without a user dropped.
+
+    Rows come back in (user_id, timestamp) order, so each session's first row is its earliest event (the row
+    session segments are taken from, as in sql/funnel_and_kpis.sql).
+    """
+    events = events[events["user_id"].notna()]
+    sessionizer = sessionizer or Sessionizer(gap_minutes)
+    with span("sessionize.sort", rows_in=len(events)):
+        codes, uniques = pd.factorize(events["user_id"])
+        ts = _epoch_ns(events["timestamp"])
+        offset = ts - ts.min() if len(ts) else ts
+        # One int64 sort key when it fits (whole-second logs are keyed in seconds)
+        unit = 10**9 if not (offset % 10**9).any() else 1
+        key_span = int(offset.max()) // unit + 1 if len(ts) else 1
+        if len(uniques) * key_span < 2**62:
+            order = np.argsort(codes.astype(np.int64) * key_span + offset // unit, kind="stable")
+        else:
+            order = np.lexsort((ts, codes))
+    with span("sessionize.assign", rows_in=len(events)):
+        ids = sessionizer.assign_codes(codes[order], uniques, ts[order]).to_pandas()
+        return events.iloc[order].assign(session_id=ids.to_numpy())
+
+
+def continue_open(events: pd.DataFrame, open_sessions: pd.DataFrame, gap_minutes: float = SESSION_GAP_MINUTES):
+    """Carry sessions across incremental batches: (events, open sessions after this batch).
+
+    events come from sessionize() on one batch; a user's first session in the batch takes the user's open
+    session id when it starts within the gap of that session's last event. open_sessions (session_id,
+    last_seen, indexed by user_id) keeps users whose last event is within the gap of the batch's latest event.
+    """
+    gap = pd.Timedelta(minutes=gap_minutes)
+    if len(events) == 0:
+        return events, open_sessions
+    users = events["user_id"].to_numpy()
+    first = np.r_[True, users[1:] != users[:-1]]
+    heads = events[first]
+    if open_sessions is not None and len(open_sessions):
+        carried = open_sessions.reindex(heads["user_id"])
+        continues = (heads["timestamp"].to_numpy() - carried["last_seen"].to_numpy() <= gap) & carried["session_id"].notna().to_numpy()
+        relabel = dict(zip(heads["session_id"].to_numpy()[continues], carried["session_id"].to_numpy()[continues]))
+        if relabel:
+            events = events.assign(session_id=events["session_id"].replace(relabel))
+    last = np.r_[users[1:] != users[:-1], True]
+    tails = events[last].set_index("user_id")[["session_id", "timestamp"]].rename(columns={"timestamp": "last_seen"})
+    merged = tails if open_sessions is None else pd.concat([open_sessions[~open_sessions.index.isin(tails.index)], tails])
+    return events, merged[merged["last_seen"] >= events["timestamp"].max() - gap]
+
+
+def _bucket_count(dataset, memory_mb: float, sample_rows: int = 10_000) -> int:
+    sample = dataset.head(sample_rows).to_pandas()
+    bytes_per_row = sample.memory_usage(deep=True).sum() / max(len(sample), 1)
+    return max(1, int(np.ceil(dataset.count_rows() * bytes_per_row * _SORT_COPIES / (memory_mb * 2**20))))
+
+
+def _split_by_user(dataset, columns: list, n_buckets: int, scratch: Path) -> list:
+    """Write the events into n_buckets Parquet files by user_id hash; returns the bucket paths."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    paths = [scratch / f"bucket-{k:04d}.parquet" for k in range(n_buckets)]
+    writers, schema = {}, None
+    try:
+        for batch in dataset.to_batches(columns=columns):
+            table = pa.Table.from_batches([batch])
+            schema = schema or table.schema
+            users = table.column("user_id").to_pandas().to_numpy(dtype=object)
+            bucket = (pd.util.hash_array(users) % n_buckets).astype(np.int64)
+            order = np.argsort(bucket, kind="stable")
+            bounds = np.searchsorted(bucket[order], np.arange(n_buckets + 1))
+            table = table.take(pa.array(order)).cast(schema)
+            for k in np.flatnonzero(np.diff(bounds)):
+                if k not in writers:
+                    writers[k] = pq.ParquetWriter(paths[k], schema)
+                writers[k].write_table(table.slice(bounds[k], bounds[k + 1] - bounds[k]))
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return [paths[k] for k in sorted(writers)]
+
+
+def sessionize_layer(gap_minutes: float = SESSION_GAP_MINUTES, memory_mb: float = SESSIONIZE_MEMORY_MB,
+                     root: Path = DATA_CLEANED, fmt: str = CLEANED_FORMAT) -> dict:
+    """Rewrite the cleaned events with derived session IDs, sorting one user-hash bucket at a time."""
+    stats = {"events_rows": 0, "derived_sessions": 0, "upstream_sessions": 0, "exact_matches": 0, "buckets": 1}
+    sessionizer = Sessionizer(gap_minutes)
+
+    def process(events: pd.DataFrame) -> pd.DataFrame:
+        derived = sessionize(events, sessionizer=sessionizer)
+        if "session_id" in events.columns:
+            match = agreement(events["session_id"], derived["session_id"])
+            stats["upstream_sessions"] += match["upstream_sessions"]
+            stats["exact_matches"] += match["exact_matches"]
+        stats["events_rows"] += len(derived)
+        return derived
+
+    if fmt == "csv":
+        # CSV cleaned layers are small demos: one in-memory chunk
+        write_events(process(read_events(root=root, fmt=fmt)), root=root, fmt=fmt)
+    else:
+        dataset = events_dataset(root)
+        columns = [n for n in dataset.schema.names if n != "event_date"]
+        stats["buckets"] = _bucket_count(dataset, memory_mb)
+        shutil.rmtree(SCRATCH_DIR, ignore_errors=True)
+        (SCRATCH_DIR / "buckets").mkdir(parents=True)
+        try:
+            with span("sessionize.split", buckets=stats["buckets"]):
+                buckets = _split_by_user(dataset, columns, stats["buckets"], SCRATCH_DIR / "buckets")
+            out = SCRATCH_DIR / "cleaned"
+            for i, path in enumerate(buckets):
+                # Buckets hold disjoint users, so bucket after bucket is still (user, timestamp) order for the sessionizer
+                write_events(process(pd.read_parquet(path)), append=i > 0, root=out)
+                path.unlink()
+            if buckets:
+                events_path = root / "events"
+                shutil.rmtree(events_path)
+                (out / "events").rename(events_path)
+        finally:
+            shutil.rmtree(SCRATCH_DIR, ignore_errors=True)
+    stats["derived_sessions"] = sessionizer.sessions
+    return stats
+
+
+def report_sessions(stats: dict, gap_minutes: float = SESSION_GAP_MINUTES):
+    print(f"Sessions: {stats['derived_sessions']} derived from {stats['events_rows']} events "
+          f"(inactivity gap {gap_minutes:g} min)")
+    if stats.get("upstream_sessions"):
+        pct = 100 * stats["exact_matches"] / stats["upstream_sessions"]
+        print(f"Upstream sessions: {stats['upstream_sessions']} ({pct:.1f}% match one derived session exactly)")
+
+
+def layer_needed(mode: str = SESSIONIZE) -> bool:
+    """needed() for the cleaned layer, reading only its session_id column."""
+    if mode != "auto" or not events_exist():
+        return mode == "always" and events_exist()
+    if CLEANED_FORMAT == "parquet" and "session_id" not in events_dataset().schema.names:
+        return True
+    return needed(read_events(columns=["session_id"]) if CLEANED_FORMAT == "parquet" else read_events(), mode)
+
+
+def run_if_needed(mode: str = SESSIONIZE, gap_minutes: float = SESSION_GAP_MINUTES,
+                  memory_mb: float = SESSIONIZE_MEMORY_MB):
+    """Sessionize the cleaned layer when SESSIONIZE mode calls for it; returns the stats (None if skipped)."""
+    if not layer_needed(mode):
+        return None
+    print("Deriving sessions by inactivity gap...")
+    stats = sessionize_layer(gap_minutes, memory_mb)
+    report_sessions(stats, gap_minutes)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rewrite the cleaned events with sessions derived by inactivity gap.")
+    parser.add_argument("--gap-minutes", type=float, default=SESSION_GAP_MINUTES,
+                        help="inactivity that ends a session")
+    parser.add_argument("--memory-mb", type=float, default=SESSIONIZE_MEMORY_MB, help="memory budget per sorted bucket")
+    args = parser.parse_args()
+    start = time.perf_counter()
+    stats = sessionize_layer(args.gap_minutes, args.memory_mb)
+    report_sessions(stats, args.gap_minutes)
+    print(f"Cleaned events rewritten in {time.perf_counter() - start:.1f}s ({stats['buckets']} buckets)")
+
+
+if __name__ == "__main__":
+    main()
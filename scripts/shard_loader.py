@@ -0,0 +1,212 @@
+"""
+Sharded raw events: load many raw event files (e.g. hourly shards) into the cleaned layer concurrently.
+- Shards are the files under data/raw/events/ matching RAW_SHARD_GLOB (*.csv, or gzipped *.csv.gz)
+- An asyncio loop reads shard bytes on a thread pool (INGEST_IO_THREADS) and parses and cleans each
+  shard in worker processes (INGEST_PARSE_WORKERS); only a bounded window of shards is in flight
+- Cleaned shards are appended to the cleaned layer in shard order; rows repeated across shards are
+  dropped with the same row fingerprints as data_cleaning.py --stream
+- A failing shard is retried INGEST_RETRIES times with backoff, then skipped while the others load;
+  per-shard status goes to outputs/ingest_report.csv. The run then fails (RuntimeError, exit 1) unless
+  --allow-partial is given; it always fails when no shard wrote any events (the old cleaned layer would stay)
+Run from project root: python scripts/shard_loader.py [--io-threads N] [--workers N] [--retries N] [--allow-partial]
+"""
+import argparse
+import asyncio
+import io
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+import pandas as pd
+
+import sys
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from config import (DATA_CLEANED, DATA_RAW, INGEST_IO_THREADS, INGEST_PARSE_WORKERS, INGEST_RETRIES, OUTPUTS,
+                    RAW_SHARD_DIR, RAW_SHARD_GLOB)
+
+from data_cleaning import RowFingerprints, clean_events, clean_products, report_unmapped
+from sessionize import run_if_needed
+from schema import ID_COLUMNS
+from storage import write_events, write_products
+
+# IDs stay strings even in shards where a column is empty, so every appended batch has one schema
+SHARD_DTYPES = {col: "str" for col in ID_COLUMNS}
+
+
+def discover_shards(root: Path = RAW_SHARD_DIR, pattern: str = RAW_SHARD_GLOB) -> list:
+    """Shard files in name order (zero-padded hourly names sort chronologically)."""
+    return sorted(p for p in root.glob(pattern) if p.is_file())
+
+
+def _read_bytes(path: Path) -> bytes:
+    return path.read_bytes()
+
+
+def parse_shard(data: bytes, name: str):
+    """(raw rows, cleaned events, unmapped event types) for one shard's file contents; runs in a worker process."""
+    if not data.strip():
+        return 0, None, {}
+    events = pd.read_csv(io.BytesIO(data), dtype=SHARD_DTYPES, compression="gzip" if name.endswith(".gz") else None)
+    unmapped = {}
+    return len(events), clean_events(events, unmapped), unmapped
+
+
+class ShardLoader:
+    """Reads shards on I/O threads and parses them in worker processes, retrying failed shards."""
+
+    def __init__(self, io_threads: int = INGEST_IO_THREADS, workers: int = INGEST_PARSE_WORKERS,
+                 retries: int = INGEST_RETRIES, backoff: float = 0.5):
+        self.io_threads = max(1, io_threads)
+        self.workers = max(1, workers)
+        self.retries = retries
+        self.backoff = backoff
+        # Shards read or parsed ahead of the one being written
+        self.window = max(self.io_threads, 2 * self.workers)
+        # Raw event types dropped by clean_events across all loaded shards
+        self.unmapped = {}
+
+    def _parse_pool(self):
+        # One worker: parse on a thread and skip pickling frames between processes
+        if self.workers > 1:
+            return ProcessPoolExecutor(max_workers=self.workers)
+        return ThreadPoolExecutor(max_workers=1)
+
+    async def _load(self, path: Path):
+        """(raw rows, cleaned events, unmapped event types, attempts) for one shard; raises once its retries are used up."""
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries + 1):
+            parse = self._parse
+            try:
+                data = await loop.run_in_executor(self._io, _read_bytes, path)
+                rows, events, unmapped = await loop.run_in_executor(parse, parse_shard, data, path.name)
+                return rows, events, unmapped, attempt + 1
+            except Exception as exc:
+                if isinstance(exc, BrokenProcessPool) and self._parse is parse:
+                    # A worker died (e.g. out of memory); shards in flight on the old pool retry on a new one
+                    self._parse = self._parse_pool()
+                    parse.shutdown(wait=False)
+                if attempt == self.retries:
+                    raise
+                print(f"  {path.name}: {type(exc).__name__}: {exc} (retry {attempt + 1}/{self.retries})")
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    async def _ingest(self, shards: list, write) -> list:
+        loop = asyncio.get_running_loop()
+        report, pending = [], deque()
+
+        async def finish():
+            path, task, started = pending.popleft()
+            row = {"shard": str(path.relative_to(DATA_RAW)), "status": "ok", "attempts": self.retries + 1,
+                   "raw_rows": 0, "cleaned_rows": 0, "seconds": 0.0, "error": ""}
+            try:
+                row["raw_rows"], events, unmapped, row["attempts"] = await task
+                for value, n in unmapped.items():
+                    self.unmapped[value] = self.unmapped.get(value, 0) + n
+                if events is not None and len(events) > 0:
+                    row["cleaned_rows"] = await loop.run_in_executor(self._writer, write, events)
+            except Exception as exc:
+                row.update(status="failed", error=f"{type(exc).__name__}: {exc}")
+                print(f"  {path.name}: FAILED ({row['error']})")
+            row["seconds"] = round(time.perf_counter() - started, 3)
+            report.append(row)
+
+        for path in shards:
+            pending.append((path, asyncio.ensure_future(self._load(path)), time.perf_counter()))
+            if len(pending) >= self.window:
+                await finish()
+        while pending:
+            await finish()
+        return report
+
+    def load(self, shards: list, write) -> pd.DataFrame:
+        """Load shards, calling write(cleaned events) -> rows written for each one in shard order."""
+        self._io = ThreadPoolExecutor(max_workers=self.io_threads, thread_name_prefix="shard-io")
+        self._parse = self._parse_pool()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shard-write")
+        try:
+            return pd.DataFrame(asyncio.run(self._ingest(shards, write)))
+        finally:
+            for pool in (self._io, self._parse, self._writer):
+                pool.shutdown()
+
+
+def run(shards: list = None, io_threads: int = INGEST_IO_THREADS, workers: int = INGEST_PARSE_WORKERS,
+        retries: int = INGEST_RETRIES, allow_partial: bool = False) -> pd.DataFrame:
+    """Clean all shards (and products.csv) into the cleaned layer; returns the per-shard report.
+
+    Raises RuntimeError when no events were written, or when any shard failed unless allow_partial.
+    """
+    shards = discover_shards() if shards is None else shards
+    if not shards:
+        raise FileNotFoundError(f"No raw event shards matching {RAW_SHARD_GLOB} under {RAW_SHARD_DIR}")
+    print(f"Loading {len(shards)} shards ({io_threads} I/O threads, {workers} parse workers)...")
+    fingerprints = RowFingerprints()
+    event_types, written = {}, []
+
+    def write(events: pd.DataFrame) -> int:
+        events = events[fingerprints.keep_new(events)]
+        if len(events) == 0:
+            return 0
+        # The first shard written replaces the cleaned layer; later shards append to it
+        write_events(events, append=bool(written))
+        written.append(len(events))
+        for event_type, n in events["event_type"].value_counts().items():
+            event_types[event_type] = event_types.get(event_type, 0) + int(n)
+        return len(events)
+
+    start = time.perf_counter()
+    loader = ShardLoader(io_threads, workers, retries)
+    report = loader.load(shards, write)
+    elapsed = time.perf_counter() - start
+    report.to_csv(OUTPUTS / "ingest_report.csv", index=False)
+    ok = report["status"] == "ok"
+    if not written:
+        raise RuntimeError(f"No events loaded from {len(report)} shards ({int((~ok).sum())} failed); the cleaned "
+                           "layer was not updated. See outputs/ingest_report.csv")
+    if not ok.all() and not allow_partial:
+        raise RuntimeError(f"{int((~ok).sum())} of {len(report)} shards failed, so the cleaned layer is incomplete; "
+                           "see outputs/ingest_report.csv (rerun with --allow-partial to accept it)")
+
+    products = pd.read_csv(DATA_RAW / "products.csv")
+    products_clean = clean_products(products)
+    write_products(products_clean)
+
+    print(f"Events: {report['raw_rows'].sum()} -> {report['cleaned_rows'].sum()} "
+          f"from {int(ok.sum())}/{len(report)} shards in {elapsed:.1f}s")
+    print(f"Products: {len(products)} -> {len(products_clean)}")
+    report_unmapped(loader.unmapped)
+    if not ok.all():
+        print(f"WARNING: {int((~ok).sum())} shards failed; see outputs/ingest_report.csv")
+    # A user's events span many shards, so sessions are derived over the whole cleaned layer
+    sessions = run_if_needed()
+    print(f"Cleaned data saved to {DATA_CLEANED}")
+
+    summary = {
+        "events_rows": sessions["events_rows"] if sessions else int(report["cleaned_rows"].sum()),
+        "products_rows": len(products_clean),
+        "event_types": event_types,
+        "unmapped_event_types": loader.unmapped,
+    }
+    pd.DataFrame([summary]).to_csv(OUTPUTS / "cleaning_summary.csv", index=False)
+    print("Cleaning summary saved to outputs/cleaning_summary.csv")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Clean sharded raw events concurrently into the cleaned layer.")
+    parser.add_argument("--io-threads", type=int, default=INGEST_IO_THREADS, help="threads reading shard files")
+    parser.add_argument("--workers", type=int, default=INGEST_PARSE_WORKERS, help="processes parsing shards")
+    parser.add_argument("--retries", type=int, default=INGEST_RETRIES, help="retries per failing shard")
+    parser.add_argument("--allow-partial", action="store_true", help="keep the shards that loaded when some fail")
+    args = parser.parse_args()
+    try:
+        run(io_threads=args.io_threads, workers=args.workers, retries=args.retries, allow_partial=args.allow_partial)
+    except RuntimeError as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+"""
+Approximate KPI mode for long histories: one small, mergeable sketch per event date.
+- HyperLogLog for distinct orders (purchase sessions), buyers and orders per category
+- Count-Min sketch plus a bounded candidate set for top products by revenue
+- Exact additive sums for revenue and units; a hash-sampled subset of users for the repeat rate
+Daily sketches are pickled in data/state/sketches/ and only rebuilt when their date partition
+changes; totals, weeks and months are unions of daily sketches.
+Run from project root: python scripts/sketches.py [--start 2024-10-01] [--end 2025-01-01] [--rebuild]
+"""
+import argparse
+import math
+import pickle
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import sys
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from config import (OUTPUTS, SKETCH_CM_DELTA, SKETCH_CM_EPS, SKETCH_ERROR, SKETCH_TOP_K,
+                    SKETCH_USER_SAMPLE, STATE_DIR)
+
+from eda import EDA_COLUMNS, merge_purchases_with_products
+from storage import event_partitions, read_events, read_products
+
+SKETCH_DIR = STATE_DIR / "sketches"
+SKETCH_DIR.mkdir(parents=True, exist_ok=True)
+# Days read per storage scan when building missing daily sketches
+BUILD_BLOCK_DAYS = 31
+
+
+def hash_values(values) -> np.ndarray:
+    """Stable 64-bit hashes (same value -> same hash in every run, so sketches merge across days)."""
+    return pd.util.hash_array(np.asarray(values, dtype=object))
+
+
+class HyperLogLog:
+    """Distinct counter over 64-bit hashes; relative standard error about 1.04 / sqrt(2**p)."""
+
+    def __init__(self, p: int = 12):
+        self.p = p
+        self.registers = np.zeros(1 << p, dtype=np.uint8)
+
+    @classmethod
+    def for_error(cls, error: float = SKETCH_ERROR):
+        return cls(int(np.clip(math.ceil(math.log2((1.04 / error) ** 2)), 4, 18)))
+
+    def add(self, hashes: np.ndarray):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        bucket = (hashes & np.uint64((1 << self.p) - 1)).astype(np.intp)
+        # Rank = leading zeros + 1 in the upper 32 bits (exact via the float exponent)
+        upper = (hashes >> np.uint64(32)).astype(np.float64)
+        rank = np.where(upper > 0, 33 - np.frexp(upper)[1], 33).astype(np.uint8)
+        np.maximum.at(self.registers, bucket, rank)
+
+    def merge(self, other: "HyperLogLog"):
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def estimate(self) -> float:
+        m = len(self.registers)
+        raw = 0.7213 / (1 + 1.079 / m) * m * m / np.ldexp(1.0, -self.registers.astype(np.int32)).sum()
+        zeros = int((self.registers == 0).sum())
+        # Linear counting is more accurate while many registers are still empty
+        return m * math.log(m / zeros) if raw <= 2.5 * m and zeros else raw
+
+
+class CountMinTopK:
+    """Weighted Count-Min sketch per key plus the k keys with the largest estimates of metrics[0].
+
+    Estimates never undercount and overcount by at most eps x (total weight) with probability
+    1 - delta, for every metric.
+    """
+
+    def __init__(self, metrics=("revenue", "units_sold"), k: int = SKETCH_TOP_K,
+                 eps: float = SKETCH_CM_EPS, delta: float = SKETCH_CM_DELTA):
+        self.metrics = list(metrics)
+        self.k = k
+        self.width = math.ceil(math.e / eps)
+        self.depth = math.ceil(math.log(1 / delta))
+        self.tables = np.zeros((len(self.metrics), self.depth, self.width))
+        self.candidates = {}  # key -> hash
+
+    def _columns(self, hashes: np.ndarray) -> np.ndarray:
+        # depth hash functions h1 + i * h2 from one 64-bit hash
+        h1 = hashes & np.uint64(0xFFFFFFFF)
+        h2 = (hashes >> np.uint64(32)) | np.uint64(1)
+        rows = np.arange(self.depth, dtype=np.uint64)[:, np.newaxis]
+        return ((h1 + rows * h2) % np.uint64(self.width)).astype(np.intp)
+
+    def add(self, keys, weights: dict):
+        """Add weights[metric][i] for keys[i] (keys may repeat)."""
+        keys = np.asarray(keys, dtype=object)
+        hashes = hash_values(keys)
+        columns = self._columns(hashes)
+        for m, metric in enumerate(self.metrics):
+            values = np.asarray(weights[metric], dtype=float)
+            for d in range(self.depth):
+                self.tables[m, d] += np.bincount(columns[d], weights=values, minlength=self.width)
+        unique, first = np.unique(hashes, return_index=True)
+        self._keep_top(dict(zip(keys[first], unique)))
+
+    def estimate(self, hashes: np.ndarray) -> np.ndarray:
+        """(metrics x keys) upper-bound estimates."""
+        columns = self._columns(np.asarray(hashes, dtype=np.uint64))
+        return self.tables[:, np.arange(self.depth)[:, np.newaxis], columns].min(axis=1)
+
+    def _keep_top(self, new: dict):
+        self.candidates.update(new)
+        if len(self.candidates) > self.k:
+            keys = list(self.candidates)
+            ranking = self.estimate(np.fromiter(self.candidates.values(), dtype=np.uint64, count=len(keys)))[0]
+            self.candidates = {keys[i]: self.candidates[keys[i]] for i in np.argsort(-ranking, kind="stable")[:self.k]}
+
+    def merge(self, other: "CountMinTopK"):
+        self.tables += other.tables
+        self._keep_top(other.candidates)
+        return self
+
+    def top(self, n: int = None) -> pd.DataFrame:
+        keys = list(self.candidates)
+        estimates = self.estimate(np.fromiter(self.candidates.values(), dtype=np.uint64, count=len(keys)))
+        top = pd.DataFrame({"key": keys, **{m: estimates[i] for i, m in enumerate(self.metrics)}})
+        return top.sort_values(self.metrics[0], ascending=False).head(n).reset_index(drop=True)
+
+
+class KpiSketch:
+    """Mergeable summary of purchases (one date, or the union of several) for approximate KPIs."""
+
+    def __init__(self, error: float = SKETCH_ERROR, sample: float = SKETCH_USER_SAMPLE):
+        self.error = error
+        self.sample = sample
+        self.revenue = 0.0
+        self.units = 0
+        self.orders = HyperLogLog.for_error(error)
+        self.buyers = HyperLogLog.for_error(error)
+        self.categories = {}  # category -> {"revenue", "units", "orders"}
+        self.products = CountMinTopK()
+        # (user hash, session hash) pairs of the users whose hash falls in the sample
+        self.user_orders = np.empty((0, 2), dtype=np.uint64)
+
+    def add(self, purchases: pd.DataFrame):
+        """Add purchase rows joined to products (session_id, user_id, product_id, quantity, revenue, category)."""
+        revenue = purchases["revenue"].fillna(0).to_numpy(float)
+        quantity = purchases["quantity"].to_numpy()
+        self.revenue += float(revenue.sum())
+        self.units += int(quantity.sum())
+        has_session = purchases["session_id"].notna().to_numpy()
+        session_hash = hash_values(purchases["session_id"])
+        self.orders.add(session_hash[has_session])
+
+        has_user = purchases["user_id"].notna().to_numpy()
+        user_hash = hash_values(purchases["user_id"])
+        self.buyers.add(user_hash[has_user])
+        sampled = has_user & has_session & ((user_hash >> np.uint64(32)) < np.uint64(int(self.sample * 2**32)))
+        pairs = np.column_stack([user_hash[sampled], session_hash[sampled]])
+        self.user_orders = np.unique(np.vstack([self.user_orders, pairs]), axis=0)
+
+        category = purchases["category"]
+        for name, rows in pd.Series(np.arange(len(purchases))).groupby(category.to_numpy(), sort=False):
+            entry = self.categories.setdefault(name, {"revenue": 0.0, "units": 0, "orders": HyperLogLog.for_error(self.error)})
+            rows = rows.to_numpy()
+            entry["revenue"] += float(revenue[rows].sum())
+            entry["units"] += int(quantity[rows].sum())
+            entry["orders"].add(session_hash[rows][has_session[rows]])
+
+        known = purchases["product_id"].notna().to_numpy() & category.notna().to_numpy()
+        self.products.add(purchases["product_id"].to_numpy()[known],
+                          {"revenue": revenue[known], "units_sold": quantity[known]})
+
+    def merge(self, other: "KpiSketch"):
+        self.revenue += other.revenue
+        self.units += other.units
+        self.orders.merge(other.orders)
+        self.buyers.merge(other.buyers)
+        for name, entry in other.categories.items():
+            mine = self.categories.setdefault(name, {"revenue": 0.0, "units": 0, "orders": HyperLogLog.for_error(self.error)})
+            mine["revenue"] += entry["revenue"]
+            mine["units"] += entry["units"]
+            mine["orders"].merge(entry["orders"])
+        self.products.merge(other.products)
+        self.user_orders = np.unique(np.vstack([self.user_orders, other.user_orders]), axis=0)
+        return self
+
+    def kpis(self) -> dict:
+        """Same keys as kpis.csv, plus estimated buyers."""
+        orders = self.orders.estimate()
+        _, per_user = np.unique(self.user_orders[:, 0], return_counts=True)
+        return {
+            "aov": float(self.revenue / orders) if orders else float("nan"),
+            "total_revenue": self.revenue,
+            "repeat_purchaser_pct": float((per_user > 1).mean() * 100) if len(per_user) else 0.0,
+            "total_orders": round(orders),
+            "buyers": round(self.buyers.estimate()),
+        }
+
+    def by_category(self) -> pd.DataFrame:
+        rows = [{"category": name, "units_sold": e["units"], "revenue": e["revenue"], "orders": round(e["orders"].estimate())}
+                for name, e in self.categories.items()]
+        return pd.DataFrame(rows, columns=["category", "units_sold", "revenue", "orders"]).sort_values(
+            "revenue", ascending=False).reset_index(drop=True)
+
+    def top_products(self, products: pd.DataFrame, n: int = None) -> pd.DataFrame:
+        top = self.products.top(n).rename(columns={"key": "product_id"})
+        top["units_sold"] = top["units_sold"].round().astype(int)
+        top = top.merge(products[["product_id", "product_name", "category"]], on="product_id", how="left")
+        return top[["product_id", "product_name", "category", "units_sold", "revenue"]]
+
+
+def _sketch_path(day: pd.Timestamp) -> Path:
+    return SKETCH_DIR / f"{day.date()}.pkl"
+
+
+def daily_sketches(start=None, end=None, rebuild: bool = False) -> dict:
+    """{date: KpiSketch} for cleaned-event dates in [start, end); missing or stale days are built."""
+    partitions = event_partitions()
+    days = [d for d in partitions if (start is None or d >= pd.Timestamp(start)) and (end is None or d < pd.Timestamp(end))]
+    stale = [d for d in days if rebuild or not _sketch_path(d).exists()
+             or _sketch_path(d).stat().st_mtime_ns < partitions[d]]
+    sketches = {}
+    if stale:
+        products = read_products(columns=["product_id", "product_name", "category", "price"])
+        print(f"Building sketches for {len(stale)} of {len(days)} days...")
+    for i in range(0, len(stale), BUILD_BLOCK_DAYS):
+        block = stale[i:i + BUILD_BLOCK_DAYS]
+        events = read_events(columns=EDA_COLUMNS, start=block[0], end=block[-1] + pd.Timedelta(days=1),
+                             event_types=["purchase"])
+        purchases = merge_purchases_with_products(events, products)
+        dates = purchases["timestamp"].dt.normalize()
+        wanted = set(block)
+        for day, rows in purchases.groupby(dates):
+            if day not in wanted:
+                continue
+            sketch = KpiSketch()
+            sketch.add(rows)
+            with open(_sketch_path(day), "wb") as f:
+                pickle.dump(sketch, f)
+            sketches[day] = sketch
+        for day in wanted - set(sketches):  # no purchases that day
+            sketch = KpiSketch()
+            with open(_sketch_path(day), "wb") as f:
+                pickle.dump(sketch, f)
+            sketches[day] = sketch
+    for day in days:
+        if day not in sketches:
+            with open(_sketch_path(day), "rb") as f:
+                sketches[day] = pickle.load(f)
+    return dict(sorted(sketches.items()))
+
+
+def union(sketches) -> KpiSketch:
+    total = KpiSketch()
+    for sketch in sketches:
+        total.merge(sketch)
+    return total
+
+
+def period_kpis(sketches: dict, freq: str) -> pd.DataFrame:
+    """KPIs per calendar week ("W", Monday start) or month ("M"), each a union of its daily sketches."""
+    periods = {}
+    for day, sketch in sketches.items():
+        start = day - pd.Timedelta(days=day.dayofweek) if freq == "W" else day.replace(day=1)
+        periods.setdefault(start, []).append(sketch)
+    rows = [{"period_start": start, **union(days).kpis()} for start, days in periods.items()]
+    return pd.DataFrame(rows)
+
+
+def run(start=None, end=None, rebuild: bool = False):
+    """Write approximate KPI, category, top-product and daily revenue tables (*_approx.csv)."""
+    sketches = daily_sketches(start, end, rebuild)
+    if not sketches:
+        print("No cleaned events found. Run the pipeline first.")
+        return
+    total = union(sketches.values())
+    kpis = total.kpis()
+    pd.DataFrame([kpis]).to_csv(OUTPUTS / "kpis_approx.csv", index=False)
+    total.by_category().to_csv(OUTPUTS / "revenue_by_category_approx.csv", index=False)
+    products = read_products(columns=["product_id", "product_name", "category"])
+    total.top_products(products).to_csv(OUTPUTS / "top_products_approx.csv", index=False)
+    daily = pd.DataFrame([{"date": day, "revenue": s.revenue, "orders": round(s.orders.estimate()), "units": s.units}
+                          for day, s in sketches.items() if s.units])
+    daily.to_csv(OUTPUTS / "daily_revenue_approx.csv", index=False)
+    period_kpis(sketches, "W").to_csv(OUTPUTS / "kpis_approx_weekly.csv", index=False)
+    period_kpis(sketches, "M").to_csv(OUTPUTS / "kpis_approx_monthly.csv", index=False)
+    print("Approximate KPIs:", kpis)
+    print(f"Approximate outputs ({len(sketches)} daily sketches) saved to {OUTPUTS}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Approximate KPIs from mergeable daily sketches.")
+    parser.add_argument("--start", help="first event date (inclusive)")
+    parser.add_argument("--end", help="last event date (exclusive)")
+    parser.add_argument("--rebuild", action="store_true", help="rebuild every daily sketch in the range")
+    args = parser.parse_args()
+    run(args.start, args.end, args.rebuild)
+
+
+if __name__ == "__main__":
+    main()
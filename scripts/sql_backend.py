@@ -0,0 +1,178 @@
+"""
+SQL backend: runs sql/funnel_and_kpis.sql with embedded DuckDB directly over the cleaned layer.
+DuckDB scans the Parquet partitions out of core (spilling to data/state/ past SQL_MEMORY_MB), so the
+metric definitions live in one SQL file and scale past what pandas holds in memory.
+Each query marked "-- name: <output>" is written to outputs/<output>.csv.
+Run from project root: python scripts/sql_backend.py [--check]
+--check compares the SQL results with the pandas funnel/EDA outputs instead of writing files; with
+SQL_CHECK on (or --verify), a run compares them first and writes nothing on a mismatch.
+"""
+import argparse
+import re
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import sys
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from config import OUTPUTS, PROJECT_ROOT, SQL_CHECK, SQL_MEMORY_MB, STATE_DIR
+
+from storage import sql_sources
+
+SQL_FILE = PROJECT_ROOT / "sql" / "funnel_and_kpis.sql"
+NAME_MARKER = re.compile(r"^--\s*name:\s*(\w+)\s*$")
+
+
+def parse_sql(path: Path = SQL_FILE):
+    """Split the SQL file into setup statements and {output name: query} for "-- name:" queries."""
+    setup, queries = [], {}
+    name, lines = None, []
+    for line in path.read_text().splitlines():
+        marker = NAME_MARKER.match(line.strip())
+        if marker:
+            name = marker.group(1)
+            continue
+        if line.strip().startswith("--") or not (lines or line.strip()):
+            continue
+        lines.append(line)
+        if line.rstrip().endswith(";"):
+            statement = "\n".join(lines).rstrip().rstrip(";")
+            if name:
+                queries[name] = statement
+            else:
+                setup.append(statement)
+            name, lines = None, []
+    return setup, queries
+
+
+def connect(memory_mb: int = SQL_MEMORY_MB, path: Path = SQL_FILE):
+    """In-memory DuckDB connection with the cleaned tables and the SQL file's views registered."""
+    import duckdb
+
+    con = duckdb.connect()
+    con.execute(f"SET memory_limit = '{int(memory_mb)}MB'")
+    con.execute(f"SET temp_directory = '{STATE_DIR / 'duckdb_tmp'}'")
+    for table, source in sql_sources().items():
+        con.execute(f"CREATE VIEW {table} AS SELECT * FROM {source}")
+    for statement in parse_sql(path)[0]:
+        con.execute(statement)
+    return con
+
+
+def run_queries(memory_mb: int = SQL_MEMORY_MB, path: Path = SQL_FILE) -> dict:
+    """{output name: DataFrame} for every named query in the SQL file."""
+    con = connect(memory_mb, path)
+    try:
+        return {name: con.execute(query).df() for name, query in parse_sql(path)[1].items()}
+    finally:
+        con.close()
+
+
+def pandas_outputs() -> dict:
+    """The same outputs computed by the pandas funnel and EDA code (nothing is written)."""
+    import cohorts
+    import eda
+    import funnel_analysis
+
+    events = funnel_analysis.load_cleaned_data()
+    counts_df = funnel_analysis.funnel_counts(funnel_analysis.funnel_by_session(events))
+    results = {"funnel_counts": counts_df, "funnel_conversion_rates": funnel_analysis.conversion_rates(counts_df)}
+    for grouping, seg_funnel in funnel_analysis.funnel_cube(events, crosses=[]).items():
+        results[f"funnel_by_{grouping[0]}"] = seg_funnel
+    series = cohorts.funnel_time_series(events, ("D", "W"))
+    results["funnel_daily"], results["funnel_weekly"] = series["D"], series["W"]
+
+    purchase_events, products = eda.load_data()
+    products = eda.product_index(products)
+    purchases = eda.merge_purchases_with_products(purchase_events, products)
+    by_product, results["revenue_by_category"] = eda.top_products_and_categories(purchases, products)
+    results["top_products"] = eda.decode_ids(by_product)
+    results["daily_revenue"] = eda.revenue_trends(purchases)
+    results["revenue_seasonality"] = eda.seasonality_cells(purchases).rename("revenue").reset_index()
+    results["kpis"] = pd.DataFrame([eda.aov_and_repeat(purchase_events, purchases)])
+    return results
+
+
+def _normalized(frame: pd.DataFrame) -> pd.DataFrame:
+    """Non-numeric columns as strings, rows sorted by them (row order of ties may differ)."""
+    frame = frame.copy()
+    keys = [c for c in frame.columns if not pd.api.types.is_numeric_dtype(frame[c])]
+    for col in keys:
+        frame[col] = frame[col].astype(str)
+    return frame.sort_values(keys).reset_index(drop=True) if keys else frame
+
+
+def compare(sql: dict, reference: dict, atol: float = 0.011) -> list:
+    """Mismatch messages between SQL and pandas outputs; rates may differ by rounding (atol)."""
+    problems = []
+    for name, expected in reference.items():
+        if name not in sql:
+            problems.append(f"{name}: no SQL query")
+            continue
+        got, expected = _normalized(sql[name]), _normalized(expected)
+        if list(got.columns) != list(expected.columns):
+            problems.append(f"{name}: columns {list(got.columns)} != {list(expected.columns)}")
+            continue
+        if len(got) != len(expected):
+            problems.append(f"{name}: {len(got)} rows != {len(expected)}")
+            continue
+        for col in got.columns:
+            a, b = got[col], expected[col]
+            if pd.api.types.is_numeric_dtype(a) and pd.api.types.is_numeric_dtype(b):
+                same = np.isclose(a.to_numpy(float), b.to_numpy(float), rtol=1e-9, atol=atol, equal_nan=True)
+            else:
+                same = (a == b).to_numpy()
+            if not same.all():
+                row = int(np.flatnonzero(~same)[0])
+                problems.append(f"{name}.{col}: {int((~same).sum())} rows differ (first: {a[row]!r} != {b[row]!r})")
+    return problems
+
+
+def run(out_dir: Path = OUTPUTS, charts: bool = True, memory_mb: int = SQL_MEMORY_MB,
+        verify: bool = SQL_CHECK) -> dict:
+    """Write every named SQL output to out_dir (and the charts built from them); verify: compare with pandas
+    first and raise RuntimeError, before anything is written, on any mismatch."""
+    results = run_queries(memory_mb)
+    if verify and not check(results=results):
+        raise RuntimeError("SQL outputs disagree with the pandas implementation (see MISMATCH lines); nothing written")
+    for name, frame in results.items():
+        frame.to_csv(out_dir / f"{name}.csv", index=False)
+        print(f"{name}.csv saved ({len(frame)} rows).")
+    if charts:
+        import eda
+        seasonality = results["revenue_seasonality"].pivot(index="weekday", columns="hour", values="revenue")
+        eda.render_charts(eda.chart_jobs(funnel=results["funnel_conversion_rates"], by_product=results["top_products"],
+                                         by_category=results["revenue_by_category"], daily=results["daily_revenue"],
+                                         seasonality=seasonality.fillna(0)))
+    print("KPIs:", results["kpis"].iloc[0].to_dict())
+    print(f"SQL outputs saved to {out_dir}")
+    return results
+
+
+def check(memory_mb: int = SQL_MEMORY_MB, results: dict = None) -> bool:
+    """Compare the SQL outputs (run now unless given) with the pandas implementation; prints any mismatches."""
+    problems = compare(results if results is not None else run_queries(memory_mb), pandas_outputs())
+    for problem in problems:
+        print("MISMATCH", problem)
+    print("SQL and pandas outputs match." if not problems else f"{len(problems)} mismatches.")
+    return not problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run sql/funnel_and_kpis.sql with DuckDB over the cleaned data.")
+    parser.add_argument("--check", action="store_true", help="compare with the pandas outputs instead of writing")
+    parser.add_argument("--memory-mb", type=int, default=SQL_MEMORY_MB)
+    parser.add_argument("--verify", action="store_true", help="compare with pandas before writing (as SQL_CHECK)")
+    args = parser.parse_args()
+    if args.check:
+        sys.exit(0 if check(args.memory_mb) else 1)
+    try:
+        run(memory_mb=args.memory_mb, verify=SQL_CHECK or args.verify)
+    except RuntimeError as e:
+        print(e)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
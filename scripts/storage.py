@@ -0,0 +1,214 @@
+"""
+Cleaned-layer storage: typed, columnar Parquet partitioned by event date (default) or CSV.
+- Parquet: data/cleaned/events/event_date=YYYY-MM-DD/*.parquet and data/cleaned/products_cleaned.parquet
+- CSV: data/cleaned/events_cleaned.csv and products_cleaned.csv (set CLEANED_FORMAT = "csv" for small demos)
+Readers load only the requested columns, date range and event types.
+"""
+import operator
+import shutil
+import uuid
+from functools import reduce
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import sys
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from config import CLEANED_FORMAT, DATA_CLEANED
+
+EVENT_CATEGORICALS = ["event_type", "region", "device", "campaign_source"]
+PARTITION_COL = "event_date"
+
+
+def _events_path(root: Path, fmt: str) -> Path:
+    return root / ("events" if fmt == "parquet" else "events_cleaned.csv")
+
+
+def _products_path(root: Path, fmt: str) -> Path:
+    return root / f"products_cleaned.{fmt}"
+
+
+def events_exist(root: Path = DATA_CLEANED, fmt: str = CLEANED_FORMAT) -> bool:
+    return _events_path(root, fmt).exists()
+
+
+def typed_events(events: pd.DataFrame) -> pd.DataFrame:
+    """Categorical dimensions, datetime64 timestamps and integer quantity."""
+    events = events.copy()
+    for col in EVENT_CATEGORICALS:
+        if col in events.columns and not isinstance(events[col].dtype, pd.CategoricalDtype):
+            events[col] = events[col].astype("category")
+    if "timestamp" in events.columns:
+        events["timestamp"] = pd.to_datetime(events["timestamp"])
+    if "quantity" in events.columns:
+        events["quantity"] = events["quantity"].astype(int)
+    return events
+
+
+def _arrow_events(events: pd.DataFrame):
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(events, preserve_index=False)
+    # Fixed dictionary index width so files written in separate batches share one schema
+    fields = [
+        pa.field(f.name, pa.dictionary(pa.int32(), pa.string())) if pa.types.is_dictionary(f.type) else f
+        for f in table.schema
+    ]
+    table = table.cast(pa.schema(fields))
+    dates = pa.array(events["timestamp"].to_numpy().astype("datetime64[D]"), type=pa.date32())
+    return table.append_column(PARTITION_COL, dates)
+
+
+def write_events(events: pd.DataFrame, append: bool = False, root: Path = DATA_CLEANED, fmt: str = CLEANED_FORMAT):
+    """Write cleaned events. append=True adds a batch to the existing cleaned layer."""
+    events = typed_events(events)
+    path = _events_path(root, fmt)
+    if fmt == "csv":
+        exists = append and path.exists()
+        events.to_csv(path, mode="a" if exists else "w", header=not exists, index=False)
+        return path
+
+    import pyarrow.dataset as ds
+
+    if not append and path.exists():
+        shutil.rmtree(path)
+    ds.write_dataset(
+        _arrow_events(events),
+        path,
+        format="parquet",
+        partitioning=[PARTITION_COL],
+        partitioning_flavor="hive",
+        basename_template=f"part-{uuid.uuid4().hex[:12]}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+    )
+    return path
+
+
+def event_partitions(root: Path = DATA_CLEANED, fmt: str = CLEANED_FORMAT) -> dict:
+    """{event date: last modification time in ns} for the cleaned events (CSV: one file for all dates)."""
+    path = _events_path(root, fmt)
+    if not path.exists():
+        return {}
+    if fmt == "csv":
+        mtime = path.stat().st_mtime_ns
+        dates = pd.to_datetime(pd.read_csv(path, usecols=["timestamp"])["timestamp"]).dt.normalize().dropna().unique()
+        return {pd.Timestamp(d): mtime for d in sorted(dates)}
+    partitions = {}
+    for part in path.glob(f"{PARTITION_COL}=*"):
+        files = [f.stat().st_mtime_ns for f in part.glob("*.parquet")]
+        if files:
+            partitions[pd.Timestamp(part.name.split("=", 1)[1])] = max(files)
+    return dict(sorted(partitions.items()))
+
+
+def _date_bounds(start, end):
+    start = pd.Timestamp(start) if start is not None else None
+    end = pd.Timestamp(end) if end is not None else None
+    return start, end
+
+
+def _dictionary_encoded(data, columns):
+    """RecordBatch/Table with the named string columns dictionary-encoded (pandas categoricals)."""
+    import pyarrow.compute as pc
+
+    arrays = [pc.dictionary_encode(data.column(name)) if name in columns else data.column(name)
+              for name in data.schema.names]
+    return type(data).from_arrays(arrays, names=data.schema.names)
+
+
+def events_dataset(root: Path = DATA_CLEANED):
+    """pyarrow dataset over the Parquet cleaned events (event_date is the hive partition column)."""
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    partitioning = ds.partitioning(pa.schema([(PARTITION_COL, pa.date32())]), flavor="hive")
+    return ds.dataset(_events_path(root, "parquet"), format="parquet", partitioning=partitioning)
+
+
+def read_events(columns=None, start=None, end=None, event_types=None,
+                root: Path = DATA_CLEANED, fmt: str = CLEANED_FORMAT, dictionary_columns=()) -> pd.DataFrame:
+    """Cleaned events restricted to `columns`, start <= timestamp < end and `event_types`.
+
+    dictionary_columns are returned as categoricals, encoded batch by batch so the full string
+    column is never materialized (used for high-cardinality IDs, see scripts/schema.py).
+    """
+    start, end = _date_bounds(start, end)
+    path = _events_path(root, fmt)
+    if fmt == "csv":
+        events = _read_events_csv(path, columns, start, end, event_types)
+        for col in dictionary_columns:
+            if col in events.columns:
+                events[col] = events[col].astype("category")
+        return events
+
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    dataset = events_dataset(root)
+    # Partition filters prune whole date directories; the timestamp filters trim the edge days
+    filters = []
+    if start is not None:
+        filters.append(ds.field(PARTITION_COL) >= pa.scalar(start.date(), pa.date32()))
+        filters.append(ds.field("timestamp") >= pa.scalar(start.as_unit("ns").to_datetime64(), pa.timestamp("ns")))
+    if end is not None:
+        filters.append(ds.field(PARTITION_COL) <= pa.scalar(end.date(), pa.date32()))
+        filters.append(ds.field("timestamp") < pa.scalar(end.as_unit("ns").to_datetime64(), pa.timestamp("ns")))
+    if event_types is not None:
+        filters.append(ds.field("event_type").isin(list(event_types)))
+    predicate = reduce(operator.and_, filters) if filters else None
+    if columns is None:
+        columns = [n for n in dataset.schema.names if n != PARTITION_COL]
+    dictionary_columns = [c for c in dictionary_columns if c in columns]
+    if not dictionary_columns:
+        return dataset.to_table(columns=list(columns), filter=predicate).to_pandas()
+    batches = [_dictionary_encoded(batch, dictionary_columns)
+               for batch in dataset.to_batches(columns=list(columns), filter=predicate)]
+    if not batches:
+        return _dictionary_encoded(dataset.to_table(columns=list(columns), filter=predicate), dictionary_columns).to_pandas()
+    return pa.Table.from_batches(batches).to_pandas()
+
+
+def _read_events_csv(path: Path, columns, start, end, event_types) -> pd.DataFrame:
+    usecols = None if columns is None else list(dict.fromkeys(list(columns) + ["timestamp", "event_type"]))
+    events = pd.read_csv(path, usecols=usecols)
+    events = typed_events(events)
+    mask = np.ones(len(events), dtype=bool)
+    if start is not None:
+        mask &= (events["timestamp"] >= start).to_numpy()
+    if end is not None:
+        mask &= (events["timestamp"] < end).to_numpy()
+    if event_types is not None:
+        mask &= events["event_type"].isin(list(event_types)).to_numpy()
+    if not mask.all():
+        events = events[mask].reset_index(drop=True)
+    return events if columns is None else events[list(columns)]
+
+
+def write_products(products: pd.DataFrame, root: Path = DATA_CLEANED, fmt: str = CLEANED_FORMAT):
+    path = _products_path(root, fmt)
+    if fmt == "csv":
+        products.to_csv(path, index=False)
+    else:
+        products.to_parquet(path, index=False)
+    return path
+
+
+def read_products(columns=None, root: Path = DATA_CLEANED, fmt: str = CLEANED_FORMAT) -> pd.DataFrame:
+    path = _products_path(root, fmt)
+    if fmt == "csv":
+        return pd.read_csv(path, usecols=columns)
+    return pd.read_parquet(path, columns=columns)
+
+
+def sql_sources(root: Path = DATA_CLEANED, fmt: str = CLEANED_FORMAT) -> dict:
+    """DuckDB table expressions scanning the cleaned events and products in place (not loaded)."""
+    def quoted(path):
+        return "'" + str(path).replace("'", "''") + "'"
+
+    events, products = _events_path(root, fmt), _products_path(root, fmt)
+    if fmt == "csv":
+        return {"events_cleaned": f"read_csv_auto({quoted(events)})",
+                "products_cleaned": f"read_csv_auto({quoted(products)})"}
+    return {"events_cleaned": f"read_parquet({quoted(events / '**' / '*.parquet')}, hive_partitioning = true)",
+            "products_cleaned": f"read_parquet({quoted(products)})"}
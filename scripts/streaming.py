@@ -0,0 +1,330 @@
+"""
+Streaming ingestion: rolling funnel counters over live events, for near-real-time drop-off alerts.
+- Sources: a tail-followed raw events CSV (--follow) and/or a local TCP socket taking one JSON event
+  per line (--listen host:port), both feeding one queue
+- Each event is normalized with EVENT_TYPE_MAP; unmapped types and events without a session are rejected
+- Sessions reach stages in funnel order (as in funnel_analysis); each new stage a session reaches is
+  counted once, overall and per segment value, in ring buffers per STREAM_WINDOWS (5 min / 1 h / 24 h)
+- Snapshots (counts, conversion and alerts per window) go to data/state/stream_snapshot.json every
+  STREAM_SNAPSHOT_SECONDS and are served at http://127.0.0.1:STREAM_HTTP_PORT/snapshot
+Windows slide in event time: "now" is the latest event timestamp seen, so replays behave like live data.
+Run from project root: python scripts/streaming.py --follow data/raw/events.csv [--from-start]
+                       python scripts/streaming.py --listen 127.0.0.1:9009 [--http-port 8765]
+"""
+import argparse
+import csv
+import json
+import queue
+import socketserver
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import sys
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from config import (EVENT_TYPE_MAP, FUNNEL_STAGES, SEGMENT_COLUMNS, STATE_DIR, STREAM_ALERT_MIN_SESSIONS,
+                    STREAM_ALERT_RATIO, STREAM_HTTP_PORT, STREAM_SNAPSHOT_SECONDS, STREAM_WINDOWS)
+
+SNAPSHOT_FILE = STATE_DIR / "stream_snapshot.json"
+ALERTS_FILE = STATE_DIR / "stream_alerts.jsonl"
+STAGE_INDEX = {stage: i for i, stage in enumerate(FUNNEL_STAGES)}
+ALL = ("all", "all")
+# Sessions idle for longer than the longest window are dropped every EVICT_EVERY events
+EVICT_EVERY = 10_000
+
+
+def normalize(event: dict):
+    """(session_id, stage index, event time in epoch seconds, segment values) or None if rejected."""
+    stage = STAGE_INDEX.get(EVENT_TYPE_MAP.get(str(event.get("event_type") or "").strip().lower()))
+    session = event.get("session_id")
+    if stage is None or session is None or session == "":
+        return None
+    t = _epoch_seconds(event.get("timestamp"))
+    if t is None:
+        return None
+    segments = tuple(str(event.get(col) or "unknown").strip() or "unknown" for col in SEGMENT_COLUMNS)
+    return str(session), stage, t, segments
+
+
+def _epoch_seconds(value):
+    """Epoch seconds for an ISO timestamp (naive = UTC, as pandas treats it); None if unparseable."""
+    try:
+        ts = datetime.fromisoformat(str(value))
+    except ValueError:
+        ts = pd.to_datetime(value, errors="coerce")
+        if pd.isna(ts):
+            return None
+        ts = ts.to_pydatetime()
+    return (ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)).timestamp()
+
+
+class RingCounter:
+    """Counts per key and funnel stage over a sliding window of `slots` equal time buckets."""
+
+    def __init__(self, seconds: float, slots: int):
+        self.width = seconds / slots
+        self.slots = slots
+        self.bucket = np.full(slots, -1, dtype=np.int64)  # absolute time bucket held by each slot
+        self.counts = {}                                   # key -> (slots, stages) counts
+
+    def add(self, t: float, keys, stages: slice):
+        bucket = int(t // self.width)
+        slot = bucket % self.slots
+        if self.bucket[slot] != bucket:
+            if self.bucket[slot] > bucket:  # older than the window
+                return
+            self.bucket[slot] = bucket
+            for counts in self.counts.values():
+                counts[slot] = 0
+        for key in keys:
+            if key not in self.counts:
+                self.counts[key] = np.zeros((self.slots, len(FUNNEL_STAGES)), dtype=np.int64)
+            self.counts[key][slot, stages] += 1
+
+    def totals(self, now: float) -> dict:
+        """{key: stage counts} over the window ending at `now`."""
+        current = int(now // self.width)
+        live = (self.bucket > current - self.slots) & (self.bucket <= current)
+        return {key: counts[live].sum(axis=0) for key, counts in self.counts.items()}
+
+
+class StreamingFunnel:
+    def __init__(self, windows: dict = STREAM_WINDOWS):
+        self.windows = {name: RingCounter(seconds, slots) for name, (seconds, slots) in windows.items()}
+        self.horizon = max(seconds for seconds, _ in windows.values())
+        self.sessions = {}  # session_id -> [stage bitmask, stages reached in order, segment keys, last seen]
+        self.now = None
+        self.events = 0
+        self.rejected = 0
+        self.alerts = deque(maxlen=100)
+        self._breaches = set()
+
+    def add(self, raw: dict):
+        event = normalize(raw)
+        if event is None:
+            self.rejected += 1
+            return
+        session_id, stage, t, segments = event
+        self.events += 1
+        self.now = t if self.now is None else max(self.now, t)
+        session = self.sessions.get(session_id)
+        if session is None:
+            # A session's segment is the value on its first event
+            keys = [ALL, *zip(SEGMENT_COLUMNS, segments)]
+            session = self.sessions[session_id] = [0, 0, keys, t]
+        session[0] |= 1 << stage
+        session[3] = max(session[3], t)
+        level = session[1]
+        while level < len(FUNNEL_STAGES) and session[0] >> level & 1:
+            level += 1
+        if level > session[1]:
+            for counter in self.windows.values():
+                counter.add(t, session[2], slice(session[1], level))
+            session[1] = level
+        if self.events % EVICT_EVERY == 0:
+            self.evict()
+
+    def evict(self):
+        cutoff = self.now - self.horizon
+        self.sessions = {sid: s for sid, s in self.sessions.items() if s[3] >= cutoff}
+
+    def window_table(self, name: str) -> pd.DataFrame:
+        """Sessions reaching each stage per segment value in the window, with conversion from visit."""
+        totals = self.windows[name].totals(self.now) if self.now is not None else {}
+        rows = [{"segment": key[0], "value": key[1], **dict(zip(FUNNEL_STAGES, counts.tolist()))}
+                for key, counts in sorted(totals.items(), key=lambda kv: (kv[0] != ALL, kv[0]))]
+        table = pd.DataFrame(rows, columns=["segment", "value", *FUNNEL_STAGES])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            table["conversion_pct"] = np.where(table["visit"] > 0, table["purchase"] / table["visit"] * 100, 0).round(2)
+        return table
+
+    def check_alerts(self) -> list:
+        """New drop-off alerts: stage conversion in a short window below STREAM_ALERT_RATIO x baseline."""
+        if self.now is None:
+            return []
+        names = list(self.windows)
+        baseline = self.windows[names[-1]].totals(self.now)
+        new, breaches = [], set()
+        for name in names[:-1]:
+            for key, counts in self.windows[name].totals(self.now).items():
+                base = baseline.get(key)
+                for k in range(1, len(FUNNEL_STAGES)):
+                    if counts[k - 1] < STREAM_ALERT_MIN_SESSIONS or base is None or base[k - 1] == 0 or base[k] == 0:
+                        continue
+                    rate, base_rate = counts[k] / counts[k - 1], base[k] / base[k - 1]
+                    if rate >= STREAM_ALERT_RATIO * base_rate:
+                        continue
+                    breach = (name, key, FUNNEL_STAGES[k])
+                    breaches.add(breach)
+                    if breach not in self._breaches:  # alert once per breach, again only after recovery
+                        new.append({
+                            "time": pd.Timestamp(self.now, unit="s").isoformat(), "window": name,
+                            "segment": key[0], "value": key[1], "stage": FUNNEL_STAGES[k],
+                            "sessions_at_previous": int(counts[k - 1]),
+                            "conversion_pct": round(rate * 100, 2), "baseline_pct": round(base_rate * 100, 2),
+                        })
+        self._breaches = breaches
+        self.alerts.extend(new)
+        return new
+
+    def snapshot(self) -> dict:
+        return {
+            "as_of": pd.Timestamp(self.now, unit="s").isoformat() if self.now is not None else None,
+            "events": self.events,
+            "rejected": self.rejected,
+            "open_sessions": len(self.sessions),
+            "windows": {name: self.window_table(name).to_dict(orient="records") for name in self.windows},
+            "alerts": list(self.alerts),
+        }
+
+
+def write_snapshot(snapshot: dict, path: Path = SNAPSHOT_FILE):
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(snapshot))
+    tmp.replace(path)
+
+
+def load_snapshot(path: Path = SNAPSHOT_FILE):
+    """Latest snapshot written by a running stream (None if there is none)."""
+    return json.loads(path.read_text()) if path.exists() else None
+
+
+# --- Sources: each runs in a thread and puts raw event dicts on the queue ---
+
+def follow_file(path: Path, events: queue.Queue, stop: threading.Event, from_start: bool = False, poll: float = 0.5):
+    """Tail a raw events CSV: complete lines appended after the start (or all lines with from_start)."""
+    with open(path, newline="") as f:
+        header = next(csv.reader([f.readline()]))
+        if not from_start:
+            f.seek(0, 2)
+        partial = ""
+        while not stop.is_set():
+            line = f.readline()
+            if not line:
+                if Path(path).stat().st_size < f.tell():  # truncated or rotated: start over
+                    f.seek(0)
+                    f.readline()
+                stop.wait(poll)
+                continue
+            partial += line
+            if not partial.endswith("\n"):  # the writer has not finished this line yet
+                continue
+            row, partial = next(csv.reader([partial])), ""
+            events.put(dict(zip(header, row)))
+
+
+def listen_socket(host: str, port: int, events: queue.Queue):
+    """TCP server taking newline-delimited JSON events; returns the server (serve_forever in a thread)."""
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    events.put(json.loads(line))
+                except ValueError:
+                    events.put({})  # counted as rejected
+
+    server = socketserver.ThreadingTCPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+def snapshot_server(port: int, funnel: StreamingFunnel, lock: threading.Lock):
+    """HTTP server answering GET /snapshot with the current snapshot as JSON."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip("/") != "/snapshot":
+                self.send_error(404)
+                return
+            with lock:
+                body = json.dumps(funnel.snapshot()).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return ThreadingHTTPServer(("127.0.0.1", port), Handler)
+
+
+def run(follow: Path = None, listen: str = None, from_start: bool = False, http_port: int = STREAM_HTTP_PORT,
+        idle_exit: float = 0) -> StreamingFunnel:
+    """Consume events until interrupted (or idle for idle_exit seconds), refreshing snapshots and alerts."""
+    events, stop, lock = queue.Queue(maxsize=100_000), threading.Event(), threading.Lock()
+    funnel = StreamingFunnel()
+    servers = []
+    if follow:
+        threading.Thread(target=follow_file, args=(Path(follow), events, stop, from_start), daemon=True).start()
+        print(f"Following {follow}{' from the start' if from_start else ''}...")
+    if listen:
+        host, port = listen.rsplit(":", 1)
+        servers.append(listen_socket(host, int(port), events))
+        print(f"Listening for JSON events on {listen}...")
+    if http_port:
+        servers.append(snapshot_server(http_port, funnel, lock))
+        print(f"Snapshot API: http://127.0.0.1:{http_port}/snapshot")
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    next_snapshot = last_event = time.monotonic()
+    try:
+        while True:
+            batch = []
+            try:
+                batch.append(events.get(timeout=0.2))
+                while len(batch) < 10_000:
+                    batch.append(events.get_nowait())
+            except queue.Empty:
+                pass
+            if batch:
+                last_event = time.monotonic()
+                with lock:
+                    for event in batch:
+                        funnel.add(event)
+            idle = idle_exit and time.monotonic() - last_event > idle_exit
+            if time.monotonic() >= next_snapshot or idle:
+                with lock:
+                    alerts = funnel.check_alerts()
+                    write_snapshot(funnel.snapshot())
+                with open(ALERTS_FILE, "a") as f:
+                    for alert in alerts:
+                        f.write(json.dumps(alert) + "\n")
+                        print(f"ALERT [{alert['window']}] {alert['segment']}={alert['value']} -> {alert['stage']}: "
+                              f"{alert['conversion_pct']}% vs baseline {alert['baseline_pct']}%")
+                next_snapshot = time.monotonic() + STREAM_SNAPSHOT_SECONDS
+            if idle:
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+    print(f"Stopped: {funnel.events} events, {funnel.rejected} rejected, snapshot in {SNAPSHOT_FILE}")
+    return funnel
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream events into rolling funnel counters.")
+    parser.add_argument("--follow", type=Path, help="raw events CSV to tail")
+    parser.add_argument("--from-start", action="store_true", help="replay the followed file before tailing it")
+    parser.add_argument("--listen", help="host:port for newline-delimited JSON events")
+    parser.add_argument("--http-port", type=int, default=STREAM_HTTP_PORT, help="snapshot API port (0 = off)")
+    parser.add_argument("--idle-exit", type=float, default=0, help="stop after this many seconds without events")
+    args = parser.parse_args()
+    if not (args.follow or args.listen):
+        parser.error("give --follow and/or --listen")
+    run(args.follow, args.listen, args.from_start, args.http_port, args.idle_exit)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Compact user -> sessions index for cross-session analysis (user funnel, repeat purchases, KPIs).
+Users and sessions are integer codes; each user's sessions form a contiguous slice of `sessions`
+(CSR layout: offsets[u]:offsets[u + 1]), ordered by session start. Only per-session arrays are
+kept, so the index is built once from the events and reused without string-keyed groupbys.
+"""
+import numpy as np
+import pandas as pd
+
+NO_TIME = np.iinfo(np.int64).max
+NS_PER_DAY = 86_400 * 10**9
+
+
+class UserSessionIndex:
+    def __init__(self, session_ids, session_user, session_start, user_ids):
+        self.session_ids = pd.Index(session_ids)
+        self.session_user = session_user        # user code per session (-1 = no user)
+        self.session_start = session_start      # first event time per session, int64 ns (NO_TIME = unknown)
+        self.user_ids = pd.Index(user_ids)
+        known = np.flatnonzero(session_user >= 0)
+        self.sessions = known[np.lexsort((session_start[known], session_user[known]))]
+        self.offsets = np.r_[0, np.cumsum(np.bincount(session_user[known], minlength=len(user_ids)))]
+
+    @classmethod
+    def from_events(cls, events: pd.DataFrame):
+        """Index from events with session_id, user_id and timestamp (first non-null user per session)."""
+        session_codes, session_ids = pd.factorize(events["session_id"])
+        present = np.flatnonzero(events["user_id"].notna().to_numpy() & (session_codes >= 0))
+        first = np.full(len(session_ids), len(events), dtype=np.int64)
+        np.minimum.at(first, session_codes[present], present)
+        codes = np.flatnonzero(first < len(events))
+        users = np.full(len(session_ids), -1, dtype=np.int64)
+        users[codes], user_ids = pd.factorize(events["user_id"].iloc[first[codes]])
+
+        ts = events["timestamp"].to_numpy().astype("datetime64[ns]")
+        timed = (session_codes >= 0) & ~np.isnat(ts)
+        start = np.full(len(session_ids), NO_TIME, dtype=np.int64)
+        np.minimum.at(start, session_codes[timed], ts[timed].view("int64"))
+        return cls(session_ids, users.astype(np.int32), start, user_ids)
+
+    @property
+    def n_users(self) -> int:
+        return len(self.user_ids)
+
+    @property
+    def n_sessions(self) -> int:
+        return len(self.session_ids)
+
+    def positions(self, session_ids) -> np.ndarray:
+        """Session codes for session ids (-1 = not in the index)."""
+        return self.session_ids.get_indexer(session_ids)
+
+    def session_mask(self, session_ids) -> np.ndarray:
+        """Boolean per indexed session: True for the given session ids."""
+        mask = np.zeros(self.n_sessions, dtype=bool)
+        codes = self.positions(pd.unique(np.asarray(session_ids)))
+        mask[codes[codes >= 0]] = True
+        return mask
+
+    def per_user(self, values: np.ndarray, ufunc=np.add) -> np.ndarray:
+        """Reduce a per-session array (session-code order) over each user's slice."""
+        if self.n_users == 0:
+            return np.zeros((0,) + values.shape[1:], dtype=values.dtype)
+        return ufunc.reduceat(values[self.sessions], self.offsets[:-1], axis=0)
+
+    def broadcast(self, per_user: np.ndarray) -> np.ndarray:
+        """Expand a per-user array to the index's CSR session order."""
+        return np.repeat(per_user, np.diff(self.offsets), axis=0)
@@ -1,124 +1,280 @@
 -- E-Commerce Funnel & KPI Queries
 -- Run against your data warehouse (BigQuery, Snowflake, Redshift, etc.)
 -- Adapt table/column names to your schema.
+--
+-- These are the metric definitions behind outputs/*.csv. scripts/sql_backend.py runs this file
+-- locally with DuckDB over the cleaned layer: each query preceded by "-- name: <output>" is
+-- written to outputs/<output>.csv; unnamed statements (views) are executed as setup.
 
 -- ============================================
 -- 1. Funnel stages (one row per session)
 -- ============================================
+-- Stages are ordered: a session reaches a stage only if it also reached every earlier stage.
+-- A session's segment is the value on its earliest event (arg_min is DuckDB; MIN_BY in Snowflake/Databricks).
 CREATE OR REPLACE VIEW funnel_sessions AS
+WITH session_flags AS (
+    SELECT
+        session_id,
+        MIN(timestamp)                      AS session_start,
+        arg_min(user_id, timestamp)         AS user_id,
+        arg_min(device, timestamp)          AS device,
+        arg_min(region, timestamp)          AS region,
+        arg_min(campaign_source, timestamp) AS campaign_source,
+        MAX(CASE WHEN event_type = 'visit'       THEN 1 ELSE 0 END) AS visit,
+        MAX(CASE WHEN event_type = 'signup'      THEN 1 ELSE 0 END) AS signup,
+        MAX(CASE WHEN event_type = 'add_to_cart' THEN 1 ELSE 0 END) AS add_to_cart,
+        MAX(CASE WHEN event_type = 'purchase'    THEN 1 ELSE 0 END) AS purchase
+    FROM events_cleaned
+    WHERE session_id IS NOT NULL
+    GROUP BY session_id
+)
 SELECT
     session_id,
+    session_start,
     user_id,
-    MAX(CASE WHEN event_type = 'visit'       THEN 1 ELSE 0 END) AS visit,
-    MAX(CASE WHEN event_type = 'signup'      THEN 1 ELSE 0 END) AS signup,
-    MAX(CASE WHEN event_type = 'add_to_cart' THEN 1 ELSE 0 END) AS add_to_cart,
-    MAX(CASE WHEN event_type = 'purchase'   THEN 1 ELSE 0 END) AS purchase
-FROM events_cleaned
-GROUP BY session_id, user_id;
+    device,
+    region,
+    campaign_source,
+    visit,
+    visit * signup                              AS signup,
+    visit * signup * add_to_cart                AS add_to_cart,
+    visit * signup * add_to_cart * purchase     AS purchase
+FROM session_flags;
 
 -- ============================================
--- 2. Funnel counts and conversion rates
+-- 2. Funnel counts per segment (long format: one row per stage)
 -- ============================================
-WITH funnel_counts AS (
+-- segment = 'all' is the overall funnel; otherwise the segment column and its value.
+CREATE OR REPLACE VIEW funnel_segment_counts AS
+WITH cells AS (
     SELECT
-        SUM(visit)       AS visits,
-        SUM(signup)      AS signups,
+        device,
+        region,
+        campaign_source,
+        SUM(visit)       AS visit,
+        SUM(signup)      AS signup,
         SUM(add_to_cart) AS add_to_cart,
-        SUM(purchase)    AS purchases
+        SUM(purchase)    AS purchase
     FROM funnel_sessions
+    GROUP BY device, region, campaign_source
+),
+segments AS (
+    SELECT 'all' AS segment, 'all' AS value, visit, signup, add_to_cart, purchase FROM cells
+    UNION ALL
+    SELECT 'device', device, visit, signup, add_to_cart, purchase FROM cells WHERE device IS NOT NULL
+    UNION ALL
+    SELECT 'region', region, visit, signup, add_to_cart, purchase FROM cells WHERE region IS NOT NULL
+    UNION ALL
+    SELECT 'campaign_source', campaign_source, visit, signup, add_to_cart, purchase
+    FROM cells WHERE campaign_source IS NOT NULL
+),
+totals AS (
+    SELECT
+        segment,
+        value,
+        CAST(SUM(visit) AS BIGINT)       AS visit,
+        CAST(SUM(signup) AS BIGINT)      AS signup,
+        CAST(SUM(add_to_cart) AS BIGINT) AS add_to_cart,
+        CAST(SUM(purchase) AS BIGINT)    AS purchase
+    FROM segments
+    GROUP BY segment, value
 )
-SELECT
-    visits,
-    signups,
-    add_to_cart,
-    purchases,
-    ROUND(100.0 * signups       / NULLIF(visits, 0), 2)    AS signup_rate_pct,
-    ROUND(100.0 * add_to_cart   / NULLIF(visits, 0), 2)    AS add_to_cart_rate_pct,
-    ROUND(100.0 * purchases     / NULLIF(visits, 0), 2)    AS overall_conversion_pct,
-    ROUND(100.0 * purchases     / NULLIF(add_to_cart, 0), 2) AS cart_to_purchase_pct
-FROM funnel_counts;
+SELECT segment, value, 1 AS stage_order, 'visit' AS stage, visit AS count FROM totals
+UNION ALL
+SELECT segment, value, 2, 'signup', signup FROM totals
+UNION ALL
+SELECT segment, value, 3, 'add_to_cart', add_to_cart FROM totals
+UNION ALL
+SELECT segment, value, 4, 'purchase', purchase FROM totals;
 
 -- ============================================
--- 3. Funnel by device
+-- 3. Conversion and drop-off rates
 -- ============================================
-WITH session_device AS (
-    SELECT session_id, device
-    FROM events_cleaned
-    GROUP BY session_id, device
+CREATE OR REPLACE VIEW funnel_rates AS
+WITH prior AS (
+    SELECT
+        segment,
+        value,
+        stage_order,
+        stage,
+        count,
+        FIRST_VALUE(count) OVER (PARTITION BY segment, value ORDER BY stage_order) AS visits,
+        LAG(count) OVER (PARTITION BY segment, value ORDER BY stage_order)         AS previous
+    FROM funnel_segment_counts
 ),
-funnel_device AS (
+rates AS (
     SELECT
-        sd.device,
-        SUM(f.visit)       AS visits,
-        SUM(f.signup)      AS signups,
-        SUM(f.add_to_cart) AS add_to_cart,
-        SUM(f.purchase)    AS purchases
-    FROM funnel_sessions f
-    JOIN session_device sd ON f.session_id = sd.session_id
-    GROUP BY sd.device
+        *,
+        CASE WHEN stage_order = 1 THEN 100.0
+             ELSE COALESCE(100.0 * count / NULLIF(previous, 0), 0) END AS from_previous
+    FROM prior
 )
 SELECT
-    device,
-    visits,
-    signups,
-    add_to_cart,
-    purchases,
-    ROUND(100.0 * purchases / NULLIF(visits, 0), 2) AS conversion_pct
-FROM funnel_device
-ORDER BY visits DESC;
+    segment,
+    value,
+    stage_order,
+    stage,
+    count,
+    ROUND(COALESCE(100.0 * count / NULLIF(visits, 0), 0), 2)                  AS conversion_from_visit_pct,
+    ROUND(from_previous, 2)                                                     AS conversion_from_previous_stage_pct,
+    ROUND(CASE WHEN stage_order = 1 THEN 0 ELSE 100 - from_previous END, 2)     AS drop_off_from_previous_pct
+FROM rates;
+
+-- name: funnel_counts
+SELECT stage, count
+FROM funnel_rates
+WHERE segment = 'all'
+ORDER BY stage_order;
+
+-- name: funnel_conversion_rates
+SELECT stage, count, conversion_from_visit_pct, conversion_from_previous_stage_pct, drop_off_from_previous_pct
+FROM funnel_rates
+WHERE segment = 'all'
+ORDER BY stage_order;
 
 -- ============================================
--- 4. KPIs: Revenue, AOV, Orders
+-- 4. Funnel by device, region and campaign
 -- ============================================
--- Assumes events_cleaned has purchase events with product_id/quantity
--- and products table has price.
-SELECT
-    COUNT(DISTINCT session_id) AS total_orders,
-    SUM(quantity * price)     AS total_revenue,
-    ROUND(AVG(order_value), 2) AS avg_order_value
-FROM (
-    SELECT
-        e.session_id,
-        e.product_id,
-        e.quantity,
-        p.price,
-        e.quantity * p.price AS order_value
-    FROM events_cleaned e
-    JOIN products_cleaned p ON e.product_id = p.product_id
-    WHERE e.event_type = 'purchase'
-) orders;
+-- name: funnel_by_device
+SELECT stage, count, conversion_from_visit_pct, conversion_from_previous_stage_pct, drop_off_from_previous_pct,
+       value AS device
+FROM funnel_rates
+WHERE segment = 'device'
+ORDER BY value, stage_order;
+
+-- name: funnel_by_region
+SELECT stage, count, conversion_from_visit_pct, conversion_from_previous_stage_pct, drop_off_from_previous_pct,
+       value AS region
+FROM funnel_rates
+WHERE segment = 'region'
+ORDER BY value, stage_order;
+
+-- name: funnel_by_campaign_source
+SELECT stage, count, conversion_from_visit_pct, conversion_from_previous_stage_pct, drop_off_from_previous_pct,
+       value AS campaign_source
+FROM funnel_rates
+WHERE segment = 'campaign_source'
+ORDER BY value, stage_order;
 
 -- ============================================
--- 5. Top products by revenue
+-- 5. Purchases joined to the catalog
 -- ============================================
+-- Purchases of unknown products are kept (price NULL, revenue 0) for order counts and units.
+CREATE OR REPLACE VIEW purchases AS
 SELECT
-    p.product_id,
+    e.session_id,
+    e.user_id,
+    e.product_id,
+    e.quantity,
+    e.timestamp,
     p.product_name,
     p.category,
-    SUM(e.quantity) AS units_sold,
-    SUM(e.quantity * p.price) AS revenue
+    p.price,
+    COALESCE(e.quantity * p.price, 0) AS revenue
 FROM events_cleaned e
-JOIN products_cleaned p ON e.product_id = p.product_id
-WHERE e.event_type = 'purchase'
-GROUP BY p.product_id, p.product_name, p.category
-ORDER BY revenue DESC
-LIMIT 20;
+LEFT JOIN products_cleaned p ON e.product_id = p.product_id
+WHERE e.event_type = 'purchase';
 
 -- ============================================
--- 6. Daily conversion rate (time series)
+-- 6. KPIs: AOV, revenue, repeat purchasers, orders
 -- ============================================
-WITH daily_funnel AS (
-    SELECT
-        DATE(timestamp) AS date,
-        COUNT(DISTINCT CASE WHEN event_type = 'visit'       THEN session_id END) AS visits,
-        COUNT(DISTINCT CASE WHEN event_type = 'purchase'    THEN session_id END) AS purchases
-    FROM events_cleaned
-    GROUP BY DATE(timestamp)
+-- An order is a session with at least one purchase.
+-- name: kpis
+WITH orders AS (
+    SELECT session_id, SUM(revenue) AS order_value
+    FROM purchases
+    WHERE session_id IS NOT NULL
+    GROUP BY session_id
+),
+buyers AS (
+    SELECT user_id, COUNT(DISTINCT session_id) AS sessions
+    FROM purchases
+    WHERE user_id IS NOT NULL
+    GROUP BY user_id
 )
 SELECT
-    date,
-    visits,
-    purchases,
-    ROUND(100.0 * purchases / NULLIF(visits, 0), 2) AS conversion_pct
-FROM daily_funnel
+    (SELECT AVG(order_value) FROM orders)                                        AS aov,
+    (SELECT SUM(order_value) FROM orders)                                        AS total_revenue,
+    (SELECT COALESCE(100.0 * AVG(CASE WHEN sessions > 1 THEN 1 ELSE 0 END), 0)
+     FROM buyers)                                                                AS repeat_purchaser_pct,
+    (SELECT COUNT(*) FROM orders)                                                AS total_orders;
+
+-- ============================================
+-- 7. Top products and categories by revenue
+-- ============================================
+-- name: top_products
+SELECT
+    product_id,
+    product_name,
+    category,
+    CAST(SUM(quantity) AS BIGINT) AS units_sold,
+    SUM(revenue)  AS revenue
+FROM purchases
+WHERE product_name IS NOT NULL AND category IS NOT NULL
+GROUP BY product_id, product_name, category
+ORDER BY revenue DESC;
+
+-- name: revenue_by_category
+SELECT
+    category,
+    CAST(SUM(quantity) AS BIGINT) AS units_sold,
+    SUM(revenue)               AS revenue,
+    COUNT(DISTINCT session_id) AS orders
+FROM purchases
+WHERE category IS NOT NULL
+GROUP BY category
+ORDER BY revenue DESC;
+
+-- ============================================
+-- 8. Daily revenue and funnel conversion (time series)
+-- ============================================
+-- name: daily_revenue
+SELECT
+    CAST(timestamp AS DATE)    AS date,
+    SUM(revenue)               AS revenue,
+    COUNT(DISTINCT session_id) AS orders,
+    CAST(SUM(quantity) AS BIGINT) AS units
+FROM purchases
+WHERE timestamp IS NOT NULL
+GROUP BY CAST(timestamp AS DATE)
+ORDER BY date;
+
+-- Revenue by weekday (Monday = 0) and hour, the cells of the revenue heatmap.
+-- name: revenue_seasonality
+SELECT
+    CAST(ISODOW(timestamp) - 1 AS BIGINT) AS weekday,
+    CAST(HOUR(timestamp) AS BIGINT)       AS hour,
+    SUM(revenue)                          AS revenue
+FROM purchases
+WHERE timestamp IS NOT NULL
+GROUP BY 1, 2
+ORDER BY weekday, hour;
+
+-- Sessions bucketed by the day / Monday-based week of their first event; stage counts are ordered.
+-- name: funnel_daily
+SELECT
+    CAST(session_start AS DATE)                                          AS date,
+    COUNT(*)                                                             AS sessions,
+    CAST(SUM(visit) AS BIGINT)                                           AS visit,
+    CAST(SUM(signup) AS BIGINT)                                          AS signup,
+    CAST(SUM(add_to_cart) AS BIGINT)                                     AS add_to_cart,
+    CAST(SUM(purchase) AS BIGINT)                                        AS purchase,
+    ROUND(COALESCE(100.0 * SUM(purchase) / NULLIF(SUM(visit), 0), 0), 2) AS conversion_pct
+FROM funnel_sessions
+WHERE session_start IS NOT NULL
+GROUP BY CAST(session_start AS DATE)
+ORDER BY date;
+
+-- name: funnel_weekly
+SELECT
+    CAST(DATE_TRUNC('week', session_start) AS DATE)                      AS date,
+    COUNT(*)                                                             AS sessions,
+    CAST(SUM(visit) AS BIGINT)                                           AS visit,
+    CAST(SUM(signup) AS BIGINT)                                          AS signup,
+    CAST(SUM(add_to_cart) AS BIGINT)                                     AS add_to_cart,
+    CAST(SUM(purchase) AS BIGINT)                                        AS purchase,
+    ROUND(COALESCE(100.0 * SUM(purchase) / NULLIF(SUM(visit), 0), 0), 2) AS conversion_pct
+FROM funnel_sessions
+WHERE session_start IS NOT NULL
+GROUP BY CAST(DATE_TRUNC('week', session_start) AS DATE)
 ORDER BY date;